@@ -0,0 +1,169 @@
+""" Plans the trip to a film for many users at once: for every origin of a CSV or Parquet file it finds the first projection of the film
+    the user can arrive to, and writes the cinema, the travel time and the path (node ids of the city graph) to a CSV file as the results come.
+    The origins need the columns lon and lat (or address, geocoded with osmnx), and an id column is copied to the results if there is one.
+    Parquet files are read with pyarrow, only needed for them (pip install pyarrow).
+    The city graph is loaded once and shared with the worker processes: they are forked after loading it (the snapshot arrays are memory-mapped,
+    so even where the workers have to load it again, the pages are shared).
+    Run from the root of the project:
+        python batch.py origins.csv results.csv --film "title" [--time 18:30] [--original] [--workers 8] [--metrics-log spans.jsonl] [--profile profiles] """
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Any
+import osmnx as ox
+import billboard
+import city
+import metrics
+import planner
+
+
+CHUNK_SIZE: int = 64  # origins sent to a worker at once
+RESULT_COLUMNS: list[str] = ['id', 'lon', 'lat', 'cinema', 'start',
+                             'language', 'travel_time', 'path']
+
+Origin = tuple[Any, float, float]  # (id, lon, lat)
+
+# State of every worker process, inherited when the pool is forked (set by _init_worker otherwise)
+_planner: planner.Planner | None = None
+_candidates: list[billboard.Projection] = list()
+_cinema_node: dict[str, Any] = dict()
+_now: int = 0
+
+
+def _read_table(filename: str) -> tuple[list[str], list[dict[str, Any]]]:
+    """ Returns the columns and the rows of the CSV or Parquet (.parquet) file """
+    if filename.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ModuleNotFoundError as error:
+            raise ModuleNotFoundError(
+                "Reading Parquet origins needs pyarrow (pip install pyarrow), or give them as CSV") from error
+        table = pyarrow.parquet.read_table(filename)
+        return table.column_names, table.to_pylist()
+    with open(filename, 'r', newline='') as file:
+        reader = csv.DictReader(file)
+        return list(reader.fieldnames or []), list(reader)
+
+
+def _missing(value: Any) -> bool:
+    """ Empty cell: empty in a CSV file, null (or NaN) in a Parquet file """
+    return value is None or value == '' or (isinstance(value, float) and math.isnan(value))
+
+
+def read_origins(filename: str) -> list[Origin]:
+    """ Returns (id, lon, lat) of every row of the CSV or Parquet (.parquet) file. Rows with an address instead of coordinates are geocoded """
+    columns, rows = _read_table(filename)
+    assert 'lon' in columns and 'lat' in columns or 'address' in columns, \
+        'The origins need the columns lon and lat, or address'
+
+    origins: list[Origin] = list()
+    for i, row in enumerate(rows):
+        id = row['id'] if 'id' in row else i
+        if 'lon' in row and not _missing(row['lon']):
+            origins.append((id, float(row['lon']), float(row['lat'])))
+        else:
+            lat, lon = ox.geocode(row['address'])
+            origins.append((id, lon, lat))
+    return origins
+
+
+def _init_worker(candidates: list[billboard.Projection], now: int, metrics_settings: tuple[str | None, str | None]) -> None:
+    """ Sets the projections to check in a worker, and loads the planner if the worker was not forked from the process that loaded it """
+    global _planner, _candidates, _cinema_node, _now
+    metrics.configure(*metrics_settings)
+    if _planner is None:
+        _planner = planner.load_planner()
+    _candidates = candidates
+    _cinema_node = planner.cinema_nodes(_planner.graph, list(
+        {projection.cinema.name for projection in candidates}))
+    _now = now
+
+
+def plan_chunk(origins: list[Origin]) -> list[list[Any]]:
+    """ Plans the trip of every origin of the chunk, returns a row of results (RESULT_COLUMNS) for each """
+    assert _planner is not None
+    g = _planner.graph
+    user_nodes = city.nearest_nodes(
+        g, [lon for _, lon, _ in origins], [lat for _, _, lat in origins])
+    rows: list[list[Any]] = list()
+    for (id, lon, lat), user_node in zip(origins, user_nodes):
+        projection, travel, path = planner.closest_projection(
+            _planner, _candidates, _cinema_node, user_node, _now)
+        if projection is None:
+            rows.append([id, lon, lat, '', '', '', '', ''])
+            continue
+        rows.append([id, lon, lat, projection.cinema.name, '%02d:%02d' % projection.time, projection.language,
+                     round(travel), ' '.join(str(g.node_id(node)) for node in path)])
+    return rows
+
+
+def plan_batch(origins: list[Origin], output: str, candidates: list[billboard.Projection], now: int, workers: int | None = None) -> int:
+    """ Plans the trip of every origin leaving at now (seconds from 00:00) to the first of the candidates (projections sorted by start time) it can arrive to,
+        using a pool of worker processes (one per core by default). The results are written to the CSV file output as they come (not in the order of the origins).
+        Returns how many origins can arrive to a projection """
+    global _planner
+    _planner = planner.load_planner()
+
+    chunks = [origins[i:i+CHUNK_SIZE]
+              for i in range(0, len(origins), CHUNK_SIZE)]
+    # fork shares the loaded graph with the workers without copying or pickling it
+    method: str = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+
+    found: int = 0
+    done: int = 0
+    start = time.perf_counter()
+    with open(output, 'w', newline='') as file, context.Pool(workers, _init_worker, (candidates, now, metrics.settings())) as pool:
+        writer = csv.writer(file)
+        writer.writerow(RESULT_COLUMNS)
+        for rows in pool.imap_unordered(plan_chunk, chunks):
+            writer.writerows(rows)
+            file.flush()
+            found += sum(1 for row in rows if row[3])
+            done += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"\r{done}/{len(origins)} origins, {done/elapsed:.0f}/s, {found} can arrive",
+                  end='', file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Finds the first projection of a film every origin can arrive to")
+    parser.add_argument('origins', help="CSV or Parquet file with the columns lon and lat (or address)")
+    parser.add_argument('output', help="CSV file for the results")
+    parser.add_argument('--film', required=True, help="title of the film")
+    parser.add_argument('--time', help="departure time HH:MM (now by default)")
+    parser.add_argument('--original', action='store_true',
+                        help="original language instead of dubbed")
+    parser.add_argument('--workers', type=int,
+                        default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--metrics-log', help="file where every timing span is written as a line of JSON")
+    parser.add_argument('--profile', help="directory for the cProfile stats of every origin")
+    args = parser.parse_args()
+    metrics.configure(args.metrics_log, args.profile)
+
+    if args.time is None:
+        current = datetime.now()
+        now = current.hour*3600 + current.minute*60 + current.second
+    else:
+        now = billboard.get_time_in_seconds(
+            tuple(int(x) for x in args.time.split(':')))
+    language: str = "Original" if args.original else "Doblada"
+
+    candidates = billboard.ProjectionIndex(
+        billboard.read()).next_showings(args.film, language, now)
+    assert candidates, 'No projections of '+args.film+' in '+language+' after that time'
+    origins = read_origins(args.origins)
+    found = plan_batch(origins, args.output, candidates, now, args.workers)
+    print(f"{found}/{len(origins)} origins can arrive to a projection of {args.film}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+""" Checks that billboard.extract_page (lxml, one pass) gets the same cinemas, films and projections as the previous BeautifulSoup
+    implementation (kept here as reference) and compares their times over a directory of stored sensacine pages (1.html, 2.html, ...).
+    Run from the root of the project:
+        python -m benchmarks.bench_billboard <directory with the pages> [repetitions] """
+import os
+import sys
+import json
+import time
+from bs4 import BeautifulSoup
+import billboard
+
+
+def reference_extract(pages: dict[int, bytes]) -> tuple[dict[str, str], dict[str, str], set[tuple[str, str, str, str]]]:
+    """ Previous implementation: every page is parsed with BeautifulSoup and walked three times (cinemas, films and schedule).
+        Returns {cinema name: address}, {movie id: title} and the set of (movie id, cinema, time, language).
+        The previous read() skipped the first cinema of every film, here it is not skipped so both can be compared """
+    soups = {page: BeautifulSoup(content, 'html.parser')
+             for page, content in pages.items()}
+
+    cinemas: dict[str, str] = dict()
+    for soup in soups.values():
+        theatre_address: dict[str, str] = dict()
+        span_address = soup.find_all('span', class_='lighten')
+        for i, cinema in enumerate(soup.find_all('a', class_='j_entities')):
+            cinema_id: str = json.loads(cinema["data-entities"])["entityId"]
+            theatre_address[cinema_id] = span_address[2*i+1].get_text(strip=True)
+        for item in soup.find_all("div", class_="item_resa"):
+            data_theater = json.loads(item.find('div', class_='j_w')['data-theater'])
+            cinemas.setdefault(data_theater['name'], theatre_address[data_theater['id']])
+
+    films: dict[str, str] = dict()
+    for soup in soups.values():
+        for item in soup.find_all("div", class_="item_resa"):
+            data_movie = json.loads(item.find('div', class_='j_w')['data-movie'])
+            films.setdefault(data_movie['id'], data_movie['title'])
+
+    projections: set[tuple[str, str, str, str]] = set()
+    for soup in soups.values():
+        for item in soup.find_all("div", class_="item_resa"):
+            jw_div = item.find('div', class_='j_w')
+            theatre_name = json.loads(jw_div['data-theater'])['name']
+            movie_id = json.loads(jw_div['data-movie'])['id']
+            language = "Original" if "Original" in str(jw_div) else "Doblada"
+            for em in item.find_all('em'):
+                projections.add((movie_id, theatre_name, json.loads(em['data-times'])[0], language))
+
+    return cinemas, films, projections
+
+
+def new_extract(pages: dict[int, bytes]) -> tuple[dict[str, str], dict[str, str], set[tuple[str, str, str, str]]]:
+    """ Same result as reference_extract using billboard.extract_page """
+    cinemas: dict[str, str] = dict()
+    films: dict[str, str] = dict()
+    projections: set[tuple[str, str, str, str]] = set()
+    for content in pages.values():
+        for showing in billboard.extract_page(content):
+            cinemas.setdefault(showing.theater['name'], showing.address)
+            films.setdefault(showing.movie['id'], showing.movie['title'])
+            projections.update((showing.movie['id'], showing.theater['name'], t, showing.language)
+                               for t in showing.times)
+    return cinemas, films, projections
+
+
+def main() -> None:
+    directory: str = sys.argv[1]
+    repetitions: int = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    pages: dict[int, bytes] = dict()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.html'):
+            with open(os.path.join(directory, name), 'rb') as file:
+                pages[int(name.split('.')[0])] = file.read()
+    size = sum(len(content) for content in pages.values())
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        reference = reference_extract(pages)
+    reference_time = (time.perf_counter() - start)/repetitions
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        result = new_extract(pages)
+    new_time = (time.perf_counter() - start)/repetitions
+
+    assert reference[0] == result[0], 'different cinemas'
+    assert reference[1] == result[1], 'different films'
+    assert reference[2] == result[2], 'different projections'
+
+    print(f"{len(pages)} pages ({size/1e6:.1f} MB): {len(result[0])} cinemas, {len(result[1])} films, {len(result[2])} projections, all equal")
+    print(f"beautifulsoup: {1000*reference_time:.1f} ms ({size/1e6/reference_time:.1f} MB/s)")
+    print(f"lxml:          {1000*new_time:.1f} ms ({size/1e6/new_time:.1f} MB/s, {reference_time/new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
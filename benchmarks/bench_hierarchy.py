@@ -0,0 +1,82 @@
+""" Compares walking queries answered with the contraction hierarchy of hierarchy.py against nx.shortest_path on the street graph.
+    Reports the preprocessing time and the latency percentiles of both on the same random origin/destination pairs.
+    With a snapshot of the current inputs at barcelona_city the hierarchy is built on its graph and saved next to it, so the app uses it afterwards
+    (python planner.py --hierarchy does the same without the comparison). Without it, it is built on a graph compiled here and not saved.
+    Run from the root of the project (needs barcelona.pickle, and busRoutes.json/busStops.json to add the buses):
+        python -m benchmarks.bench_hierarchy [number of queries] """
+import os
+import sys
+import time
+import random
+import numpy as np
+import networkx as nx
+import buses
+import city
+import hierarchy
+import planner
+
+
+def percentiles(times: list[float]) -> str:
+    p50, p90, p99 = np.percentile(np.array(times)*1e6, [50, 90, 99])
+    return f"p50 {p50:9.1f} us   p90 {p90:9.1f} us   p99 {p99:9.1f} us"
+
+
+def main() -> None:
+    queries: int = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ox_g = city.load_osmnx_graph("barcelona.pickle")
+    # the node indices of the hierarchy have to be the ones of the snapshot it is saved with
+    inputs: str | None = None
+    cg: city.CompiledGraph | None = None
+    if all(os.path.exists(name) for name in planner.CITY_INPUTS):
+        inputs = city.inputs_hash(planner.CITY_INPUTS)
+        cg = city.load_city_snapshot(planner.SNAPSHOT_DIR, inputs)
+    if cg is None:
+        bus_g = buses.get_buses_graph() if os.path.exists(
+            "busRoutes.json") else buses.BusesGraph()
+        cg = city.compile_city_graph(city.build_city_graph(ox_g, bus_g))
+        inputs = None
+
+    start = time.perf_counter()
+    h = hierarchy.build_hierarchy(cg)
+    print(f"preprocessing: {time.perf_counter()-start:.1f} s, {h.number_of_shortcuts()} shortcuts for {cg.number_of_edges()} edges")
+    if inputs is not None:
+        hierarchy.save_hierarchy(h, planner.SNAPSHOT_DIR, inputs)
+
+    # Same random origin/destination pairs (street nodes) for both
+    rng = random.Random(0)
+    streets = list(ox_g.nodes)
+    pairs = [(rng.choice(streets), rng.choice(streets))
+             for _ in range(queries)]
+
+    nx_times: list[float] = list()
+    nx_costs: list[float] = list()
+    for src, dst in pairs:
+        begin = time.perf_counter()
+        try:
+            path = nx.shortest_path(ox_g, src, dst, weight='length')
+            nx_costs.append(nx.path_weight(ox_g, path, 'length'))
+        except nx.NetworkXNoPath:
+            nx_costs.append(float('inf'))
+        nx_times.append(time.perf_counter()-begin)
+
+    ch_times: list[float] = list()
+    ch_costs: list[float] = list()
+    for src, dst in pairs:
+        u, v = cg.index_of(src), cg.index_of(dst)
+        begin = time.perf_counter()
+        try:
+            ch_costs.append(hierarchy.query(h, u, v)[0])
+        except nx.NetworkXNoPath:
+            ch_costs.append(float('inf'))
+        ch_times.append(time.perf_counter()-begin)
+
+    # weights are float32 in the compiled graph so costs can differ a little
+    mismatches = sum(1 for a, b in zip(nx_costs, ch_costs)
+                     if abs(a-b) > 1e-3*max(1.0, a) and not (a == b))
+    print(f"networkx:  {percentiles(nx_times)}")
+    print(f"hierarchy: {percentiles(ch_times)}")
+    print(f"mean speedup: {sum(nx_times)/sum(ch_times):.1f}x, different costs: {mismatches}/{queries}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+""" Compares drawing all the edges and nodes of the city graph one by one (staticmap, as city.plot did before, and one PIL call per edge)
+    against the vectorized drawing of render.draw_routes/draw_points used by city.plot now. The tiles are not used (white background),
+    only the drawing of the network is measured. Also checks that the vectorized drawing paints about the same pixels.
+    Run from the root of the project (needs barcelona.pickle, and busRoutes.json/busStops.json to add the buses):
+        python -m benchmarks.bench_render [repetitions] """
+import os
+import sys
+import time
+import numpy as np
+import staticmap as stm
+from PIL import Image
+import buses
+import city
+import render
+
+
+def staticmap_draw(g: city.CompiledGraph, view: render.View) -> Image.Image:
+    """ Previous implementation: one stm.Line per edge and one stm.CircleMarker per node (only the features, without tiles) """
+    barcelona = stm.StaticMap(view.width, view.height)
+    for u in np.flatnonzero(g.barcelona):
+        barcelona.add_marker(stm.CircleMarker(
+            g.pos(u), str(g.colors[g.node_color[u]]), 2))
+    for u, v, e in g.edges():
+        if g.barcelona[u] and g.barcelona[v]:
+            barcelona.add_line(
+                stm.Line(g.route(e), str(g.colors[g.edge_color[e]]), 1))
+    # same view than render
+    barcelona.zoom = view.zoom
+    barcelona.x_center = (view.left + view.width/2) / render.TILE_SIZE
+    barcelona.y_center = (view.top + view.height/2) / render.TILE_SIZE
+    image = Image.new('RGB', (view.width, view.height), render.BACKGROUND)
+    barcelona._draw_features(image)
+    return image
+
+
+def per_edge_draw(g: city.CompiledGraph, view: render.View) -> Image.Image:
+    """ One ImageDraw call per edge and per node with render.draw_lines/draw_circles """
+    image = Image.new('RGB', (view.width, view.height), render.BACKGROUND)
+    render.draw_lines(image, view, [(g.route(e), str(g.colors[g.edge_color[e]]), 1)
+                                    for u, v, e in g.edges() if g.barcelona[u] and g.barcelona[v]])
+    render.draw_circles(image, view, [(g.pos(u), str(g.colors[g.node_color[u]]), 2)
+                                      for u in np.flatnonzero(g.barcelona)])
+    return image
+
+
+def vectorized_draw(g: city.CompiledGraph, view: render.View) -> Image.Image:
+    image = Image.new('RGB', (view.width, view.height), render.BACKGROUND)
+    city._draw_city(g, image, view)
+    return image
+
+
+def painted(image: Image.Image) -> np.ndarray:
+    return np.any(np.array(image) < 250, axis=2)
+
+
+def main() -> None:
+    repetitions: int = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    ox_g = city.load_osmnx_graph("barcelona.pickle")
+    bus_g = buses.get_buses_graph() if os.path.exists(
+        "busRoutes.json") else buses.BusesGraph()
+    g = city.compile_city_graph(city.build_city_graph(ox_g, bus_g))
+    view = city.map_view(g)
+    print(f"{g.number_of_edges()} edges, {len(g.geom)} points, {view.width}x{view.height} pixels at zoom {view.zoom}")
+
+    images: dict[str, Image.Image] = dict()
+    for name, draw in [("staticmap", staticmap_draw), ("per edge", per_edge_draw), ("vectorized", vectorized_draw)]:
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            images[name] = draw(g, view)
+        print(f"{name:10}: {1000*(time.perf_counter()-start)/repetitions:8.1f} ms")
+
+    # staticmap antialiases, so only compare which pixels are painted (PIL and render can round a point to the next pixel)
+    reference, result = painted(images["per edge"]), painted(images["vectorized"])
+    near = reference.copy()
+    for axis in (0, 1):
+        near |= np.roll(reference, 1, axis) | np.roll(reference, -1, axis)
+    print(f"painted pixels: per edge {reference.sum()}, vectorized {result.sum()}, {100*(result & near).sum()/result.sum():.1f}% of them within a pixel of the per edge ones")
+
+
+if __name__ == "__main__":
+    main()
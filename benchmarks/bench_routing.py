@@ -0,0 +1,57 @@
+""" Compares the networkx shortest path with the compiled (CSR) graph of routing.py on the Barcelona graph.
+    Run from the root of the project (needs barcelona.pickle, and busRoutes.json/busStops.json to add the buses):
+        python -m benchmarks.bench_routing [number of queries] """
+import os
+import sys
+import time
+import random
+import networkx as nx
+import buses
+import city
+import routing
+
+
+def main() -> None:
+    queries: int = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    ox_g = city.load_osmnx_graph("barcelona.pickle")
+    bus_g = buses.get_buses_graph() if os.path.exists(
+        "busRoutes.json") else buses.BusesGraph()
+    g = city.build_city_graph(ox_g, bus_g)
+
+    start = time.perf_counter()
+    cg = routing.compile_graph(g)
+    print(f"compile: {time.perf_counter()-start:.2f} s for {cg.number_of_nodes()} nodes and {cg.number_of_edges()} edges")
+
+    # Same random origin/destination pairs for both engines
+    rng = random.Random(0)
+    nodes = list(g.nodes)
+    pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(queries)]
+
+    start = time.perf_counter()
+    nx_costs: list[float] = list()
+    for src, dst in pairs:
+        try:
+            nx_costs.append(nx.shortest_path_length(
+                g, src, dst, weight='length'))
+        except nx.NetworkXNoPath:
+            nx_costs.append(float('inf'))
+    nx_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    csr_costs: list[float] = list()
+    for src, dst in pairs:
+        u, v = cg.index_of(src), cg.index_of(dst)
+        dist, _ = routing.dijkstra(cg, u, {v})
+        csr_costs.append(dist.get(v, float('inf')))
+    csr_time = time.perf_counter() - start
+
+    # weights are float32 in the compiled graph so costs can differ a little
+    mismatches = sum(1 for a, b in zip(nx_costs, csr_costs)
+                     if abs(a-b) > 1e-3*max(1.0, a) and not (a == b))
+    print(f"networkx: {1000*nx_time/queries:.2f} ms/query")
+    print(f"csr:      {1000*csr_time/queries:.2f} ms/query ({nx_time/csr_time:.1f}x)")
+    print(f"different costs: {mismatches}/{queries}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+""" Freezes the local fixtures the benchmark suite (benchmarks.suite) runs against, so the results do not depend on the network or on the data of the day.
+    They are committed with the suite (and benchmarks/baseline.json measured on them), freezing them again is only needed to change them:
+        fixtures/barcelona.pickle                  the streets of a small area of the walking graph saved by the app (city.get_osmnx_graph)
+        fixtures/busRoutes.json, busStops.json     the first lines of the bus json files whose stops are all inside that graph
+        fixtures/pages/<page>.html                 the sensacine pages read by billboard.read
+        fixtures/queries.json                      fixed random origin/destination pairs inside the graph
+        fixtures/manifest.json                     hash of every file, the baseline belongs to one manifest
+    Run from the root of the project (needs barcelona.pickle, busRoutes.json and busStops.json, and the sensacine pages: from --pages or billboard's cache/server):
+        python -m benchmarks.fixtures [--lines 20] [--pages directory with 1.html, 2.html...] [--queries 100] """
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import networkx as nx
+import billboard
+import buses
+import city
+
+
+FIXTURES_DIR: str = os.path.join(os.path.dirname(__file__), "fixtures")
+FIXTURE_BBOX: tuple[float, float, float, float] = (2.168, 41.378, 2.182, 41.390)  # (min lon, min lat, max lon, max lat) of the streets kept
+SEED: int = 2023
+
+
+def freeze_osmnx_graph(source: str, filename: str, bbox: tuple[float, float, float, float] = FIXTURE_BBOX) -> city.OsmnxGraph:
+    """ Saves the streets of the osmnx graph at source (city.save_osmnx_graph) inside bbox, only the largest part where every node can be reached
+        from every other. Saved once, the fixture does not change with osmnx or with OpenStreetMap """
+    g = city.load_osmnx_graph(source)
+    inside = g.subgraph(u for u, data in g.nodes(data=True)
+                        if bbox[0] <= data['x'] <= bbox[2] and bbox[1] <= data['y'] <= bbox[3])
+    frozen: city.OsmnxGraph = city.OsmnxGraph(inside.subgraph(
+        max(nx.strongly_connected_components(inside), key=len)))
+    # the index of the addresses is not used by the benchmarks, and the spatial index has to be the one of the streets kept
+    frozen.graph.pop('addresses', None)
+    frozen.graph.pop('street_index', None)
+    city.street_index(frozen)
+    city.save_osmnx_graph(frozen, filename)
+    return frozen
+
+
+def freeze_buses(g: city.OsmnxGraph, lines: int, routes_file: str, stops_file: str, dirname: str) -> int:
+    """ Writes the routes and stops of the first lines (by id) whose stops are all inside the graph. Returns how many were written """
+    lons = [data['x'] for _, data in g.nodes(data=True)]
+    lats = [data['y'] for _, data in g.nodes(data=True)]
+    stops: dict[int, list[dict]] = dict()
+    for stop in buses.iter_features(stops_file):
+        stops.setdefault(int(stop['properties']['ID_RECORREGUT']), list()).append(stop)
+    inside = {id for id, line_stops in stops.items() if all(min(lons) <= stop['geometry']['coordinates'][0] <= max(lons)
+                                                             and min(lats) <= stop['geometry']['coordinates'][1] <= max(lats) for stop in line_stops)}
+    routes = sorted((route for route in buses.iter_features(routes_file) if int(route['properties']['ID_RECORREGUT']) in inside),
+                    key=lambda route: int(route['properties']['ID_RECORREGUT']))[:lines]
+    for filename, features in [("busRoutes.json", routes), ("busStops.json", [stop for route in routes for stop in stops[int(route['properties']['ID_RECORREGUT'])]])]:
+        with open(os.path.join(dirname, filename), 'w') as file:
+            json.dump({'type': 'FeatureCollection', 'features': features}, file)
+    return len(routes)
+
+
+def freeze_pages(pages_dir: str | None, dirname: str) -> None:
+    """ Copies the sensacine pages from pages_dir (<page>.html) or gets them with billboard (its cache or the server) """
+    pages = sorted(set(billboard.CINEMA_PAGES+billboard.FILM_PAGES))
+    os.makedirs(dirname, exist_ok=True)
+    if pages_dir is not None:
+        for page in pages:
+            shutil.copy(os.path.join(pages_dir, str(page)+'.html'), dirname)
+        return
+    for page, content in billboard.fetch_pages(pages).items():
+        with open(os.path.join(dirname, str(page)+'.html'), 'wb') as file:
+            file.write(content)
+
+
+def freeze_queries(g: city.OsmnxGraph, queries: int, filename: str) -> None:
+    """ Writes the origin/destination pairs (lon, lat) of the routing benchmarks, random points of the area of the graph """
+    rng = random.Random(SEED)
+    lons = [data['x'] for _, data in g.nodes(data=True)]
+    lats = [data['y'] for _, data in g.nodes(data=True)]
+
+    def point() -> list[float]:
+        return [rng.uniform(min(lons), max(lons)), rng.uniform(min(lats), max(lats))]
+    with open(filename, 'w') as file:
+        json.dump({'pairs': [[point(), point()] for _ in range(queries)]}, file)
+
+
+def manifest(dirname: str = FIXTURES_DIR) -> dict[str, str]:
+    """ Returns the sha1 of every fixture file (relative path -> hash), without the manifest itself """
+    hashes: dict[str, str] = dict()
+    for root, _, files in os.walk(dirname):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.relpath(path, dirname) != 'manifest.json':
+                with open(path, 'rb') as file:
+                    hashes[os.path.relpath(path, dirname)] = hashlib.sha1(
+                        file.read()).hexdigest()
+    return dict(sorted(hashes.items()))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Freezes the fixtures of the benchmark suite")
+    parser.add_argument('--graph', default="barcelona.pickle", help="osmnx graph saved by the app")
+    parser.add_argument('--lines', type=int, default=20, help="bus lines to keep")
+    parser.add_argument('--pages', help="directory with the sensacine pages (1.html, 2.html...)")
+    parser.add_argument('--queries', type=int, default=100, help="origin/destination pairs")
+    args = parser.parse_args()
+
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    g = freeze_osmnx_graph(args.graph, os.path.join(FIXTURES_DIR, "barcelona.pickle"))
+    lines = freeze_buses(g, args.lines, "busRoutes.json", "busStops.json", FIXTURES_DIR)
+    freeze_pages(args.pages, os.path.join(FIXTURES_DIR, "pages"))
+    freeze_queries(g, args.queries, os.path.join(FIXTURES_DIR, "queries.json"))
+    with open(os.path.join(FIXTURES_DIR, "manifest.json"), 'w') as file:
+        json.dump(manifest(), file, indent=1)
+    print(f"{g.number_of_nodes()} street nodes, {lines} bus lines, {args.queries} queries in {FIXTURES_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+""" Benchmark suite over the frozen fixtures (benchmarks.fixtures): building the bus and city graphs, reading the billboard, the routing queries and every plot.
+    Each benchmark runs in a process of its own (so the peak RSS is its own) inside a fresh copy of the fixtures, and nothing is downloaded:
+    the sensacine pages are served by a local server and the maps are drawn without tiles. For each benchmark it reports the wall time
+    (median and best of the repetitions), the peak RSS of its process and the peak of memory allocated by Python in one more run (tracemalloc).
+    The results are compared against the stored baseline: the suite fails (exit code 1) if any is more than --threshold worse.
+    Run from the root of the project:
+        python -m benchmarks.suite [--repetitions 5] [--threshold 0.25] [--only find_path ...] [--save-baseline] """
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import networkx as nx
+from PIL import Image
+import billboard
+import buses
+import city
+import planner
+import render
+from benchmarks import fixtures
+
+
+ROOT_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE: str = os.path.join(os.path.dirname(__file__), "baseline.json")
+ICONS: list[str] = ["start.png", "end.png"]  # drawn by city.plot_path, read from the working directory
+METRICS: list[str] = ['wall_s', 'peak_rss_mb', 'alloc_peak_mb']  # compared against the baseline
+# a metric is only worse if it grew more than this too, the small benchmarks change more than threshold with the noise of the machine
+NOISE: dict[str, float] = {'wall_s': 0.01, 'peak_rss_mb': 10, 'alloc_peak_mb': 1}
+NOW: int = 16*3600  # departure time of the projection queries
+PROJECTION_QUERIES: int = 20  # origins of find_closest_projection
+PLOTTED_PATHS: int = 10  # paths drawn by city.plot_path
+
+
+@dataclass
+class Benchmark:
+    name: str
+    setup: Callable[[], Any]  # prepares what the benchmark needs (not measured), its result is given to run
+    run: Callable[[Any], Any]  # the code measured
+
+
+def _serve_pages(dirname: str) -> str:
+    """ Serves the pages of dirname (<page>.html) as sensacine does (?page=<page>) in a background thread, returns the url to use as billboard.SENSACINE_URL """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            page = parse_qs(urlparse(self.path).query).get('page', ['1'])[0]
+            filename = os.path.join(dirname, os.path.basename(page)+'.html')
+            if not os.path.exists(filename):
+                self.send_error(404)
+                return
+            with open(filename, 'rb') as file:
+                content = file.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/?page="
+
+
+def _pairs() -> list[tuple[city.Coord, city.Coord]]:
+    with open("queries.json", 'r') as file:
+        return [(tuple(src), tuple(dst)) for src, dst in json.load(file)['pairs']]
+
+
+def _city_graph() -> city.CompiledGraph:
+    return city.compile_city_graph(city.build_city_graph(city.load_osmnx_graph("barcelona.pickle"), buses.get_buses_graph(None)))
+
+
+def _find_paths(state: tuple[city.CompiledGraph, list[tuple[city.Coord, city.Coord]]]) -> list[city.Path]:
+    g, pairs = state
+    paths: list[city.Path] = list()
+    for src, dst in pairs:
+        try:
+            paths.append(city.find_path(g, src, dst))
+        except nx.NetworkXNoPath:
+            paths.append(list())
+    return paths
+
+
+def _read_billboard() -> billboard.Billboard:
+    shutil.rmtree(billboard.CACHE_DIR, ignore_errors=True)  # every page is downloaded from the local server
+    return billboard.read()
+
+
+def _projection_setup() -> tuple[planner.Planner, billboard.ProjectionIndex, list[tuple[str, str]], list[city.Coord]]:
+    billboard.SENSACINE_URL = _serve_pages("pages")
+    bb = billboard.read()
+    films = sorted({(projection.film.title, projection.language)
+                   for projection in bb.projections})
+    city_planner = planner.load_planner()
+    city_planner.routes = None  # every repetition searches, the route cache would answer all but the first
+    return city_planner, billboard.ProjectionIndex(bb), films, [src for src, _ in _pairs()[:PROJECTION_QUERIES]]
+
+
+def _find_closest_projections(state: tuple[planner.Planner, billboard.ProjectionIndex, list[tuple[str, str]], list[city.Coord]]) -> None:
+    """ What the app does when the user clicks Find (without the plot), for each origin and a different film each time """
+    city_planner, projections, films, origins = state
+    for i, origin in enumerate(origins):
+        title, language = films[i % len(films)]
+        candidates = projections.next_showings(title, language, NOW)
+        user_node = city.nearest_nodes(
+            city_planner.graph, [origin[0]], [origin[1]])[0]
+        cinema_node = planner.cinema_nodes(city_planner.graph, list(
+            {projection.cinema.name for projection in candidates}))
+        planner.closest_projection(
+            city_planner, candidates, cinema_node, user_node, NOW)
+
+
+def _plot_city(g: city.CompiledGraph) -> None:
+    city.images(g).clear()  # drawn from scratch every time
+    render.base_map.cache_clear()
+    city.plot(g)
+
+
+def _plot_buses(g: buses.BusesGraph) -> None:
+    g.graph.pop('images', None)
+    render.base_map.cache_clear()
+    buses.plot(g)
+
+
+def _warm(state: Any, draw: Callable[[Any], Any]) -> Any:
+    """ Draws once so the cached layers are ready, the plots of paths and lines are drawn over them """
+    draw(state)
+    return state
+
+
+def _plot_paths(state: tuple[city.CompiledGraph, list[city.Path]]) -> None:
+    g, paths = state
+    for path in paths:
+        city.plot_path(g, path)
+
+
+def _plot_lines(g: buses.BusesGraph) -> None:
+    for id in buses.line_index(g):
+        buses.plot_BusLine(g, id)
+
+
+def _paths_setup() -> tuple[city.CompiledGraph, list[city.Path]]:
+    g = _city_graph()
+    paths = [path for path in _find_paths((g, _pairs())) if path]
+    return _warm((g, paths[:PLOTTED_PATHS]), _plot_paths)
+
+
+BENCHMARKS: list[Benchmark] = [
+    Benchmark('get_buses_graph', lambda: None,
+              lambda _: buses.get_buses_graph(None)),
+    Benchmark('build_city_graph', lambda: (city.load_osmnx_graph("barcelona.pickle"), buses.get_buses_graph(None)),
+              lambda state: city.build_city_graph(*state)),
+    Benchmark('billboard.read', lambda: setattr(billboard, 'SENSACINE_URL', _serve_pages("pages")),
+              lambda _: _read_billboard()),
+    Benchmark('find_path', lambda: (_city_graph(), _pairs()), _find_paths),
+    Benchmark('find_closest_projection', _projection_setup, _find_closest_projections),
+    Benchmark('city.plot', _city_graph, _plot_city),
+    Benchmark('city.plot_path', _paths_setup, _plot_paths),
+    Benchmark('buses.plot', lambda: buses.get_buses_graph(None), _plot_buses),
+    Benchmark('buses.plot_BusLine', lambda: _warm(
+        buses.get_buses_graph(None), _plot_lines), _plot_lines),
+]
+
+
+def measure(benchmark: Benchmark, repetitions: int) -> dict[str, float]:
+    """ Runs the benchmark in this process (in the current directory, a copy of the fixtures) and returns its results """
+    state = benchmark.setup()
+    benchmark.run(state)  # warm up: lazy imports, first reads of the files...
+    times: list[float] = list()
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        benchmark.run(state)
+        times.append(time.perf_counter() - start)
+    # tracemalloc slows everything down, so the allocations are measured in a run that is not timed
+    tracemalloc.start()
+    benchmark.run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss: float = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return {'wall_s': statistics.median(times), 'best_s': min(times), 'peak_rss_mb': rss, 'alloc_peak_mb': peak / 2**20}
+
+
+def _child(name: str, repetitions: int) -> None:
+    """ Runs one benchmark in a fresh copy of the fixtures and prints its results as JSON """
+    benchmark = next(benchmark for benchmark in BENCHMARKS if benchmark.name == name)
+    # the images are not opened in a viewer, and missing tiles are left blank instead of being downloaded
+    Image.Image.show = lambda self, *args, **kwargs: None
+    render._offline_until = math.inf
+    with tempfile.TemporaryDirectory() as dirname:
+        shutil.copytree(fixtures.FIXTURES_DIR, dirname, dirs_exist_ok=True)
+        for icon in ICONS:
+            shutil.copy(os.path.join(ROOT_DIR, icon), dirname)
+        os.chdir(dirname)
+        print(json.dumps(measure(benchmark, repetitions)))
+
+
+def run(name: str, repetitions: int) -> dict[str, float]:
+    """ Runs the benchmark in a new process and returns its results """
+    done = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--child', name, '--repetitions', str(repetitions)],
+                          capture_output=True, text=True, cwd=ROOT_DIR)
+    assert done.returncode == 0, name+' failed:\n'+done.stderr
+    return json.loads(done.stdout.strip().splitlines()[-1])
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], threshold: float) -> list[str]:
+    """ Returns a message for every metric that is more than threshold (fraction) and more than its NOISE worse than in the baseline """
+    failures: list[str] = list()
+    for name, result in results.items():
+        for metric in METRICS:
+            if name in baseline and baseline[name].get(metric, 0) > 0 and result[metric] > baseline[name][metric]*(1+threshold) \
+                    and result[metric] > baseline[name][metric]+NOISE[metric]:
+                failures.append(f"{name} {metric}: {result[metric]:.3f} vs {baseline[name][metric]:.3f} in the baseline "
+                                f"({100*(result[metric]/baseline[name][metric]-1):+.0f}%)")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks over the frozen fixtures compared with a baseline")
+    parser.add_argument('--repetitions', type=int, default=5, help="timed runs of each benchmark")
+    parser.add_argument('--threshold', type=float, default=0.25, help="fraction a metric can be worse than the baseline")
+    parser.add_argument('--only', nargs='+', help="names of the benchmarks to run")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        _child(args.child, args.repetitions)
+        return
+
+    assert os.path.exists(os.path.join(fixtures.FIXTURES_DIR, "manifest.json")), \
+        'No fixtures, freeze them first: python -m benchmarks.fixtures'
+    with open(os.path.join(fixtures.FIXTURES_DIR, "manifest.json"), 'r') as file:
+        manifest = json.load(file)
+    assert manifest == fixtures.manifest(), 'The fixtures changed since they were frozen'
+
+    baseline: dict[str, Any] | None = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as file:
+            baseline = json.load(file)
+        if baseline['manifest'] != manifest:
+            print("The baseline was measured with other fixtures, it is not compared")
+            baseline = None
+        elif baseline['machine'] != platform.platform():
+            print(f"The baseline was measured on {baseline['machine']}, times may not be comparable")
+
+    results: dict[str, dict[str, float]] = dict()
+    print(f"{'benchmark':24}{'median s':>10}{'best s':>10}{'RSS MB':>10}{'alloc MB':>10}{'vs baseline':>13}")
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.name not in args.only:
+            continue
+        result = results[benchmark.name] = run(benchmark.name, args.repetitions)
+        previous = baseline['results'].get(benchmark.name) if baseline is not None else None
+        change = f"{100*(result['wall_s']/previous['wall_s']-1):+.0f}%" if previous else '-'
+        print(f"{benchmark.name:24}{result['wall_s']:10.3f}{result['best_s']:10.3f}{result['peak_rss_mb']:10.1f}{result['alloc_peak_mb']:10.1f}{change:>13}")
+
+    if args.save_baseline:
+        saved = baseline['results'] if baseline is not None else dict()
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump({'manifest': manifest, 'machine': platform.platform(), 'python': platform.python_version(),
+                       'results': {**saved, **results}}, file, indent=1)
+        print("Baseline saved at", BASELINE_FILE)
+        return
+    failures = compare(results, baseline['results'], args.threshold) if baseline is not None else list()
+    for failure in failures:
+        print("REGRESSION", failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
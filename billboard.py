@@ -1,7 +1,14 @@
 from dataclasses import dataclass
-from bs4 import BeautifulSoup
+from lxml import html
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import requests
+import metrics
+import hashlib
+import bisect
+import time
 import json
+import os
 
 
 @dataclass
@@ -50,6 +57,17 @@ class Film_data:
         self.times = list()
 
 
+@dataclass
+class Showing:
+    '''Flat record of one item_resa block of a page: a film in a cinema with its schedule.
+    The data-movie and data-theater attributes are decoded only once, here'''
+    movie: dict  # decoded data-movie (id, title, genre, directors, actors, poster)
+    theater: dict  # decoded data-theater (id, name)
+    address: str  # address of the cinema ('' if not in the page)
+    language: str  # "Original" or "Doblada"
+    times: list[str]  # start times in format hh:mm
+
+
 cinemas_location: dict[str, tuple[float, float]] = {
     'Arenas Multicines 3D': (2.1492467400941715, 41.37645873603848),
     'Aribau Multicines': (2.1625393383857823, 41.38622954118975),
@@ -84,59 +102,153 @@ cinemas_location: dict[str, tuple[float, float]] = {
 }
 
 
-def get_cinemas() -> dict[str, Cinema]:
+# Base url of the billboard pages (the page number is added at the end), can be changed to use a local server
+SENSACINE_URL: str = "https://www.sensacine.com/cines/cines-en-72480/?page="
+CINEMA_PAGES: list[int] = [1, 2]  # pages with the cinemas (and projections)
+FILM_PAGES: list[int] = [1, 2, 3]  # pages with the films
+CACHE_DIR: str = "sensacine_cache"  # directory where the downloaded pages are kept
+CACHE_TTL: int = 15*60  # seconds a cached page is used without asking the server again
+
+
+def fetch_page(session: requests.Session, url: str, cache_dir: str | None = CACHE_DIR, ttl: int = CACHE_TTL) -> bytes:
+    '''Returns the content of url. If it is in the cache and younger than ttl it is not downloaded. Otherwise it is asked to the server
+    with its ETag/Last-Modified so that if it did not change (304) we reuse the cached content'''
+    if cache_dir is None:
+        r = session.get(url)
+        r.raise_for_status()
+        metrics.count('downloaded')
+        return r.content
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key: str = hashlib.sha1(url.encode()).hexdigest()
+    body_file: str = os.path.join(cache_dir, key+".html")
+    meta_file: str = os.path.join(cache_dir, key+".json")
+    meta: dict = dict()
+    if os.path.exists(body_file) and os.path.exists(meta_file):
+        with open(meta_file, "r") as file:
+            meta = json.load(file)
+        if time.time() - meta['time'] < ttl:
+            metrics.count('cached')
+            with open(body_file, "rb") as file:
+                return file.read()
+
+    # Conditional request, the server only sends the page if it changed
+    headers: dict[str, str] = dict()
+    if 'etag' in meta:
+        headers['If-None-Match'] = meta['etag']
+    if 'last_modified' in meta:
+        headers['If-Modified-Since'] = meta['last_modified']
+    r = session.get(url, headers=headers)
+    if r.status_code == 304:
+        metrics.count('not_modified')
+        with open(body_file, "rb") as file:
+            content: bytes = file.read()
+    else:
+        r.raise_for_status()
+        metrics.count('downloaded')
+        content = r.content
+        with open(body_file, "wb") as file:
+            file.write(content)
+
+    meta = {'url': url, 'time': time.time()}
+    if r.headers.get('ETag'):
+        meta['etag'] = r.headers['ETag']
+    if r.headers.get('Last-Modified'):
+        meta['last_modified'] = r.headers['Last-Modified']
+    with open(meta_file, "w") as file:
+        json.dump(meta, file)
+    return content
+
+
+def fetch_pages(pages: list[int], cache_dir: str | None = CACHE_DIR, ttl: int = CACHE_TTL) -> dict[int, bytes]:
+    '''Downloads each page once, concurrently and sharing the connections of one session.
+    Returns a dictionary with the page number as key and its html as value'''
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=len(pages))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            return dict(zip(pages, executor.map(lambda page: _fetch_page_span(session, SENSACINE_URL+str(page), cache_dir, ttl), pages)))
+
+
+def _fetch_page_span(session: requests.Session, url: str, cache_dir: str | None, ttl: int) -> bytes:
+    '''fetch_page measured as a span of its own (it runs in the threads of fetch_pages)'''
+    with metrics.span('billboard.fetch_page', url=url):
+        return fetch_page(session, url, cache_dir, ttl)
+
+
+# XPath equivalents of the CSS selectors div.item_resa, div.j_w, a.j_entities and span.lighten
+_ITEM_RESA = "//div[contains(concat(' ', normalize-space(@class), ' '), ' item_resa ')]"
+_J_W = ".//div[contains(concat(' ', normalize-space(@class), ' '), ' j_w ')]"
+_J_ENTITIES = "//a[contains(concat(' ', normalize-space(@class), ' '), ' j_entities ')]"
+_LIGHTEN = "//span[contains(concat(' ', normalize-space(@class), ' '), ' lighten ')]"
+
+
+def extract_page(content: bytes) -> list[Showing]:
+    '''Parses a page with lxml and returns, in one pass, the flat records of all its item_resa blocks'''
+    tree = html.fromstring(content)
+
+    # The address of the i-th cinema of the page is the text of the (2i+1)-th span with class lighten
+    span_address = tree.xpath(_LIGHTEN)
+    theatre_address: dict[str, str] = dict()
+    for i, cinema in enumerate(tree.xpath(_J_ENTITIES)):
+        cinema_id: str = json.loads(cinema.get("data-entities"))["entityId"]
+        theatre_address[cinema_id] = span_address[2*i+1].text_content().strip()
+
+    showings: list[Showing] = list()
+    for item in tree.xpath(_ITEM_RESA):
+        jw_div = item.xpath(_J_W)[0]
+        theater = json.loads(jw_div.get('data-theater'))
+        # the language appears in the text or the attributes of the j_w block or of any element inside it
+        original: bool = "Original" in jw_div.text_content() or any(
+            "Original" in value for element in jw_div.iter() for value in element.attrib.values())
+        showings.append(Showing(
+            movie=json.loads(jw_div.get('data-movie')),
+            theater=theater,
+            address=theatre_address.get(theater['id'], ''),
+            language="Original" if original else "Doblada",
+            times=[json.loads(em.get('data-times'))[0]
+                   for em in item.iter('em') if em.get('data-times') is not None]
+        ))
+    return showings
+
+
+def extract_pages(pages: list[int]) -> dict[int, list[Showing]]:
+    '''Fetches and extracts the given pages, returns the records of each page'''
+    return {page: extract_page(content) for page, content in fetch_pages(pages).items()}
+
+
+def get_cinemas(showings: dict[int, list[Showing]] | None = None) -> dict[str, Cinema]:
     '''This method returns a dictionary with all the cinemas in
-    Barcelona where the key is a cinema name and the value is its data'''
+    Barcelona where the key is a cinema name and the value is its data.
+    showings are the records of the pages (as returned by extract_pages), they are fetched if not given'''
 
     cinema_dict: dict[str, Cinema] = dict()
-    # Contains the street where a certain theatre is located
-    theatre_address: dict[str, str] = dict()
-
-    for i in range(1, 3):
-
-        urlToScrape: str = "https://www.sensacine.com/cines/cines-en-72480/?page=" + \
-            str(i)
-        r = requests.get(urlToScrape)
-        soup = BeautifulSoup(r.content, "html.parser")
-        item_resa_elements = soup.find_all("div", class_="item_resa")
-
-        cinema_info = soup.find_all('a', class_='j_entities')
-        span_address = soup.find_all('span', class_='lighten')
-
-        for i, cinema in enumerate(cinema_info):
-            # this retrieves the adress of each theatre
-            cinema_id: str = json.loads(cinema["data-entities"])["entityId"]
-            theatre_address[cinema_id] = span_address[2 *
-                                                      i+1].get_text(strip=True)
+    if showings is None:
+        showings = extract_pages(CINEMA_PAGES)
 
-        for item in item_resa_elements:
-            jw_div = item.find('div', class_='j_w')
-            data_theater = json.loads(jw_div['data-theater'])
-            if not data_theater['name'] in cinema_dict:
-                NewCinema: Cinema = Cinema(
-                    data_theater['name'], theatre_address[data_theater['id']], cinemas_location[data_theater['name']])
-                cinema_dict[data_theater['name']] = NewCinema
+    for page in CINEMA_PAGES:
+        for showing in showings[page]:
+            name: str = showing.theater['name']
+            if not name in cinema_dict:
+                cinema_dict[name] = Cinema(
+                    name, showing.address, cinemas_location[name])
 
     return cinema_dict
 
 
-def get_films() -> dict[str, Film]:
+def get_films(showings: dict[int, list[Showing]] | None = None) -> dict[str, Film]:
     '''This method returns a dictionary with all the films in cinemas of
-    Barcelona where the key is the film name and the value is its data'''
+    Barcelona where the key is the film name and the value is its data.
+    showings are the records of the pages (as returned by extract_pages), they are fetched if not given'''
 
     film_dict = dict()
+    if showings is None:
+        showings = extract_pages(FILM_PAGES)
 
-    for i in range(1, 4):
-
-        urlToScrape = "https://www.sensacine.com/cines/cines-en-72480/?page=" + \
-            str(i)
-        r = requests.get(urlToScrape)
-        soup = BeautifulSoup(r.content, "html.parser")
-        item_resa_elements = soup.find_all("div", class_="item_resa")
-
-        for item in item_resa_elements:
-            jw_div = item.find('div', class_='j_w')
-            data_movie = json.loads(jw_div['data-movie'])
+    for page in FILM_PAGES:
+        for showing in showings[page]:
+            data_movie = showing.movie
             if not data_movie['id'] in film_dict:
                 NewFilm: Film = Film(data_movie['title'], data_movie['genre'],
                                      data_movie['directors'], data_movie['actors'], data_movie['poster'])
@@ -145,59 +257,43 @@ def get_films() -> dict[str, Film]:
     return film_dict
 
 
+@metrics.timed('billboard.read')
 def read() -> Billboard:
     '''Returns the billboard of Barcelona cinema's.
     First it retrieves the html blocks of sensacine.com, which are those delimited by the divs with class item_resa.
     Each block of this type contains a film, the cinema where it's showed and the schedule.
-    We retrieve for each block the id of the movie and the name of the cinema in the sublock delimited by div with class j_w.
+    Every page is extracted only once into flat records (Showing) that are shared to get the cinemas, films and projections.
     Finally, we load the film information to a dictionary with the cinema and the schedule. To avoid repeated films in repeated
     cinemas we add the tuple (movie_id,theatre_name) to a set, and we use the set movie_info to store its information and avoid
     saving multiple times the same film.'''
 
+    # Every page is downloaded and extracted only once and shared by all the steps
+    showings: dict[int, list[Showing]] = extract_pages(
+        sorted(set(CINEMA_PAGES+FILM_PAGES)))
     # Contains all the different cinemas in Barcelona
-    bcn_cinemas: dict[str, Cinema] = get_cinemas()
+    bcn_cinemas: dict[str, Cinema] = get_cinemas(showings)
     # Contains all the different films in Barcelona
-    bcn_films: dict[str, Film] = get_films()
+    bcn_films: dict[str, Film] = get_films(showings)
     # Contains pairs of (movie id, cinema name) to avoid duplicated movies in the same cinema
     processed_films: set[tuple[str, str]] = set()
     # given a film id, it contains its data
     film_info: dict[str, Film_data] = dict()
 
-    for i in range(1, 3):
-
-        urlToScrape = "https://www.sensacine.com/cines/cines-en-72480/?page=" + \
-            str(i)
-        r = requests.get(urlToScrape)
-        soup = BeautifulSoup(r.content, "html.parser")
-        # The information of films and theaters is in this class
-        item_resa_elements = soup.find_all("div", class_="item_resa")
-
-        for item in item_resa_elements:
-            # Each item contains a certain film in a certain cinema with its schedule
-
-            jw_div = item.find('div', class_='j_w')
-
-            theatre_name = json.loads(jw_div['data-theater'])['name']
-            movie_id = json.loads(jw_div['data-movie'])['id']
+    for page in CINEMA_PAGES:
+        # Each showing contains a certain film in a certain cinema with its schedule
+        for showing in showings[page]:
+            theatre_name = showing.theater['name']
+            movie_id = showing.movie['id']
 
             # we check if we have processed a certain movie in a certain cinema
             if not (movie_id, theatre_name) in processed_films:
                 processed_films.add((movie_id, theatre_name))
                 if not movie_id in film_info:
                     film_info[movie_id] = Film_data()
-                else:
-                    # We add the cinema in the list of cinemas where the film belongs
-                    film_info[movie_id].theatres_names.append(theatre_name)
-                    film_info[movie_id].original_version.append("Original" if "Original" in str(
-                        jw_div) else "Doblada")  # retrieve the language of the movie
-
-                    # We retrieve all the following times where the film is showed in a particular cinema
-                    data_times: list[str] = list()
-                    for time in item.find_all('em'):
-                        item_times = json.loads(time['data-times'])
-                        data_times.append(item_times)
-
-                    film_info[movie_id].times.append(data_times)
+                # We add the cinema in the list of cinemas where the film belongs, its language and schedule
+                film_info[movie_id].theatres_names.append(theatre_name)
+                film_info[movie_id].original_version.append(showing.language)
+                film_info[movie_id].times.append(showing.times)
 
     films_list: list[Film] = [film for film in bcn_films.values()]
     theater_list: list[Cinema] = [cinema for cinema in bcn_cinemas.values()]
@@ -211,8 +307,9 @@ def read() -> Billboard:
             # for each cinema we iterate over the schedule in that cinema
             for curr_time in film_info[id].times[i]:
                 projection_list.append(Projection(film=movie, cinema=bcn_cinemas[film_info[id].theatres_names[i]], time=(
-                    int(curr_time[0][0:2]), int(curr_time[0][3:5])), language=film_info[id].original_version[i]))
+                    int(curr_time[0:2]), int(curr_time[3:5])), language=film_info[id].original_version[i]))
 
+    metrics.count('projections', len(projection_list))
     return Billboard(films=films_list, cinemas=theater_list, projections=projection_list)
 
 
@@ -221,6 +318,83 @@ def get_time_in_seconds(time: tuple[int, int]) -> int:
     return int(time[0])*3600+int(time[1])*60
 
 
-def sort_projections_by_start_time(t: int, billboard: Billboard) -> list[Projection]:
-    '''Given a start time in format seconds it sorts the billboard according to time difference between the given time'''
-    return sorted((projection for projection in billboard.projections if get_time_in_seconds(projection.time) >= t), key=lambda x: abs(get_time_in_seconds(x.time) - t))
+def projection_key(projection: Projection) -> tuple[str, str, tuple[int, int], str]:
+    '''Hashable identity of a projection: (film title, cinema name, time, language)'''
+    return (projection.film.title, projection.cinema.name, projection.time, projection.language)
+
+
+class ProjectionIndex:
+    '''Projections of a billboard grouped by (film title, language). The projections of each group are kept
+    sorted by start time in two parallel lists (start in seconds and projection), so the next showings
+    after a time are found with a bisect instead of filtering and sorting the whole billboard'''
+
+    _starts: dict[tuple[str, str], list[int]]
+    _projections: dict[tuple[str, str], list[Projection]]
+    _keys: set[tuple[str, str, tuple[int, int], str]]
+
+    def __init__(self, billboard: Billboard | None = None) -> None:
+        self._starts = dict()
+        self._projections = dict()
+        self._keys = set()
+        if billboard is not None:
+            for projection in billboard.projections:
+                self.add(projection)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, projection: Projection) -> bool:
+        '''Adds a projection to its group keeping the order, returns False if it was already in the index'''
+        key = projection_key(projection)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        group = (projection.film.title, projection.language)
+        starts = self._starts.setdefault(group, list())
+        # after the projections that start at the same time, as a stable sort would do
+        i = bisect.bisect_right(starts, get_time_in_seconds(projection.time))
+        starts.insert(i, get_time_in_seconds(projection.time))
+        self._projections.setdefault(group, list()).insert(i, projection)
+        return True
+
+    def remove(self, projection: Projection) -> bool:
+        '''Removes a projection from the index, returns False if it was not in it'''
+        key = projection_key(projection)
+        if not key in self._keys:
+            return False
+        self._keys.remove(key)
+        group = (projection.film.title, projection.language)
+        starts, projections = self._starts[group], self._projections[group]
+        # only the projections starting at the same second have to be checked
+        start = get_time_in_seconds(projection.time)
+        i = bisect.bisect_left(starts, start)
+        while projection_key(projections[i]) != key:
+            i += 1
+        del starts[i]
+        del projections[i]
+        if not starts:
+            del self._starts[group]
+            del self._projections[group]
+        return True
+
+    def update(self, billboard: Billboard) -> tuple[int, int]:
+        '''Updates the index to the projections of a refreshed billboard. Only the showings that were added or
+        removed are touched. Returns the number of projections (added, removed)'''
+        new: dict[tuple[str, str, tuple[int, int], str], Projection] = {
+            projection_key(projection): projection for projection in billboard.projections}
+        removed = [projection for projections in self._projections.values()
+                   for projection in projections if not projection_key(projection) in new]
+        for projection in removed:
+            self.remove(projection)
+        added = sum(self.add(projection) for key, projection in new.items()
+                    if not key in self._keys)
+        return added, len(removed)
+
+    def next_showings(self, title: str, language: str, t: int, n: int | None = None) -> list[Projection]:
+        '''Returns the next n (all if n is None) projections of the film with the given title and language
+        that start at t (in seconds) or later, ordered by start time'''
+        group = (title, language)
+        if not group in self._starts:
+            return []
+        i = bisect.bisect_left(self._starts[group], t)
+        return self._projections[group][i:] if n is None else self._projections[group][i:i+n]
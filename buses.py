@@ -1,10 +1,14 @@
 from dataclasses import dataclass
-from typing import TypeAlias, Any
-from haversine import haversine
+from typing import TypeAlias, Any, Iterator
+from haversine import haversine, haversine_vector
 from PIL import Image
-import staticmap as stm
+import render
+import metrics
 import networkx as nx
 import json
+import os
+import hashlib
+import numpy as np
 import matplotlib.pyplot as plt
 
 
@@ -12,7 +16,13 @@ BusesGraph: TypeAlias = nx.DiGraph
 Coord: TypeAlias = tuple[float, float]  # (longitud, latitud)
 
 
-@dataclass
+NETWORK_FORMAT: int = 2  # version of the arrays saved by save_network
+# arrays that hold all the information of a NetworkBus
+NETWORK_ARRAYS: list[str] = ['line_ids', 'line_names', 'line_colors', 'route_offsets', 'route_coords', 'stop_offsets',
+                             'stop_codes', 'stop_names', 'stop_poblacio', 'stop_pos', 'stop_dist']
+
+
+@dataclass(slots=True)
 class Stop:
     """ Dataclass representing a bus stop"""
     code: str  # id used to identify the bus stop, unique to each route
@@ -23,77 +33,143 @@ class Stop:
 
 
 class BusLine:
-    """ Class representing a bus line for each direction (circle lines are divided) """
-    _id: int  # id of the bus line (diferent for each direction)
-    _name: str  # name of
-    _color: str  # color of the bus line
-    _busStops: list[Stop]  # list containing all the bus stops in order
-    _busRoute: list[Coord]  # path de busline takes
-
-    def __init__(self, Id: int, Nom: str, Color: str) -> None:
-        """ constructor for the BusLine class. Sets the stops and route as empty lists """
-        self._id = Id
-        self._name = Nom
-        self._color = Color
-
-        self._busStops = list()
-        self._busRoute = list()
+    """ Class representing a bus line for each direction (circle lines are divided).
+        It is only a view of the line number index of a NetworkBus, all the data is in the arrays of the network """
+    __slots__ = ('_network', '_index')
+    _network: 'NetworkBus'  # network that holds the data
+    _index: int  # position of the line in the arrays of the network
+
+    def __init__(self, network: 'NetworkBus', index: int) -> None:
+        """ constructor for the BusLine class """
+        self._network = network
+        self._index = index
 
     ######################## GETTERS ################################
     def id(self) -> int:
-        return self._id
+        return int(self._network._arrays['line_ids'][self._index])
 
     def name(self) -> str:
-        return self._name
+        return str(self._network._arrays['line_names'][self._index])
 
     def color(self) -> str:
-        return self._color
-
-    def stops(self) -> list[Stop]:
-        return self._busStops
+        return str(self._network._arrays['line_colors'][self._index])
 
-    def route(self) -> list[Coord]:
-        return self._busRoute
+    def stop_range(self) -> range:
+        """ Returns the range of the (integer) ids of the stops of the line in the network arrays """
+        offsets = self._network._arrays['stop_offsets']
+        return range(int(offsets[self._index]), int(offsets[self._index+1]))
 
-    ######################## FUNCTIONS ################################
-    def addStop(self, stop: Stop) -> None:
-        """" Given a list of stops, sets the stops of the bus lin to it """
-        self._busStops.append(stop)
+    def stops(self) -> list[Stop]:
+        """ Returns the stops in order, the Stop objects are created when asked """
+        return [self._network.stop(i) for i in self.stop_range()]
 
-    def setRoute(self, route: list[Coord]) -> None:
-        """" Given a list of coordinates, sets the route of the bus line to it """
-        self._busRoute = route
+    def route(self) -> np.ndarray:
+        """ Returns the path the busline takes as an array (n, 2) of (longitud, latitud), a view of the shared array of the network """
+        offsets = self._network._arrays['route_offsets']
+        return self._network._arrays['route_coords'][offsets[self._index]:offsets[self._index+1]]
 
 
 class NetworkBus:
-    """ Class to represent the set of bus lines"""
-    _busLines: dict[int, BusLine]  # id of the bus line -> BusLine
-    _dupeStops: dict[int, list[str]]
-
-    def __init__(self) -> None:
-        """ Constructor of the class creates an empty dictionary """
-        self._busLines = dict()
-        self._dupeStops = dict()
+    """ Class to represent the set of bus lines as a struct of arrays: every stop is an integer id (its row in the stop arrays),
+        the stops and route of each line are a range given by offsets and all routes share one array of coordinates """
+    _arrays: dict[str, np.ndarray]  # name in NETWORK_ARRAYS -> array
+    _lineIndex: dict[int, int]  # id of the bus line -> index of the line in the arrays
+    # lines and stops added but not yet in the arrays: id of the line -> (name, color, route, list of stops)
+    _pending: dict[int, tuple[str, str, list[Coord], list[tuple[int, str, str, Coord, float]]]]
+
+    def __init__(self, arrays: dict[str, np.ndarray] | None = None) -> None:
+        """ Constructor of the class, creates an empty network or one with the given arrays """
+        if arrays is None:
+            arrays = {'line_ids': np.zeros(0, dtype=np.int64), 'line_names': np.zeros(0, dtype=str), 'line_colors': np.zeros(0, dtype=str),
+                      'route_offsets': np.zeros(1, dtype=np.int64), 'route_coords': np.zeros((0, 2)),
+                      'stop_offsets': np.zeros(1, dtype=np.int64), 'stop_codes': np.zeros(0, dtype=np.int64),
+                      'stop_names': np.zeros(0, dtype=str), 'stop_poblacio': np.zeros(0, dtype=str),
+                      'stop_pos': np.zeros((0, 2)), 'stop_dist': np.zeros(0)}
+        self._arrays = arrays
+        self._lineIndex = {id: i for i, id in enumerate(
+            arrays['line_ids'].tolist())}
+        self._pending = dict()
 
     ######################## GETTERS ################################
+    def arrays(self) -> dict[str, np.ndarray]:
+        self._compact()
+        return self._arrays
+
     def busLines(self) -> dict[int, BusLine]:
-        return self._busLines
+        self._compact()
+        return {id: BusLine(self, i) for id, i in self._lineIndex.items()}
 
     def dupeStops(self) -> dict[int, list[str]]:
-        return self._dupeStops
+        """ Returns, for each stop code, the codes of the stop in every line it appears """
+        self._compact()
+        dupes: dict[int, list[str]] = dict()
+        for i in range(len(self._arrays['stop_codes'])):
+            dupes.setdefault(int(self._arrays['stop_codes'][i]), list()).append(
+                self.stop_code(i))
+        return dupes
+
+    def stop_code(self, i: int) -> str:
+        """ Returns the code (stop code-id of the line) of the stop with integer id i """
+        line = int(np.searchsorted(
+            self._arrays['stop_offsets'], i, side='right'))-1
+        return str(self._arrays['stop_codes'][i])+"-"+str(self._arrays['line_ids'][line])
+
+    def stop(self, i: int) -> Stop:
+        """ Returns the Stop with integer id i """
+        self._compact()
+        dist_prev = float(self._arrays['stop_dist'][i])
+        return Stop(self.stop_code(i), str(self._arrays['stop_names'][i]), str(self._arrays['stop_poblacio'][i]),
+                    (float(self._arrays['stop_pos'][i, 0]), float(self._arrays['stop_pos'][i, 1])), None if np.isnan(dist_prev) else dist_prev)
 
     ######################## FUNCTIONS ################################
-    def addBusLine(self, line: BusLine) -> None:
-        """ Adds a bus line to the dicctionary (if added previouslly asserts pops up) """
-        assert line.id() not in self._busLines, str(
-            line.id())+' already added'  # error message
-        self.busLines()[line.id()] = line
+    def addBusLine(self, id: int, name: str, color: str, route: list[Coord]) -> None:
+        """ Adds a bus line to the network (if added previouslly asserts pops up) """
+        assert id not in self._lineIndex and id not in self._pending, str(
+            id)+' already added'  # error message
+        self._pending[id] = (name, color, route, list())
+
+    def addStop(self, id_route: int, code: int, name: str, poblacio: str, pos: Coord, dist_prev: float | None) -> None:
+        """ Adds a stop at the end of the stops of the bus line id_route (only for lines added since the last time the arrays were used) """
+        assert id_route in self._pending, str(
+            id_route)+' not in network'  # error message
+        self._pending[id_route][3].append(
+            (code, name, poblacio, pos, np.nan if dist_prev is None else dist_prev))
 
     def getBusLine(self, id_route: int) -> BusLine:
         """ Given the id of a bus line, returns that busline if it is in network """
-        assert id_route in self.busLines(), str(
+        self._compact()
+        assert id_route in self._lineIndex, str(
             id_route)+' not in network'  # error message
-        return self.busLines()[id_route]
+        return BusLine(self, self._lineIndex[id_route])
+
+    def _compact(self) -> None:
+        """ Moves the lines and stops added since last time to the arrays """
+        if not self._pending:
+            return
+        ids: list[int] = list(self._pending)
+        lines = list(self._pending.values())
+        stops = [stop for line in lines for stop in line[3]]
+        new: dict[str, np.ndarray] = {
+            'line_ids': np.array(ids, dtype=np.int64),
+            'line_names': np.array([line[0] for line in lines], dtype=str),
+            'line_colors': np.array([line[1] for line in lines], dtype=str),
+            'route_offsets': np.cumsum([len(line[2]) for line in lines], dtype=np.int64),
+            'route_coords': np.array([p for line in lines for p in line[2]], dtype=np.float64).reshape(-1, 2),
+            'stop_offsets': np.cumsum([len(line[3]) for line in lines], dtype=np.int64),
+            'stop_codes': np.array([stop[0] for stop in stops], dtype=np.int64),
+            'stop_names': np.array([stop[1] for stop in stops], dtype=str),
+            'stop_poblacio': np.array([stop[2] for stop in stops], dtype=str),
+            'stop_pos': np.array([stop[3] for stop in stops], dtype=np.float64).reshape(-1, 2),
+            'stop_dist': np.array([stop[4] for stop in stops], dtype=np.float64),
+        }
+        # offsets of the new lines continue after the ones already in the arrays
+        for name in ('route_offsets', 'stop_offsets'):
+            new[name] = new[name] + self._arrays[name][-1]
+        self._arrays = {name: np.concatenate([self._arrays[name], new[name]])
+                        for name in NETWORK_ARRAYS}
+        self._lineIndex = {id: i for i, id in enumerate(
+            self._arrays['line_ids'].tolist())}
+        self._pending = dict()
 
 
 def dist(x: Coord, y: Coord) -> float:  # lon, lat
@@ -101,6 +177,11 @@ def dist(x: Coord, y: Coord) -> float:  # lon, lat
     return haversine((x[1], x[0]), (y[1], y[0]), unit='m')  # we flip them because harversine function uses invers (lat, lon)
 
 
+def dist_array(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ Same as dist but for two arrays of points (n, 2) in (longitud, latitud), returns the n distances in meters """
+    return haversine_vector(x[:, ::-1], y[:, ::-1], unit='m')
+
+
 def brighter_color(hex_color):
     # Convert the hexadecimal color to RGB
     r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
@@ -114,53 +195,60 @@ def brighter_color(hex_color):
     return '{:02x}{:02x}{:02x}'.format(r, g, b)
 
 
-def create_network_base() -> NetworkBus:
-    """ Creates the template for the NetworkBus class. aka creates all the buslines extracted form json but with no information """
-    # We open the file and read it
-    with open("busRoutes.json", "r") as file:
-        json_data: str = file.read()
-    TMBdata = json.loads(json_data)
-
+def iter_features(json_file: str, chunk_size: int = 1 << 16) -> Iterator[dict[str, Any]]:
+    """ Yields one by one the features of a GeoJSON file without loading the whole document.
+        The file is read by chunks and each feature is decoded as soon as it is complete, so memory stays bounded by one feature """
+    decoder = json.JSONDecoder()
+    with open(json_file, "r", encoding="utf-8") as file:
+        # Skip everything until the start of the features array
+        buffer: str = ""
+        while True:
+            key = buffer.find('"features"')
+            start = buffer.find('[', key) if key >= 0 else -1
+            if start >= 0:
+                buffer = buffer[start+1:]
+                break
+            chunk = file.read(chunk_size)
+            assert chunk, json_file+' has no features'
+            # once the key is found everything after it is kept until the '[' arrives (there can be any whitespace in between),
+            # before that only the end, in case "features" is split between two chunks
+            buffer = (buffer[key:] if key >= 0 else buffer[-len('"features"'):])+chunk
+
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer.startswith(']'):
+                return  # end of the features array
+            try:
+                feature, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # the feature is not complete yet, read more (at least as much as we have so long features do not decode too many times)
+                chunk = file.read(max(chunk_size, len(buffer)))
+                assert chunk, json_file+' ended in the middle of a feature'
+                buffer += chunk
+                continue
+            yield feature
+            buffer = buffer[end:]
+
+
+def get_lines_json(json_file: str, network: NetworkBus) -> NetworkBus:
+    """ Adds all the bus lines of the routes json file, with their route (list[Coord]), to the NetworkBus passed by reference. Only one pass over the file """
     # Iterating through each route and getting all information needed to inicialize the route, we add it to the NetworkBus class
-    network = NetworkBus()
-    for route in TMBdata['features']:  # Iterating over routes in json file
-        id: int = route['properties']['ID_RECORREGUT']
+    for route in iter_features(json_file):
+        id: int = int(route['properties']['ID_RECORREGUT'])
         name: str = route['properties']['NOM_LINIA'] + ' - ' + \
             route['properties']['DESC_PAQUET'] + \
             ' ('+route['properties']['DESC_SENTIT']+")"
         color: str = route['properties']['COLOR_REC']
-        NewLine = BusLine(id, name, color)  # Create new busline
-        network.addBusLine(NewLine)
-
-    return network
-
-
-def get_route_json(json_file: str, network: NetworkBus) -> NetworkBus:
-    """ Adds the information (list[Coord]) of the route of each BusLine to the NetworkBus passed by reference """
-    # We open the file and read it
-    with open(json_file, "r") as file:
-        json_data: str = file.read()
-    TMBdata = json.loads(json_data)
-
-    # Iterating through we get the list of coordinates indicating the path the busline takes and adding them to the coorrespoinding bus line
-    for route in TMBdata['features']:  # iterating over routes in json file
-        id: int = int(route['properties']['ID_RECORREGUT'])
-        # We do this to avoid type errors
-        path: list[Coord] = route['geometry']['coordinates'][0]
-        network.getBusLine(id).setRoute(path)
+        # Create new busline with the list of coordinates indicating the path it takes
+        network.addBusLine(id, name, color, route['geometry']['coordinates'][0])
 
     return network
 
 
 def get_stops_json(json_file: str, network: NetworkBus) -> NetworkBus:
     """ Adds the information of all the stops in each bus line to the NetworkBus passed by reference """
-    # We open the file and read it
-    with open(json_file, "r") as file:
-        json_data: str = file.read()
-    TMBdata = json.loads(json_data)
-
     # We iterate through the stops getting all the information we need to inicialize them. Then add them to the corresponding bus line
-    for stop in TMBdata['features']:
+    for stop in iter_features(json_file):
         # id of the busroute to which the stop belongs
         id: int = stop['properties']['ID_RECORREGUT']
         # We fetch all information we need to create stop
@@ -170,94 +258,227 @@ def get_stops_json(json_file: str, network: NetworkBus) -> NetworkBus:
         pos: Coord = (stop['geometry']['coordinates'])
         dist_prev: float = stop['properties']['DISTANCIA_PAR_ANTERIOR']
 
-        if code in network.dupeStops():
-            network.dupeStops()[code].append(str(code)+"-"+str(id))
-        else:
-            network.dupeStops()[code] = [str(code)+"-"+str(id)]
-        NewStop = Stop(str(code)+"-"+str(id), name, poblacio, pos, dist_prev)
-        # bus stops all apear in oreder
-        network.getBusLine(id).addStop(NewStop)
+        # bus stops all apear in oreder (its code will be code-id)
+        network.addStop(id, code, name, poblacio, pos, dist_prev)
 
     return network
 
 
-def create_Bus_Network() -> NetworkBus:
-    """ Returns the bus network of Barcelona"""
-    network = create_network_base()
-    network = get_route_json("busRoutes.json", network)
+def _json_sources(json_files: list[str]) -> str:
+    """ Returns a description (name, size and modification time) of the json files, used to know if a preprocessed network is outdated """
+    return ';'.join(f"{name}:{os.path.getsize(name)}:{os.path.getmtime(name)}" for name in json_files)
+
+
+def save_network(network: NetworkBus, filename: str, sources: str = "") -> None:
+    """ Saves the arrays of the network (numpy .npz, no pickle) so it can be loaded without parsing the json files """
+    np.savez(filename, format=np.array(NETWORK_FORMAT),
+             sources=np.array(sources), **network.arrays())
+
+
+def load_network(filename: str, sources: str | None = None) -> NetworkBus | None:
+    """ Loads the network saved with save_network. If sources is given and it is not the one it was saved with (or the format changed), returns None """
+    with np.load(filename, allow_pickle=False) as data:
+        if 'format' not in data.files or int(data['format']) != NETWORK_FORMAT:
+            return None
+        if sources is not None and str(data['sources']) != sources:
+            return None
+        return NetworkBus({name: data[name] for name in NETWORK_ARRAYS})
+
+
+@metrics.timed('buses.create_Bus_Network')
+def create_Bus_Network(preprocessed: str | None = None) -> NetworkBus:
+    """ Returns the bus network of Barcelona. If preprocessed is a filename, the network is loaded from it when it is up to date with the json files, otherwise it is parsed and saved there """
+    json_files: list[str] = ["busRoutes.json", "busStops.json"]
+    if preprocessed is not None and os.path.exists(preprocessed):
+        loaded = load_network(preprocessed, _json_sources(json_files))
+        if loaded is not None:
+            metrics.count('preprocessed')
+            return loaded
+
+    network = NetworkBus()
+    network = get_lines_json("busRoutes.json", network)
     network = get_stops_json("busStops.json", network)
+    if preprocessed is not None:
+        save_network(network, preprocessed, _json_sources(json_files))
+    metrics.count('lines', len(network.arrays()['line_ids']))
+    metrics.count('stops', len(network.arrays()['stop_codes']))
     return network
 
 
-def route_between_stops(idx: int, trgt_dist: float, route: list[Coord]) -> tuple[int, list[Coord]]:
-    """ Returns the index and list of coordinates coresponding to the path between stops """
-    distance: float = 0  # acumulated distance
-    # we know idx is in between src, dst so we add it
-    route_between: list[Coord] = [route[idx]]
-    # If we are not out of range and adding the new point does not exceed the target distance we can add it to the route
-    while idx < len(route)-1 and distance+dist(route[idx], route[idx+1]) <= trgt_dist:
-        distance += dist(route[idx], route[idx+1])  # using harversines
-        route_between.append(route[idx+1])
-        idx += 1
-    # we whant to return the index to the node in front of dst, aka the first one we did not add, so idx+1
-    return idx+1, route_between
+def line_hash(line: BusLine) -> str:
+    """ Returns a hash of everything the bus graph uses of the line (name, color, route and stops), to know if it changed from one network to another """
+    arrays = line._network.arrays()
+    stops = line.stop_range()
+    content = [line.name(), line.color(), line.route().tolist()] + [arrays[name][stops.start:stops.stop].tolist()
+                                                                    for name in ('stop_codes', 'stop_names', 'stop_poblacio', 'stop_pos', 'stop_dist')]
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+
+def line_hashes(network: NetworkBus) -> dict[int, str]:
+    """ Returns the line_hash of every line of the network by its id """
+    return {id: line_hash(busline) for id, busline in network.busLines().items()}
+
+
+def changed_lines(old: dict[int, str], new: dict[int, str]) -> tuple[list[int], list[int]]:
+    """ Compares the line_hashes of two networks. Returns the ids of the lines to remove (not in new or changed) and to add (not in old or changed) """
+    removed: list[int] = [id for id, h in old.items() if new.get(id) != h]
+    added: list[int] = [id for id, h in new.items() if old.get(id) != h]
+    return removed, added
+
+
+def split_route(stops: list[Stop], route: list[Coord] | np.ndarray) -> list[list[Coord]]:
+    """ Returns for each pair of consecutive stops the list of coordinates of the route in between them.
+        The distance along the route is computed once (cumulative) and each cut is found with a binary search """
+    if len(route) == 0:
+        return [list() for _ in stops[1:]]
+    points = np.asarray(route, dtype=np.float64)
+    # cumulative[i] is the distance along the route from route[0] to route[i]
+    cumulative = np.zeros(len(route))
+    np.cumsum(dist_array(points[:-1], points[1:]), out=cumulative[1:])
+
+    parts: list[list[Coord]] = list()
+    index: int = 0
+    # Invariant: route[index] allways in between src and dst stops
+    for src, dst in zip(stops, stops[1:]):
+        # we first substract the distance from src to the bus route to dist_prev to get our target distance
+        trgt_dist: float = dst.dist_prev - dist(src.pos, points[index])
+        # there are no points in route in between src and dst (invariant not true)
+        if trgt_dist <= 0:
+            parts.append(list())
+            continue
+        # last point we can reach without exceeding the target distance (at least route[index])
+        last = int(np.searchsorted(
+            cumulative, cumulative[index]+trgt_dist, side='right'))-1
+        parts.append(points[index:last+1].tolist())
+        # the next index is the first point we did not add
+        index = last+1
 
+    return parts
 
+
+@dataclass
+class LineInfo:
+    """ Elements of one bus line in the bus graph (to use them without going through the whole graph) and its statistics """
+    id: str  # id of the line (ID_RECORREGUT), the part after "-" of the code of its stops
+    name: str  # name of the line (V15, D20...)
+    nodes: list[str]  # codes of its stops in order (without repeating them)
+    edges: list[tuple[str, str]]  # edges between its consecutive stops
+    bbox: tuple[float, float, float, float]  # (min lon, min lat, max lon, max lat) of its routes
+    length: float  # meters along its routes
+
+    def number_of_stops(self) -> int:
+        return len(self.nodes)
+
+    def extent(self) -> tuple[float, float]:
+        """ Returns the width and height in meters of the bounding box """
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return dist((min_lon, min_lat), (max_lon, min_lat)), dist((min_lon, min_lat), (min_lon, max_lat))
+
+
+def _line_info(g: BusesGraph, id: str, name: str, nodes: list[str], edges: list[tuple[str, str]]) -> LineInfo:
+    """ Returns the LineInfo of the line with the given nodes and edges of g """
+    points = np.array([(g.nodes[node]['x'], g.nodes[node]['y']) for node in nodes] +
+                      [p for u, v in edges for p in g[u][v]['route']], dtype=np.float64)
+    routes = [np.asarray(g[u][v]['route'], dtype=np.float64) for u, v in edges]
+    length: float = sum(float(dist_array(route[:-1], route[1:]).sum())
+                        for route in routes if len(route) > 1)
+    return LineInfo(id, name, nodes, edges, (float(points[:, 0].min()), float(points[:, 1].min()), float(points[:, 0].max()), float(points[:, 1].max())), length)
+
+
+def line_index(g: BusesGraph) -> dict[str, LineInfo]:
+    """ Returns the index of the lines of the graph: id of the line -> LineInfo. Graphs made by get_buses_from_network already have it,
+        for any other it is built (going through the graph once) the first time and kept with the graph """
+    if 'lines' not in g.graph:
+        nodes: dict[str, list[str]] = dict()
+        edges: dict[str, list[tuple[str, str]]] = dict()
+        for node in g.nodes:
+            nodes.setdefault(node.split("-")[1], list()).append(node)
+        for u, v in g.edges:
+            if u.split("-")[1] == v.split("-")[1]:
+                edges.setdefault(u.split("-")[1], list()).append((u, v))
+        g.graph['lines'] = {id: _line_info(g, id, id, line_nodes, edges.get(id, list()))
+                            for id, line_nodes in nodes.items()}
+    return g.graph['lines']
+
+
+def _add_line(graph: BusesGraph, busline: BusLine) -> LineInfo:
+    """ Adds the stops and the edges of the bus line to the graph, returns its LineInfo """
+    stops: list[Stop] = busline.stops()
+    color: str = "#"+brighter_color(busline.color())
+    # Iterate through the stops in each bus line we add them as nodes
+    for s in stops:
+        graph.add_node(
+            s.code,  # We use code atribute to idintefy each stop
+            name=s.name,  # Name of the stop
+            poblacio=s.poblacio,  # poblacio of the stop
+            x=s.pos[0], y=s.pos[1],  # Postionion of the stop (lon lat)
+            color=color  # Color coresponding to bus line
+        )
+
+    # Let us obtain what part of the route stored in the busline is in between each pair of stops
+    # Remember: dst.dist_prev indicates the distance from src->dst using the busRoute (aprox)
+    parts: list[list[Coord]] = split_route(stops, busline.route())
+    # Iterating through each pair of stops we add the edge with all its necessary information
+    for src, dst, route_between in zip(stops, stops[1:], parts):
+        # We add the eddge with all of its information
+        graph.add_edge(
+            src.code, dst.code,  # start and end id of nodes
+            # Path it takes to go from stops
+            route=[src.pos]+route_between+[dst.pos],
+            # Aproximation of time it takes (we assume average speed 30km/h)
+            length=dst.dist_prev/8.33,
+            color=color  # Color corresponding to the bus line
+        )
+
+    # The elements of the line are kept so it does not have to be searched in the whole graph
+    return _line_info(graph, str(busline.id()), busline.name(), list(dict.fromkeys(s.code for s in stops)),
+                      list(dict.fromkeys((src.code, dst.code) for src, dst in zip(stops, stops[1:]))))
+
+
+@metrics.timed('buses.get_buses_from_network')
 def get_buses_from_network(network: NetworkBus) -> BusesGraph:
     """ Given a bus network returns the corresponding directed graph (using networkx) """
     # Initialize the directed graph
     graph = BusesGraph()
+    lines: dict[str, LineInfo] = dict()  # index of the lines, see line_index
 
     # Iterate through all buslines we will add the stops and the edges to the directed graph
     for busline in network.busLines().values():
-        # Iterate through the stops in each bus line we add them as nodes
-        for s in busline.stops():
-            graph.add_node(
-                s.code,  # We use code atribute to idintefy each stop
-                name=s.name,  # Name of the stop
-                poblacio=s.poblacio,  # poblacio of the stop
-                x=s.pos[0], y=s.pos[1],  # Postionion of the stop (lon lat)
-                # Color coresponding to bus line
-                color="#"+brighter_color(busline.color())
-            )
-
-        index: int = 0
-        route_between: list[Coord] = list()
-        # Iterating through each pair of stops we add the edge with all its necessary information
-        for src, dst in zip(busline.stops(), busline.stops()[1:]):
-            # Let us obtain what part of the route stored in the busline is in between each stop
-            # Invariant: route[index] allways in between src and dst stops
-            # Remember: dst.dist_prev indicates the distance from src->dst using the busRoute (aprox)
-            # We will be adding the distance travelled on the busline route until going to the next point in route exceeds the target distance
-
-            # we first substract the distance from src to the bus route to dist_prev to get our target distance
-            trgt_dist: float = dst.dist_prev - \
-                dist(src.pos, busline.route()[index])
-            # there are no points in route in between src and dst (invariant not true)
-            if trgt_dist <= 0:
-                route_between = list()
-            else:  # we update our index we currently are at in the route and get the route between stops
-                index, route_between = route_between_stops(
-                    index, trgt_dist, busline.route())
-
-            # We add the eddge with all of its information
-            graph.add_edge(
-                src.code, dst.code,  # start and end id of nodes
-                # Path it takes to go from stops
-                route=[src.pos]+route_between+[dst.pos],
-                # Aproximation of time it takes (we assume average speed 30km/h)
-                length=dst.dist_prev/8.33,
-                # Color corresponding to the bus line
-                color="#"+brighter_color(busline.color())
-            )
+        lines[str(busline.id())] = _add_line(graph, busline)
 
+    graph.graph['lines'] = lines
+    # content of every line, so the graph can be updated when only some of them change (update_buses_graph)
+    graph.graph['hashes'] = line_hashes(network)
+    metrics.count('nodes', graph.number_of_nodes())
+    metrics.count('edges', graph.number_of_edges())
     return graph
 
 
-def get_buses_graph() -> BusesGraph:
-    """ Returns the directed graph representing the busses of Barcelona """
+@metrics.timed('buses.update_buses_graph')
+def update_buses_graph(g: BusesGraph, network: NetworkBus) -> tuple[list[int], list[int]]:
+    """ Updates in place a graph made by get_buses_from_network with an older network so it is the graph of network: only the lines that changed
+        (changed_lines) are removed and added again, and so are their entries of the line index. Returns the ids of the lines removed and added (a changed line is in both) """
+    assert 'hashes' in g.graph, 'The graph was not made by get_buses_from_network'
+    hashes: dict[int, str] = line_hashes(network)
+    removed, added = changed_lines(g.graph['hashes'], hashes)
+    lines: dict[str, LineInfo] = line_index(g)
+    for id in removed:
+        # the code of a stop ends with the id of its line, so its nodes only belong to it
+        g.remove_nodes_from(lines.pop(str(id)).nodes)
+    for id in added:
+        lines[str(id)] = _add_line(g, network.getBusLine(id))
+    g.graph['hashes'] = hashes
+    # the maps (and their view) are drawn again the next time
+    g.graph.pop('images', None)
+    metrics.count('removed', len(removed))
+    metrics.count('added', len(added))
+    return removed, added
+
+
+def get_buses_graph(preprocessed: str | None = "busNetwork.npz") -> BusesGraph:
+    """ Returns the directed graph representing the busses of Barcelona. The parsed network is kept at preprocessed (None to always parse the json files) """
     network: NetworkBus = create_Bus_Network(
-    )  # We get all the infomation into the NetworkBus class
+        preprocessed)  # We get all the infomation into the NetworkBus class
     return get_buses_from_network(network)
 
 
@@ -272,51 +493,60 @@ def show(g: BusesGraph) -> None:
     plt.show()
 
 
-def plot(g: BusesGraph, nom_fitxer: str) -> None:
-    """ Saves and shows the graph as an image with the background city map in the specified file: nom_fitxer, using staticmaps library """
-    # Create a new map object
-    barcelona = stm.StaticMap(3500, 3500)
-    # Draws all the nodes in the graph using 'x', 'y' information in edge
-    for id, data in g.nodes(data=True):
-        pos: Coord = (data['x'], data['y'])
-        marker = stm.CircleMarker(pos, data['color'], 5)
-        barcelona.add_marker(marker)
+def map_view(g: BusesGraph) -> render.View:
+    """ Returns the view of the maps of the bus graph (all the stops in a MAP_SIZE image). Computed the first time and kept with the graph """
+    images = g.graph.setdefault('images', dict())
+    if 'view' not in images:
+        images['view'] = render.view_of([data['x'] for _, data in g.nodes(data=True)], [
+                                        data['y'] for _, data in g.nodes(data=True)])
+    return images['view']
 
+
+def _draw_buses(g: BusesGraph, image: Image.Image, view: render.View) -> None:
+    """ Draws all the stops and bus lines of the graph on the image, all of them at once with render """
+    edges = [data for u, v, data in g.edges(data=True)]
+    nodes = [data for _, data in g.nodes(data=True)]
+    colors, palette = render.palette_of(
+        [data['color'] for data in edges + nodes])
+    raster = render.Raster(view, palette)
     # Draws all the edges using route information in edge
-    for u, v, data in g.edges(data=True):
-        line = stm.Line(data['route'], data['color'], 3)
-        barcelona.add_line(line)
-
-    # Save image
-    image = barcelona.render()
-    image.save(nom_fitxer)
-    # Show image
-    image = Image.open(nom_fitxer)
+    points, offsets = render.flatten([data['route'] for data in edges])
+    raster.routes(points, offsets, colors[:len(edges)], 3)
+    # Draws all the nodes in the graph using 'x', 'y' information in edge
+    raster.points(np.array([(data['x'], data['y']) for data in nodes]).reshape(-1, 2),
+                  colors[len(edges):], 5)
+    raster.paste_on(image)
+
+
+@metrics.timed('buses.plot')
+def plot(g: BusesGraph, nom_fitxer: str | None = None) -> Image.Image:
+    """ Returns and shows the graph as an image with the background city map, saved in the specified file: nom_fitxer if given.
+        The image is drawn only the first time, then it is kept with the graph """
+    image = render.cached_layer(g.graph.setdefault('images', dict()), 'buses', map_view(
+        g), lambda image, view: _draw_buses(g, image, view))
+    if nom_fitxer is not None:
+        image.save(nom_fitxer)
     image.show()
-
-
-def plot_BusLine(g: BusesGraph, id_line: str, nom_fitxer: str) -> None:
-    """ Saves and shows just a bus line of the graph as an image with the background city map in the specified file: nom_fitxer, using staticmaps library """
-    # Create a new map object
-    barcelona = stm.StaticMap(3500, 3500)
-    # Draws all the nodes that belong to the route using that the original stop.code was composed of: stop_id+"-"+route_id
-    for id, data in g.nodes(data=True):
-        if id.split("-")[1] != id_line:
-            continue
-        pos: Coord = (data['x'], data['y'])
-        marker = stm.CircleMarker(pos, data['color'], 5)
-        barcelona.add_marker(marker)
-
-    # Draws all the edges that belong to the route using that the original stop.code was composed of: stop_id+"-"+route_id
-    for u, v, data in g.edges(data=True):
-        if u.split("-")[1] != id_line or v.split("-")[1] != id_line:
-            continue
-        route = stm.Line(data['route'], data['color'], 3)
-        barcelona.add_line(route)
-
-    # Save image
-    image = barcelona.render()
-    image.save(nom_fitxer)
-    # Show image
-    image = Image.open(nom_fitxer)
+    return image
+
+
+@metrics.timed('buses.plot_BusLine')
+def plot_BusLine(g: BusesGraph, id_line: str, nom_fitxer: str | None = None) -> Image.Image:
+    """ Returns and shows just a bus line of the graph as an image with the background city map, saved in the specified file: nom_fitxer if given.
+        The line is drawn over the part of the cached map (only tiles) around it, only its own nodes and edges are used (line_index) """
+    assert id_line in line_index(g), 'Line '+id_line+' not found'
+    line: LineInfo = line_index(g)[id_line]
+    base = render.cached_layer(g.graph.setdefault(
+        'images', dict()), 'tiles', map_view(g), lambda image, view: None)
+    image, view = render.crop(base, map_view(g), [line.bbox[0], line.bbox[2]], [
+                              line.bbox[1], line.bbox[3]])
+
+    render.draw_lines(image, view, [(g[u][v]['route'], g[u][v]['color'], 3)
+                                    for u, v in line.edges])
+    render.draw_circles(image, view, [((g.nodes[node]['x'], g.nodes[node]['y']), g.nodes[node]['color'], 5)
+                                      for node in line.nodes])
+
+    if nom_fitxer is not None:
+        image.save(nom_fitxer)
     image.show()
+    return image
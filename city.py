@@ -1,29 +1,53 @@
 from dataclasses import dataclass
 from PIL import Image
-from typing import TypeAlias, Any
+from typing import TypeAlias, Any, Iterator
 import osmnx as ox
 import networkx as nx
 import buses
+import routing
+import hierarchy
+import spatial
+import render
+import metrics
+import geocoding
 import os
 import pickle
+import heapq
+import math
+import json
+import hashlib
+import numpy as np
 import matplotlib.pyplot as plt
-import staticmap as stm
 
 
 CityGraph: TypeAlias = nx.DiGraph
+CompiledGraph: TypeAlias = routing.CompiledGraph
 OsmnxGraph: TypeAlias = nx.DiGraph
 BusesGraph: TypeAlias = nx.DiGraph
 
 Coord: TypeAlias = tuple[float, float]   # (longitude, latitude)
 Path: TypeAlias = list
 
+SNAPSHOT_LINES: str = "lines.json"  # what the bus lines of a snapshot were built from, see load_snapshot_lines
 
+
+@metrics.timed('city.get_osmnx_graph')
 def get_osmnx_graph() -> OsmnxGraph:
     """ Returns procesed Barcelona graph """
+    # osmnx keeps the address tags of the nodes too, so the house numbers on the walking paths are indexed (see geocoding)
+    ox.settings.useful_tags_node = list(dict.fromkeys(
+        ox.settings.useful_tags_node + geocoding.ADDRESS_TAGS))
+    return clean_osmnx_graph(ox.graph_from_place(
+        "Barcelona", network_type="walk", simplify=True))
+
+
+def clean_osmnx_graph(g: nx.MultiDiGraph) -> OsmnxGraph:
+    """ Returns the walking graph of osmnx with only what we use: positions of the nodes, and time, color and route of the edges.
+        The street names are deleted, but first they are indexed for the geocoding of addresses (graph attribute 'addresses') """
     # Delete duplicated edges by converting it to DiGraph
     # Same functionality than deleting all edges with key != 0
-    GraphBcn: OsmnxGraph = OsmnxGraph(ox.graph_from_place(
-        "Barcelona", network_type="walk", simplify=True))
+    GraphBcn: OsmnxGraph = OsmnxGraph(g)
+    GraphBcn.graph['addresses'] = geocoding.build_index(g)
 
     # Filter the edge and node information
     # Information in nodes we whant to keep (x=longitud, y=latitut)
@@ -58,6 +82,10 @@ def get_osmnx_graph() -> OsmnxGraph:
         v_pos: Coord = (GraphBcn.nodes[v]['x'], GraphBcn.nodes[v]['y'])
         GraphBcn[u][v].update({'color': '#000000', 'route': [u_pos, v_pos]})
 
+    # The spatial index is kept in the graph so it is saved (and loaded) with it
+    street_index(GraphBcn)
+    metrics.count('nodes', GraphBcn.number_of_nodes())
+    metrics.count('edges', GraphBcn.number_of_edges())
     return GraphBcn
 
 
@@ -74,22 +102,32 @@ def load_osmnx_graph(filename: str) -> OsmnxGraph:
         return pickle.load(file)
 
 
+@metrics.timed('city.build_city_graph')
 def build_city_graph(bcn: OsmnxGraph, bus: BusesGraph) -> CityGraph:
     """ Returns the graph of the city (merge of the street graph and the bus graph)"""
     city_graph: nx.DiGraph = nx.compose(
         bcn, bus)  # We use compose to merge both graphs
+    # the line index and the images of the bus graph are not the ones of the city graph
+    for key in ('lines', 'hashes', 'images'):
+        city_graph.graph.pop(key, None)
 
-    # We get the list of nearest nodes from each node of the bus to the bcn graph using ox.distance.nearest_nodes
+    # We get the list of nearest nodes from each node of the bus to the bcn graph using its spatial index
     lon_stops: list[float] = [bus.nodes[id]['x'] for id in bus.nodes]
     lat_stops: list[float] = [bus.nodes[id]['y'] for id in bus.nodes]
-    nearest_cruilla: list[int] = ox.distance.nearest_nodes(
-        bcn, lon_stops, lat_stops, return_dist=False)
+    nearest_cruilla: list[int] = nearest_nodes(
+        bcn, lon_stops, lat_stops)
 
     # Create the edge between the stop and its nearest node in bcn graph
-    for stop_id, cruilla_id in zip(bus.nodes, nearest_cruilla):
+    _connect_stops(city_graph, bus, list(bus.nodes), nearest_cruilla, [
+                   (bcn.nodes[cruilla_id]['x'], bcn.nodes[cruilla_id]['y']) for cruilla_id in nearest_cruilla])
+    metrics.count('stops', len(nearest_cruilla))
+    return city_graph
+
+
+def _connect_stops(city_graph: nx.DiGraph, bus: BusesGraph, stops: list[str], cruilles: list[Any], cruilla_pos: list[Coord]) -> None:
+    """ Adds the edges (both directions) between each stop of bus and its nearest street node, cruilles[i] at cruilla_pos[i] """
+    for stop_id, cruilla_id, cruilla_pos in zip(stops, cruilles, cruilla_pos):
         stop_pos: Coord = (bus.nodes[stop_id]['x'], bus.nodes[stop_id]['y'])
-        cruilla_pos: Coord = (
-            bcn.nodes[cruilla_id]['x'], bcn.nodes[cruilla_id]['y'])
         edge_length = buses.dist(stop_pos, cruilla_pos)  # harversine
 
         # Since it is directed we want to add both directions
@@ -98,20 +136,297 @@ def build_city_graph(bcn: OsmnxGraph, bus: BusesGraph) -> CityGraph:
         city_graph.add_edge(stop_id, cruilla_id, route=[
                             stop_pos, cruilla_pos], length=edge_length/1.11, color='#000000')  # suposem 3 min de espera
 
-    return city_graph
 
-
-def find_path(g: CityGraph, src: Coord, dst: Coord) -> Path:
+@metrics.timed('city.update_city_graph')
+def update_city_graph(g: CityGraph | CompiledGraph, bus: BusesGraph, removed: list[int], added: list[int]) -> CityGraph | CompiledGraph:
+    """ Replaces the removed bus lines by the added lines of bus (ids, see buses.changed_lines) without building the city graph again: the stops of the
+        removed lines go away with their edges and only the stops of the added lines are snapped to the streets. A networkx graph is updated in place,
+        a compiled one is patched into a new one (routing.patch_graph) that keeps the spatial index and the hierarchy of the streets. Returns the updated graph """
+    gone: set[str] = {str(id) for id in removed}
+    # the code of a stop ends with the id of its line
+    if isinstance(g, routing.CompiledGraph):
+        old_stops: list[str] = [g.node_id(u) for u in np.flatnonzero(g.is_stop)
+                                if str(g.ids[u]).split("-")[1] in gone]
+    else:
+        old_stops = [node for node in g.nodes if isinstance(
+            node, str) and node.split("-")[1] in gone]
+
+    # stops and edges of the added lines (line_index of bus) and the edges to their nearest street nodes
+    new: nx.DiGraph = nx.DiGraph()
+    lines = buses.line_index(bus)
+    for id in added:
+        new.add_nodes_from((node, bus.nodes[node]) for node in lines[str(id)].nodes)
+        new.add_edges_from((u, v, bus[u][v]) for u, v in lines[str(id)].edges)
+    stops: list[str] = list(new.nodes)
+    metrics.count('stops', len(stops))
+    cruilles = nearest_nodes(g, [bus.nodes[stop]['x'] for stop in stops], [
+                             bus.nodes[stop]['y'] for stop in stops])
+
+    if isinstance(g, routing.CompiledGraph):
+        _connect_stops(new, bus, stops, [g.node_id(u) for u in cruilles], [
+                       g.pos(u) for u in cruilles])
+        patched, _ = routing.patch_graph(g, set(old_stops), new)
+        if g._hierarchy is not None:
+            patched._hierarchy = hierarchy.patch_stops(g._hierarchy, patched)
+        return patched
+    _connect_stops(new, bus, stops, cruilles, [
+                   (g.nodes[cruilla]['x'], g.nodes[cruilla]['y']) for cruilla in cruilles])
+    g.remove_nodes_from(old_stops)
+    g.update(new)
+    images(g).clear()  # the maps are drawn again the next time
+    return g
+
+
+def compile_city_graph(g: CityGraph) -> CompiledGraph:
+    """ Returns the compiled (CSR arrays) version of the city graph, faster to search and lighter to keep in memory """
+    return routing.compile_graph(g)
+
+
+def inputs_hash(filenames: list[str]) -> str:
+    """ Returns a hash of the content of the files used to build the city graph (bus json files and osmnx graph) """
+    sha = hashlib.sha1()
+    for filename in filenames:
+        sha.update(filename.encode())
+        with open(filename, 'rb') as file:
+            # read by blocks, the json files are big
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def save_city_snapshot(g: CompiledGraph, dirname: str, inputs: str, streets: str = "", lines: dict[int, str] | None = None) -> None:
+    """ Saves the compiled city graph at: dirname. inputs is the inputs_hash of the files used to build it.
+        streets (inputs_hash of the osmnx graph) and lines (buses.line_hashes of the bus network) let it be updated later when only some lines change """
+    # a hierarchy saved with a previous snapshot does not belong to this one, nor its lines
+    for filename in ('ch_meta.json', SNAPSHOT_LINES):
+        if os.path.exists(os.path.join(dirname, filename)):
+            os.remove(os.path.join(dirname, filename))
+    routing.save_snapshot(g, dirname, inputs)
+    # a graph patched by update_city_graph keeps its hierarchy
+    if g._hierarchy is not None:
+        hierarchy.save_hierarchy(g._hierarchy, dirname, inputs)
+    if lines is not None:
+        with open(os.path.join(dirname, SNAPSHOT_LINES), 'w') as file:
+            json.dump({'inputs': inputs, 'streets': streets,
+                      'lines': lines}, file)
+
+
+def load_snapshot_lines(dirname: str) -> tuple[str, str, dict[int, str]] | None:
+    """ Returns the inputs, streets and lines the snapshot at dirname was saved with (save_city_snapshot), None if they were not saved """
+    filename = os.path.join(dirname, SNAPSHOT_LINES)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as file:
+        saved = json.load(file)
+    return saved['inputs'], saved['streets'], {int(id): h for id, h in saved['lines'].items()}
+
+
+def load_city_snapshot(dirname: str, inputs: str) -> CompiledGraph | None:
+    """ Loads the compiled city graph from: dirname, with its contraction hierarchy if it was built (build_city_hierarchy).
+        Returns None if there is no snapshot or it was built from other inputs (or version) """
+    if not routing.snapshot_is_valid(dirname, inputs):
+        return None
+    g = routing.load_snapshot(dirname)
+    g._hierarchy = hierarchy.load_hierarchy(dirname, inputs)
+    return g
+
+
+def build_city_hierarchy(g: CompiledGraph, dirname: str, inputs: str) -> hierarchy.Hierarchy:
+    """ Optional preprocessing: builds the contraction hierarchy of the streets of the compiled graph, saves it next to the snapshot at dirname
+        and keeps it with the graph, so walking_path answers without searching the whole graph """
+    h = hierarchy.build_hierarchy(g)
+    hierarchy.save_hierarchy(h, dirname, inputs)
+    g._hierarchy = h
+    return h
+
+
+def street_index(g: OsmnxGraph | CityGraph | CompiledGraph) -> spatial.GridIndex:
+    """ Returns the spatial index over the street nodes of the graph (bus stops are never included). It is built only the first time and kept with the graph """
+    if isinstance(g, routing.CompiledGraph):
+        return g.street_index()
+    if 'street_index' not in g.graph:
+        # bus stops are the only nodes with str ids
+        streets: list[int] = [
+            node for node in g.nodes if not isinstance(node, str)]
+        g.graph['street_index'] = spatial.build_index(np.array(streets, dtype=np.int64), np.array(
+            [g.nodes[node]['x'] for node in streets]), np.array([g.nodes[node]['y'] for node in streets]))
+    return g.graph['street_index']
+
+
+@metrics.timed('city.nearest_nodes')
+def nearest_nodes(g: OsmnxGraph | CityGraph | CompiledGraph, lons: list[float], lats: list[float], return_dist: bool = False) -> Any:
+    """ Returns the nearest street node of the graph to each point (lon, lat), and the distances in meters if return_dist """
+    nodes, dists = street_index(g).query(lons, lats)
+    metrics.count('points', len(lons))
+    if return_dist:
+        return nodes.tolist(), dists.tolist()
+    return nodes.tolist()
+
+
+@metrics.timed('city.find_path')
+def find_path(g: CityGraph | CompiledGraph, src: Coord, dst: Coord) -> Path:
     """ Given a graph, and 2 points descrived by coordinates, returns the shortest using the graph. Coords: lon, lat """
-    src_nearest_node = ox.distance.nearest_nodes(
-        g, src[0], src[1])  # find the nearest node from src
-    dst_nearest_node = ox.distance.nearest_nodes(
-        g, dst[0], dst[1])  # find the nearest node from dst
+    src_nearest_node, dst_nearest_node = nearest_nodes(
+        g, [src[0], dst[0]], [src[1], dst[1]])  # find the nearest node from src and dst
+    if isinstance(g, routing.CompiledGraph):
+        return routing.shortest_path(g, src_nearest_node, dst_nearest_node)
     return nx.shortest_path(g, src_nearest_node, dst_nearest_node, weight='length')
 
 
-def show(g: CityGraph) -> None:
+@metrics.timed('city.shortest_times')
+def shortest_times(g: CityGraph | CompiledGraph, src: Any, targets: set[Any] | None = None, budget: float = math.inf, reverse: bool = False, walk_only: bool = False) -> tuple[dict[Any, float], dict[Any, Any]]:
+    """ Runs a single Dijkstra from src over the 'length' of the edges. It stops once every node in targets is settled or when the next node is further than budget.
+        Returns the time to every settled node and the predecessor map so paths can be rebuilt with path_from.
+        With reverse=True the times are from every node to src, and with walk_only=True only the streets are used (bus stops are only entered when they are targets) """
+    if isinstance(g, routing.CompiledGraph):
+        times, pred = routing.dijkstra(
+            g, src, targets, budget, reverse, walk_only)
+        metrics.count('settled', len(times))
+        return times, pred
+    if reverse:
+        g = g.reverse(copy=False)
+
+    dist: dict[Any, float] = {src: 0.0}  # settled nodes -> time from src
+    pred: dict[Any, Any] = {src: None}  # node -> previous node in the shortest path tree
+    best: dict[Any, float] = {src: 0.0}  # best tentative time found for each node
+    remaining: set[Any] = set(targets or ()) - {src}
+    heap: list[tuple[float, int, Any]] = [(0.0, 0, src)]
+    counter = 1  # tie breaker so the heap never has to compare node ids (int and str are mixed)
+
+    while heap:
+        t, _, u = heapq.heappop(heap)
+        if t > best[u]:
+            continue  # outdated entry, u was already settled with a better time
+        if t > budget:
+            break
+        dist[u] = t
+        remaining.discard(u)
+        if targets and not remaining:
+            break
+        if walk_only and isinstance(u, str) and u != src:
+            continue  # a stop reached walking is a target, the walk does not go on through it
+        for v, data in g.adj[u].items():
+            # bus stops are the only nodes with str ids, walking they are only entered from the street when they are targets (stop to stop is a bus)
+            if walk_only and isinstance(v, str) and (isinstance(u, str) or v not in remaining):
+                continue
+            new_t = t + data['length']
+            if new_t < best.get(v, math.inf):
+                best[v] = new_t
+                pred[v] = u
+                heapq.heappush(heap, (new_t, counter, v))
+                counter += 1
+
+    metrics.count('settled', len(dist))
+    return dist, {node: pred[node] for node in dist}
+
+
+def settle(g: CityGraph | CompiledGraph, src: Any, budget: float = math.inf, walk_only: bool = False) -> Iterator[tuple[Any, float, Any]]:
+    """ Same search as shortest_times, but yields every node (node, time, predecessor) as soon as it is settled, in order of time, until the next one
+        is further than budget. The search goes on only while it is consumed, so the nearest answers can be used before it finishes """
+    if isinstance(g, routing.CompiledGraph):
+        yield from routing.settle(g, src, budget, walk_only)
+        return
+
+    settled: set[Any] = set()
+    best: dict[Any, float] = {src: 0.0}
+    pred: dict[Any, Any] = {src: None}
+    heap: list[tuple[float, int, Any]] = [(0.0, 0, src)]
+    counter = 1  # tie breaker so the heap never has to compare node ids (int and str are mixed)
+
+    while heap:
+        t, _, u = heapq.heappop(heap)
+        if t > best[u] or u in settled:
+            continue
+        if t > budget:
+            return
+        settled.add(u)
+        yield u, t, pred[u]
+        for v, data in g.adj[u].items():
+            if walk_only and isinstance(v, str):
+                continue  # bus stops are the only nodes with str ids
+            new_t = t + data['length']
+            if new_t < best.get(v, math.inf):
+                best[v] = new_t
+                pred[v] = u
+                heapq.heappush(heap, (new_t, counter, v))
+                counter += 1
+
+
+@metrics.timed('city.walking_path')
+def walking_path(g: CityGraph | CompiledGraph, src: Any, dst: Any) -> tuple[float, Path]:
+    """ Returns the time and the path walking (buses are never taken) from src to dst. They can be bus stops: the walk starts or ends at them.
+        If the graph has a contraction hierarchy it is used instead of searching the graph, both give the same times """
+    if isinstance(g, routing.CompiledGraph) and g._hierarchy is not None:
+        return hierarchy.query(g._hierarchy, src, dst)
+    times, pred = shortest_times(g, src, {dst}, walk_only=True)
+    if dst not in times:
+        raise nx.NetworkXNoPath('No walk between '+str(src)+' and '+str(dst))
+    return times[dst], path_from(pred, dst)
+
+
+def path_from(pred: dict[Any, Any], dst: Any) -> Path:
+    """ Rebuilds the path from the source of the search to dst using the predecessor map returned by shortest_times """
+    assert dst in pred, str(dst)+' was not reached'
+    path: Path = [dst]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+    return path[::-1]
+
+
+@dataclass
+class CinemaTables:
+    """ Travel time from every node of the city graph to every cinema (matrix of nodes x cinemas) """
+    times: np.ndarray  # float32 matrix, times[row of node, column of cinema] (inf if unreachable)
+    rows: dict[Any, int]  # node id -> row in times
+    columns: dict[str, int]  # cinema name -> column in times
+    version: str = ''  # hash of the inputs of the graph the tables were built for
+
+    def time_to(self, node: Any, cinema: str) -> float:
+        """ Returns the time needed to go from node to the cinema (inf if the node or cinema are not in the tables) """
+        if node not in self.rows or cinema not in self.columns:
+            return math.inf
+        return float(self.times[self.rows[node], self.columns[cinema]])
+
+
+@metrics.timed('city.build_cinema_tables')
+def build_cinema_tables(g: CityGraph | CompiledGraph, cinemas: dict[str, Coord], filename: str, version: str = '') -> CinemaTables:
+    """ Runs a reverse Dijkstra from every cinema and saves the time from every node to each cinema at: filename (.npy matrix) and its index at filename with .json extension """
+    compiled: bool = isinstance(g, routing.CompiledGraph)
+    nodes: list[Any] = list(range(g.number_of_nodes())) if compiled else list(g.nodes)
+    names: list[str] = list(cinemas)
+    rows: dict[Any, int] = {node: i for i, node in enumerate(nodes)}
+    cinema_nodes = nearest_nodes(
+        g, [cinemas[name][0] for name in names], [cinemas[name][1] for name in names])
+
+    # Searching on the reversed graph gives the time from every node to the cinema
+    times = np.full((len(nodes), len(names)), np.inf, dtype=np.float32)
+    for column, cinema_node in enumerate(cinema_nodes):
+        if compiled:
+            dist, _ = routing.dijkstra(g, cinema_node, reverse=True)
+        else:
+            dist, _ = shortest_times(g.reverse(copy=False), cinema_node)
+        times[[rows[node] for node in dist], column] = list(dist.values())
+
+    np.save(filename, times)
+    with open(os.path.splitext(filename)[0]+'.json', 'w') as file:
+        json.dump({'nodes': nodes, 'cinemas': names,
+                  'version': version}, file)
+    return CinemaTables(times, rows, {name: i for i, name in enumerate(names)}, version)
+
+
+def load_cinema_tables(filename: str) -> CinemaTables:
+    """ Loads the tables saved by build_cinema_tables. The matrix is memory-mapped instead of read into memory """
+    assert os.path.exists(filename)
+    with open(os.path.splitext(filename)[0]+'.json', 'r') as file:
+        index = json.load(file)
+    times: np.ndarray = np.load(filename, mmap_mode='r')
+    return CinemaTables(times, {node: i for i, node in enumerate(index['nodes'])}, {name: i for i, name in enumerate(index['cinemas'])}, index.get('version', ''))
+
+
+def show(g: CityGraph | CompiledGraph) -> None:
     """ Shows the directed graph using networkx.draw """
+    if isinstance(g, routing.CompiledGraph):
+        g = routing.to_networkx(g)
     # We extrat the position of each node and create a dictionary
     pos: dict[Any, Coord] = {node: (data['x'], data['y'])
                              for node, data in g.nodes(data=True)}
@@ -121,60 +436,109 @@ def show(g: CityGraph) -> None:
     plt.show()
 
 
-def plot(g: CityGraph, filename: str) -> None:
-    """ Saves and shows the graph as an image with the background city map in the specified file: filename, using staticmaps library """
-    # Create a new map object
-    barcelona = stm.StaticMap(3500, 3500)
-    # Draws all the nodes in the graph using 'x', 'y' information in edge
-    for id, data in g.nodes(data=True):
-        if data['poblacio'] == 'Barcelona':
-            pos: Coord = (data['x'], data['y'])
-            marker = stm.CircleMarker(pos, data['color'], 2)
-            barcelona.add_marker(marker)
-
-    # Draws all the edges using route information in edge
-    for u, v, data in g.edges(data=True):
-        if g.nodes[u]['poblacio'] == 'Barcelona' and g.nodes[v]['poblacio'] == 'Barcelona':
-            line = stm.Line(data['route'], data['color'], 1)
-            barcelona.add_line(line)
-
-    # Save image
-    image = barcelona.render()
-    image.save(filename)
-    # Show image
-    image = Image.open(filename)
+def images(g: CityGraph | CompiledGraph) -> dict[str, Any]:
+    """ Returns the dict where the images of the graph drawn by render are kept """
+    if isinstance(g, routing.CompiledGraph):
+        return g._images
+    return g.graph.setdefault('images', dict())
+
+
+def map_view(g: CityGraph | CompiledGraph) -> render.View:
+    """ Returns the view of the maps of the graph: all Barcelona in a MAP_SIZE image. Computed the first time and kept with the graph """
+    if 'view' not in images(g):
+        if isinstance(g, routing.CompiledGraph):
+            lons, lats = g.x[g.barcelona], g.y[g.barcelona]
+        else:
+            nodes = [data for _, data in g.nodes(data=True)
+                     if data['poblacio'] == 'Barcelona']
+            lons, lats = [data['x'] for data in nodes], [data['y'] for data in nodes]
+        images(g)['view'] = render.view_of(lons, lats)
+    return images(g)['view']
+
+
+def _draw_city(g: CityGraph | CompiledGraph, image: Image.Image, view: render.View) -> None:
+    """ Draws the nodes and edges of Barcelona on the image, all of them at once with render """
+    if isinstance(g, routing.CompiledGraph):
+        # The routes of the edges are already one after the other in the arrays of the compiled graph
+        sources = np.repeat(np.arange(g.number_of_nodes()), np.diff(g.offsets))
+        edges = np.flatnonzero(g.barcelona[sources] & g.barcelona[g.targets])
+        lengths = np.diff(g.geom_offsets)[edges]
+        offsets = np.zeros(len(edges)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        points = g.geom[np.repeat(g.geom_offsets[edges]-offsets[:-1], lengths) +
+                        np.arange(offsets[-1])]
+        raster = render.Raster(view, [str(color) for color in g.colors])
+        raster.routes(points, offsets, g.edge_color[edges], 1)
+        nodes = np.flatnonzero(g.barcelona)
+        raster.points(np.column_stack(
+            (g.x[nodes], g.y[nodes])), g.node_color[nodes], 2)
+    else:
+        edges = [data for u, v, data in g.edges(data=True)
+                 if g.nodes[u]['poblacio'] == 'Barcelona' and g.nodes[v]['poblacio'] == 'Barcelona']
+        nodes = [data for _, data in g.nodes(data=True)
+                 if data['poblacio'] == 'Barcelona']
+        colors, palette = render.palette_of(
+            [data['color'] for data in edges + nodes])
+        raster = render.Raster(view, palette)
+        # Draws all the edges using route information in edge
+        points, offsets = render.flatten([data['route'] for data in edges])
+        raster.routes(points, offsets, colors[:len(edges)], 1)
+        # Draws all the nodes in the graph using 'x', 'y' information in edge
+        raster.points(np.array([(data['x'], data['y']) for data in nodes]).reshape(-1, 2),
+                      colors[len(edges):], 2)
+    raster.paste_on(image)
+
+
+@metrics.timed('city.plot')
+def plot(g: CityGraph | CompiledGraph, filename: str | None = None) -> Image.Image:
+    """ Returns and shows the graph as an image with the background city map, saved in the specified file: filename if given.
+        The image is drawn only the first time, then it is kept with the graph """
+    image = render.cached_layer(images(g), 'city', map_view(
+        g), lambda image, view: _draw_city(g, image, view))
+    if filename is not None:
+        image.save(filename)
     image.show()
+    return image
 
 
-def plot_path(g: CityGraph, p: Path, filename: str) -> None:
-    """ Saves and shows a path of nodes as an image with the background city map in the specified file: filename, using staticmaps library """
-    # Create a new map object
-    barcelona = stm.StaticMap(3500, 3500)
+def _node_info(g: CityGraph | CompiledGraph, id: Any) -> tuple[Coord, str]:
+    """ Returns the position and color of a node of any of the two graph formats """
+    if isinstance(g, routing.CompiledGraph):
+        return g.pos(id), str(g.colors[g.node_color[id]])
+    return (g.nodes[id]['x'], g.nodes[id]['y']), g.nodes[id]['color']
 
-    # We add special markers for start and end
-    pos_start: Coord = (g.nodes[p[0]]['x'], g.nodes[p[0]]['y'])
-    marker_start = stm.IconMarker(pos_start, "start.png", 10, 30)
-    barcelona.add_marker(marker_start)
-    pos_end: Coord = (g.nodes[p[-1]]['x'], g.nodes[p[-1]]['y'])
-    marker_end = stm.IconMarker(pos_end, "end.png", 10, 20)
-    barcelona.add_marker(marker_end)
+
+def _edge_info(g: CityGraph | CompiledGraph, u: Any, v: Any) -> tuple[list[Coord], str]:
+    """ Returns the route and color of the edge u->v of any of the two graph formats """
+    if isinstance(g, routing.CompiledGraph):
+        e = g.edge(u, v)
+        return g.route(e), str(g.colors[g.edge_color[e]])
+    return g[u][v]['route'], g[u][v]['color']
+
+
+@metrics.timed('city.plot_path')
+def plot_path(g: CityGraph | CompiledGraph, p: Path, filename: str | None = None) -> Image.Image:
+    """ Returns and shows a path of nodes as an image with the background city map, saved in the specified file: filename if given.
+        The path is drawn over the part of the cached map of the city (only tiles) around it """
+    positions: list[Coord] = [_node_info(g, id)[0] for id in p]
+    base = render.cached_layer(images(g), 'tiles', map_view(
+        g), lambda image, view: None)
+    image, view = render.crop(base, map_view(g), [pos[0] for pos in positions], [
+                              pos[1] for pos in positions])
 
     # Add the lines connecting the nodes using the information in the edge u->v
-    for u, v in zip(p, p[1:]):
-        line = stm.Line(g[u][v]['route'], g[u][v]['color'], 6)
-        barcelona.add_line(line)
+    render.draw_lines(image, view, [(*_edge_info(g, u, v), 6)
+                                    for u, v in zip(p, p[1:])])
 
     # Add the nodes form the path with the indecated attributes
-    for id in p:
-        pos: Coord = (g.nodes[id]['x'], g.nodes[id]['y'])
-        marker = stm.CircleMarker(pos, g.nodes[id]['color'], 6)
-        outline = stm.CircleMarker(pos, 'black', 8)
-        barcelona.add_marker(outline)
-        barcelona.add_marker(marker)
-
-    # Save image
-    image = barcelona.render()
-    image.save(filename)
-    # Show image
-    image = Image.open(filename)
+    render.draw_circles(image, view, [circle for id, pos in zip(p, positions)
+                                      for circle in ((pos, 'black', 8), (pos, _node_info(g, id)[1], 6))])
+
+    # We add special markers for start and end
+    render.draw_icon(image, view, positions[0], "start.png", 10, 30)
+    render.draw_icon(image, view, positions[-1], "end.png", 10, 20)
+
+    if filename is not None:
+        image.save(filename)
     image.show()
+    return image
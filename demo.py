@@ -1,15 +1,21 @@
 import tkinter as tk
+from tkinter import ttk
 import buses
 import city
 import billboard
+import transit
+import planner
+import geocoding
+import metrics
+import tasks
 from PIL import ImageTk, Image
 import requests
 from io import BytesIO
-import osmnx as ox
-from networkx import shortest_path_length
-from typing import TypeAlias
+from typing import TypeAlias, Callable
 from dataclasses import asdict
 from datetime import datetime
+import argparse
+import threading
 
 
 Coord: TypeAlias = tuple[float, float]   # (latitude, longitude)
@@ -26,12 +32,27 @@ class MovieApp(tk.Tk):
 
         # initializ som values we will use in th entire program
         self.selected_movie = ""
-        self.billboard = billboard.read()
+        # empty until it is read in background (read_billboard)
+        self.billboard = billboard.Billboard([], [], [])
+        # projections of each film and language sorted by start time
+        self.projections = billboard.ProjectionIndex()
         self.BusGraph = buses.BusesGraph()
-        self.CityGraph = city.CityGraph()
+        # only one thread fetches the bus graph, the others wait for it (fetch_buses_graph)
+        self.buses_lock = threading.Lock()
+        self.CityGraph: city.CityGraph | city.CompiledGraph = city.CityGraph()
+        self.cinemaTables: city.CinemaTables | None = None
+        self.timetable: transit.Timetable | None = None
+        self.planner: planner.Planner | None = None
+        # loaded with the first address searched (pos_address)
+        self.geocoder: geocoding.Geocoder | None = None
+
+        # The slow work runs in background, the window is shown at once
+        self.tasks = tasks.TaskRunner(self, on_change=self.show_tasks)
+        self.protocol("WM_DELETE_WINDOW", self.close)
 
         # Set up the widgets
         self.set_widgets()
+        self.read_billboard()
 
     def set_widgets(self):
         self.movie_widgets()
@@ -39,6 +60,7 @@ class MovieApp(tk.Tk):
         self.bus_widgets()
         self.city_widgets()
         self.path_widgets()
+        self.task_widgets()
 
         author_label = tk.Label(
             self, text="Authors: Pol de los Santos & Roger Bargall\u00F3")
@@ -58,6 +80,7 @@ class MovieApp(tk.Tk):
         scrollbar = tk.Scrollbar(list_frame, orient=tk.VERTICAL)  # scrollbar
         listbox = tk.Listbox(list_frame, width=50,
                              yscrollcommand=scrollbar.set)  # List of movies
+        self.movies_listbox = listbox
         # Making scrollbar move list by y axis
         scrollbar.config(command=listbox.yview)
 
@@ -87,6 +110,17 @@ class MovieApp(tk.Tk):
         update_button.grid(row=0, column=0, padx=10)
         select_button.grid(row=0, column=1, padx=10)
 
+    def read_billboard(self) -> None:
+        """ Reads the billboard in background and fills the list of movies when it is read """
+        self.tasks.submit("Reading billboard", billboard.read,
+                          on_done=self.set_billboard)
+
+    def set_billboard(self, billboard_read: billboard.Billboard) -> None:
+        self.billboard = billboard_read
+        # on a refresh only the showings added or removed since the last read change in the index
+        self.projections.update(self.billboard)
+        self.update_movies(self.movies_listbox)
+
     def fill_listbox(self, listbox: tk.Listbox, data: list[str]) -> None:
         """Fill the listbox with the given data"""
         listbox.delete(0, tk.END)
@@ -150,13 +184,10 @@ class MovieApp(tk.Tk):
             (movie for movie in self.billboard.films if movie.title == self.selected_movie), None)
         assert movie != None, "Movie info not found"
         if movie is not None:  # if not mypy has errors even though we hav assert
-            # Create a frame to hold the movie list and scrollbar and sarchbar
-            image_data = requests.get(movie.poster).content
-            image_tk = ImageTk.PhotoImage(Image.open(BytesIO(image_data)).resize(
-                (150, 200)))  # Gets image and resizes it with format tk can process
-            self.movie_poster.configure(image=image_tk)  # changes image
-            # Mypy says error but withought this the image does not show
-            self.movie_poster.image = image_tk
+            # The poster is downloaded in background, a previous download is not needed anymore
+            self.tasks.cancel("Downloading poster")
+            self.tasks.submit("Downloading poster", lambda url: requests.get(url).content, movie.poster,
+                              on_done=self.set_poster)
 
             # movie.title (str), movie.genre (list of str), movie.director (list of str), movie.actors (list of str)
             info = \
@@ -167,6 +198,14 @@ class MovieApp(tk.Tk):
             self.movie_info.configure(
                 text=info, justify='left', wraplength=300)  # changes information
 
+    def set_poster(self, image_data: bytes) -> None:
+        """ Shows the downloaded poster of the selected movie """
+        image_tk = ImageTk.PhotoImage(Image.open(BytesIO(image_data)).resize(
+            (150, 200)))  # Gets image and resizes it with format tk can process
+        self.movie_poster.configure(image=image_tk)  # changes image
+        # Mypy says error but withought this the image does not show
+        self.movie_poster.image = image_tk
+
     ############################ BUSES ############################
 
     def bus_widgets(self) -> None:
@@ -192,16 +231,35 @@ class MovieApp(tk.Tk):
         plotBusLine_button.grid(row=0, column=3, padx=2)
 
     def get_buses_info(self) -> None:
-        """Gets the Bus Graph using function in buses.py"""
-        self.BusGraph = buses.get_buses_graph()
+        """Gets the Bus Graph using function in buses.py (in background)"""
+        self.tasks.submit("Fetching buses", self.fetch_buses_graph,
+                          on_done=self.set_buses_graph)
+
+    def fetch_buses_graph(self) -> buses.BusesGraph:
+        """ Returns the bus graph, fetching it if it is not fetched yet. Runs in background: if another thread is fetching it, waits for that fetch """
+        with self.buses_lock:
+            if self.BusGraph.number_of_nodes() == 0:
+                self.BusGraph = buses.get_buses_graph()
+            return self.BusGraph
+
+    def set_buses_graph(self, g: buses.BusesGraph) -> None:
+        self.BusGraph = g
+
+    def needs_buses(self) -> list[str]:
+        """ Fetches the bus graph if it is not fetched (or being fetched) yet. Returns the tasks to wait for before using it """
+        if self.BusGraph.number_of_nodes() == 0:
+            self.get_buses_info()
+        return ["Fetching buses"]
 
     def show_buses(self) -> None:
-        """ Shows bus graph using function in buses.py """
-        buses.show(self.BusGraph)
+        """ Shows bus graph using function in buses.py (matplotlib windows have to be opened from the Tk loop, only the fetch is in background) """
+        self.tasks.submit("Showing buses", lambda: None, depends=self.needs_buses(),
+                          on_done=lambda _: buses.show(self.BusGraph))
 
     def plot_buses(self) -> None:
         """ Plots bus graph using function in buses.py """
-        buses.plot(self.BusGraph, "plot_buses.png")
+        self.tasks.submit("Plotting buses", lambda: buses.plot(
+            self.BusGraph, "plot_buses.png"), depends=self.needs_buses())
 
     def show_buslines(self) -> None:
         """ Opens a new window with all the busline codes and when one is entered in search bar, it plots it using buses.py function """
@@ -217,8 +275,12 @@ class MovieApp(tk.Tk):
         # Add some items to the listbox
         for line in open('BusCodes.txt', "r"):
             listbox_buslines.insert(tk.END, line.strip())
-        search.bind('<Return>', lambda event: buses.plot_BusLine(
-            self.BusGraph, input.get(), str(input.get())+'.png'))
+        search.bind('<Return>', lambda event: self.plot_busline(input.get()))
+
+    def plot_busline(self, line: str) -> None:
+        """ Plots the bus line using buses.py function (in background) """
+        self.tasks.submit("Plotting line "+line, lambda: buses.plot_BusLine(
+            self.BusGraph, line, line+'.png'), depends=self.needs_buses())
 
     ############################ CITY ############################
 
@@ -242,21 +304,32 @@ class MovieApp(tk.Tk):
         plotCity_button.grid(row=0, column=2, padx=2)
 
     def build_city_graph(self) -> None:
-        """ If it is the first time it loads and saves the osmnx graph and then creates city graph using the previously obtained bus graph (nd to fetch bus graph before)"""
-        if city.os.path.exists("barcelona.pickle"):
-            ox_g = city.load_osmnx_graph("barcelona.pickle")
-        else:
-            ox_g = city.get_osmnx_graph()
-            city.save_osmnx_graph(ox_g, "barcelona.pickle")
-        self.CityGraph = city.build_city_graph(ox_g, self.BusGraph)
+        """ Loads the city graph (with the cinema tables and the bus timetable) in background, building it the first time from the osmnx graph and the bus graph.
+            The bus graph is only fetched if the city graph has to be built or updated. The result is saved as a snapshot that is loaded directly next time if the inputs did not change """
+        self.tasks.submit("Fetching city", planner.load_planner, self.fetch_buses_graph,
+                          on_done=self.set_planner)
+
+    def set_planner(self, city_planner: planner.Planner) -> None:
+        self.planner = city_planner
+        self.CityGraph = city_planner.graph
+        self.cinemaTables = city_planner.tables
+        self.timetable = city_planner.timetable
+
+    def needs_city(self) -> list[str]:
+        """ Loads the city graph if it is not loaded (or being loaded) yet. Returns the tasks to wait for before using it """
+        if self.planner is None:
+            self.build_city_graph()
+        return ["Fetching city"]
 
     def show_city(self) -> None:
-        """ Shows City graph using function in city.py """
-        city.show(self.CityGraph)
+        """ Shows City graph using function in city.py (only the load is in background) """
+        self.tasks.submit("Showing city", lambda: None, depends=self.needs_city(),
+                          on_done=lambda _: city.show(self.CityGraph))
 
     def plot_city(self) -> None:
         """ Plots City graph using function in city.py """
-        city.plot(self.CityGraph, "plot_city.png")
+        self.tasks.submit("Plotting city", lambda: city.plot(
+            self.CityGraph, "plot_city.png"), depends=self.needs_city())
 
     ############################ PATH ############################
 
@@ -272,7 +345,7 @@ class MovieApp(tk.Tk):
         address_entry = tk.Entry(
             button_frame_loc, textvariable=address, width=20)
         button_address = tk.Button(
-            button_frame_loc, text="Find", command=lambda: self.pos_address(address.get()))
+            button_frame_loc, text="Find", command=lambda: self.find(self.pos_address, address.get()))
 
         # Create buttons to search with pos
         position_label = tk.Label(button_frame_loc, text="Position 'lat lon':")
@@ -280,7 +353,7 @@ class MovieApp(tk.Tk):
         position_entry = tk.Entry(
             button_frame_loc, textvariable=position, width=20)
         button_position = tk.Button(
-            button_frame_loc, text="Find", command=lambda: self.pos_lonlat(position.get()))
+            button_frame_loc, text="Find", command=lambda: self.find(self.pos_lonlat, position.get()))
 
         # Create grid to put the buttons
         address_label.grid(row=0, column=0, padx=2, pady=5)
@@ -291,61 +364,85 @@ class MovieApp(tk.Tk):
         position_entry.grid(row=1, column=1, padx=2, pady=5)
         button_position.grid(row=1, column=2, padx=4, pady=5)
 
-    def find_closest_projection(self, userPos: Coord) -> Coord:
-        """ Given the coords of the user, calculates the firt projection the user can arrive in time and see. It takes into consideration time to arrive to the cinema and the language you wwhant to watch it in """
-        user_node = ox.distance.nearest_nodes(
-            self.CityGraph, userPos[0], userPos[1])  # finds nearest node for userPos
-        # iterate through available films (in order) given time
-        for projection in billboard.sort_projections_by_start_time(get_time(), self.billboard):
-            # Search for films with the sam title
-            if projection.film.title != self.selected_movie:
-                continue
-
-            # Checks if language is correct
-            if self.projection_language.get() == True and projection.language == "Doblada":
-                continue
-            elif self.projection_language.get() == False and projection.language == "Original":
-                continue
-
-            # Calcualtes time to travl from userPos to the cinema
-            projection_pos: Coord = billboard.cinemas_location[projection.cinema.name]
-            projection_start: int = billboard.get_time_in_seconds(
-                projection.time)
-            projection_node = ox.distance.nearest_nodes(
-                self.CityGraph, projection_pos[0], projection_pos[1])
-            t: float = shortest_path_length(
-                self.CityGraph, user_node, projection_node, weight='length')
-            # If you can arrive in time return since projections are ordered
-            if get_time()+t <= projection_start:
-                return projection_pos
-
-        return (-1, -1)  # If no projections are found -> error
-
-    def pos_address(self, address: str) -> None:
-        """ Given an adrss geocodes it to get position and then finds path betwen desired cinema and saves the image"""
-        assert ox.geocode(address) != None, 'Location not found'
-        location: Coord = ox.geocode(address)[::-1]
-
-        closest_projection: Coord = self.find_closest_projection(location)
-        assert closest_projection != (
-            -1, -1), 'Could not find a Cinema that offers your desiered film and language in time for you to get there'
-        path: city.Path = city.find_path(
-            self.CityGraph, location, closest_projection)
+    def find(self, pos_function: Callable[[str, str, str], None], position: str) -> None:
+        """ Finds in background (once the city graph is loaded) the path with pos_function, reading the selected movie and language now """
+        language: str = "Original" if self.projection_language.get() else "Doblada"
+        self.tasks.cancel("Finding path")  # only the last search matters
+        self.tasks.submit("Finding path", metrics.timed('demo.find', profile=True)(pos_function), position, self.selected_movie, language,
+                          depends=self.needs_city())
+
+    def find_closest_projection(self, userPos: Coord, movie: str, language: str) -> city.Path:
+        """ Given the coords of the user, returns the path to the first projection the user can arrive in time and see. It takes into consideration time to arrive to the cinema and the language you wwhant to watch it in.
+            All the projections are checked against one single search from the user, and an empty path is returned if none can be reached """
+        now: int = get_time()
+        user_node = city.nearest_nodes(
+            self.CityGraph, [userPos[0]], [userPos[1]])[0]  # finds nearest node for userPos
+
+        # Projections (in order) of the movie with the correct language
+        candidates: list[billboard.Projection] = self.projections.next_showings(
+            movie, language, now)
+        cinema_node = planner.cinema_nodes(
+            self.CityGraph, list({projection.cinema.name for projection in candidates}))
+        _, _, path = planner.closest_projection(
+            self.planner, candidates, cinema_node, user_node, now)
+        return path
+
+    def pos_address(self, address: str, movie: str, language: str) -> None:
+        """ Given an adrss geocodes it to get position and then finds path betwen desired cinema and saves the image.
+            The address is looked for in the cache and the streets of the city before asking Nominatim (see geocoding) """
+        if self.geocoder is None:
+            self.geocoder = planner.load_geocoder()
+        with metrics.span('demo.geocode'):
+            location: Coord | None = self.geocoder.geocode(address)
+        assert location is not None, 'Location not found'
+
+        path: city.Path = self.find_closest_projection(
+            location, movie, language)
+        assert path, 'Could not find a Cinema that offers your desiered film and language in time for you to get there'
         city.plot_path(self.CityGraph, path, 'path_to_cinema.png')
 
-    def pos_lonlat(self, position: str) -> None:
+    def pos_lonlat(self, position: str, movie: str, language: str) -> None:
         """ Given an position in coordenates  finds the path betwen desired cinema and saves the iamge"""
         assert len(position.split()
                    ) == 2, 'Not formated corrctly (just seperate with space).'
         lon = float(position.split()[0])
         lat = float(position.split()[1])
-        closest_projection: Coord = self.find_closest_projection((lon, lat))
-        assert closest_projection != (
-            -1, -1), 'Could not find a Cinema that offers your desiered film and language in time for you to get there'
-        path: city.Path = city.find_path(
-            self.CityGraph, (lon, lat), closest_projection)
+        path: city.Path = self.find_closest_projection(
+            (lon, lat), movie, language)
+        assert path, 'Could not find a Cinema that offers your desiered film and language in time for you to get there'
         city.plot_path(self.CityGraph, path, 'path_to_cinema.png')
 
+    ############################ TASKS ############################
+
+    def task_widgets(self) -> None:
+        """ Creates the progress bar with the tasks running in background and the button to cancel them """
+        task_frame = tk.Frame(self)
+        task_frame.pack(pady=10)
+
+        self.progress = ttk.Progressbar(
+            task_frame, mode='indeterminate', length=200)
+        self.task_label = tk.Label(task_frame, text="Ready", wraplength=300)
+        cancel_button = tk.Button(
+            task_frame, text="Cancel", command=self.tasks.cancel_all)
+
+        self.progress.grid(row=0, column=0, padx=2)
+        cancel_button.grid(row=0, column=1, padx=2)
+        self.task_label.grid(row=1, column=0, columnspan=2, pady=2)
+
+    def show_tasks(self, names: list[str]) -> None:
+        """ Shows the tasks that are not finished, the bar moves while there is any """
+        if names:
+            self.task_label.configure(text=", ".join(names)+"...")
+            self.progress.start(10)
+        else:
+            self.task_label.configure(text="Ready")
+            self.progress.stop()
+
+    def close(self) -> None:
+        """ Closes the window without waiting for the background tasks """
+        self.tasks.shutdown()
+        self.destroy()
+
 
 def get_time() -> int:
     """ Gets PC current time in seconds """
@@ -356,5 +453,10 @@ def get_time() -> int:
 
 # Create an instance of the MovieApp class and run the app
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds the way to a film")
+    parser.add_argument('--metrics-log', help="file where every timing span is written as a line of JSON")
+    parser.add_argument('--profile', help="directory for the cProfile stats of every search")
+    args = parser.parse_args()
+    metrics.configure(args.metrics_log, args.profile)
     app = MovieApp()
     app.mainloop()  # Runs app
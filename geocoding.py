@@ -0,0 +1,224 @@
+""" Geocoding of the addresses written by the user without asking Nominatim every time. An address is looked for, in this order:
+        - in a persistent LRU cache of the previous answers, keyed by the normalised address (accents, case, punctuation and "Barcelona" do not matter)
+        - in an offline index of the street names (and the house numbers that osmnx kept) of the osmnx walking graph, by exact name, prefix or fuzzy match
+        - in Nominatim (ox.geocode), only as a fallback, and its answer is added to the cache """
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, TypeAlias
+import bisect
+import difflib
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+import networkx as nx
+import osmnx as ox
+from osmnx._errors import InsufficientResponseError
+import metrics
+
+
+Coord: TypeAlias = tuple[float, float]   # (longitude, latitude)
+
+CACHE_FILE: str = "geocode_cache.json"  # answers of Nominatim, the most recently used last
+CACHE_SIZE: int = 1000  # addresses kept in the cache
+INDEX_FILE: str = "addresses.json"  # offline index of the streets of the osmnx graph
+ADDRESS_TAGS: list[str] = ['addr:street', 'addr:housenumber']  # tags of the nodes osmnx has to keep to know the house numbers
+SHORT_STREET: float = 300  # meters, a street this short is found without knowing where its number is
+FUZZY_CUTOFF: float = 0.85  # minimum similarity (difflib ratio) of a misspelled street name
+EARTH_RADIUS: float = 6371008.8  # meters, same as haversine
+
+# Words that do not identify the street: its type (also abbreviated) and the articles. "Carrer de Mallorca" is found as "mallorca"
+STREET_TYPES: set[str] = {'carrer', 'calle', 'c', 'cl', 'avinguda', 'avenida', 'av', 'avda', 'passeig', 'paseo', 'pg', 'pl',
+                          'placa', 'plaza', 'pza', 'ronda', 'via', 'passatge', 'pasaje', 'pje', 'cami', 'camino', 'carretera', 'baixada', 'travessia'}
+ARTICLES: set[str] = {'de', 'del', 'dels', 'd', 'la', 'les', 'l', 'el', 'els', 'los', 'las', 'i', 'y'}
+PLACE_WORDS: set[str] = {'barcelona', 'bcn', 'spain', 'espana', 'espanya'}  # written after the address
+
+
+def normalize(address: str) -> str:
+    """ Returns the address without accents, in lower case, only letters, digits and single spaces, and without the city, country or postcode """
+    text = unicodedata.normalize('NFKD', address)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    words = re.sub(r'[^a-z0-9]+', ' ', text).split()
+    return ' '.join(word for word in words if word not in PLACE_WORDS and not re.fullmatch(r'08\d{3}', word))
+
+
+def split_number(address: str) -> tuple[str, str | None]:
+    """ Splits a normalised address in street and house number ("mallorca 401" -> ("mallorca", "401")), None if it has no number """
+    match = re.fullmatch(r'(.*?)\s*(\d+)[a-z]?(\s.*)?', address)
+    if match is None or not match.group(1):
+        return address, None
+    return match.group(1), match.group(2)
+
+
+def street_key(street: str) -> str:
+    """ Returns the words of a normalised street name that identify it, without its type and articles """
+    words = street.split()
+    while len(words) > 1 and (words[0] in STREET_TYPES or words[0] in ARTICLES):
+        words.pop(0)
+    return ' '.join(words)
+
+
+@dataclass
+class AddressIndex:
+    """ Street names of the graph with the position of their segments, and the position of the house numbers osmnx kept (entrances on the walking paths) """
+    names: list[str]  # name of each street, as in OSM
+    points: list[list[Coord]]  # middle of every segment of each street
+    numbers: dict[str, Coord]  # "key number" -> position of the entrance
+    _names: dict[str, int] = field(init=False, repr=False)  # normalised name -> street
+    _keys: dict[str, list[int]] = field(init=False, repr=False)  # key -> streets (Carrer and Plaça de Sants share it)
+    _sorted: list[str] = field(init=False, repr=False)  # keys in order, for the prefix search
+    _center: list[Coord] = field(init=False, repr=False)  # point of each street closest to its centroid
+    _extent: list[float] = field(init=False, repr=False)  # meters, from the center to the farthest point of each street
+
+    def __post_init__(self) -> None:
+        self._names, self._keys = dict(), dict()
+        self._center, self._extent = list(), list()
+        for i, (name, points) in enumerate(zip(self.names, self.points)):
+            self._names[normalize(name)] = i
+            self._keys.setdefault(street_key(normalize(name)), list()).append(i)
+            lon = sum(p[0] for p in points)/len(points)
+            lat = sum(p[1] for p in points)/len(points)
+            center = min(points, key=lambda p: _meters(p, (lon, lat)))
+            self._center.append(center)
+            self._extent.append(max(_meters(p, center) for p in points))
+        self._sorted = sorted(self._keys)
+
+    def _street(self, street: str) -> int | None:
+        """ Returns the street of a normalised name: exact name, exact key, the shortest key it is a prefix of, or the most similar key """
+        if street in self._names:
+            return self._names[street]
+        key = street_key(street)
+        if not key:
+            return None
+        if key not in self._keys:
+            i = bisect.bisect_left(self._sorted, key)
+            prefixed = self._sorted[i:i+1] if i < len(self._sorted) and self._sorted[i].startswith(key) else list()
+            found = prefixed or difflib.get_close_matches(key, self._sorted, 1, FUZZY_CUTOFF)
+            if not found:
+                return None
+            key = found[0]
+        # Of the streets with the same key, the longest (Carrer de Sants rather than Plaça de Sants)
+        return max(self._keys[key], key=lambda i: len(self.points[i]))
+
+    def lookup(self, address: str) -> Coord | None:
+        """ Returns the position of a normalised address, None if the street is not in the index or it is too long to guess where its number is """
+        street, number = split_number(address)
+        # the entrances with a number can be on a square or path with no name in the graph
+        if number is not None and street_key(street)+' '+number in self.numbers:
+            return self.numbers[street_key(street)+' '+number]
+        i = self._street(street)
+        if i is None:
+            return None
+        if number is not None:
+            key = street_key(normalize(self.names[i]))+' '+number
+            if key in self.numbers:
+                return self.numbers[key]
+            if self._extent[i] > SHORT_STREET:
+                return None
+        return self._center[i]
+
+
+def _meters(a: Coord, b: Coord) -> float:
+    """ Distance in meters, equirectangular (enough inside a city) """
+    x = math.radians(b[0]-a[0])*math.cos(math.radians((a[1]+b[1])/2))
+    return math.hypot(x, math.radians(b[1]-a[1]))*EARTH_RADIUS
+
+
+def build_index(g: nx.MultiDiGraph) -> AddressIndex:
+    """ Builds the index from the osmnx graph as downloaded (the names of the edges and the address tags of the nodes are deleted when it is cleaned) """
+    segments: dict[str, dict[tuple[int, int], Coord]] = dict()
+    for u, v, data in g.edges(data=True):
+        # osmnx gives a list of names when the simplified edge joins several ways
+        edge_names = data.get('name', [])
+        for name in edge_names if isinstance(edge_names, list) else [edge_names]:
+            segments.setdefault(name, dict())[(min(u, v), max(u, v))] = (
+                (g.nodes[u]['x']+g.nodes[v]['x'])/2, (g.nodes[u]['y']+g.nodes[v]['y'])/2)
+    names = sorted(segments)
+    numbers: dict[str, Coord] = dict()
+    for _, data in g.nodes(data=True):
+        if 'addr:street' in data and 'addr:housenumber' in data:
+            # "2-4" is the entrance of the numbers 2 and 4
+            for number in re.findall(r'\d+', str(data['addr:housenumber'])):
+                numbers[street_key(normalize(data['addr:street']))+' '+number] = (data['x'], data['y'])
+    return AddressIndex(names, [list(segments[name].values()) for name in names], numbers)
+
+
+def save_index(index: AddressIndex, filename: str) -> None:
+    with open(filename, 'w') as file:
+        json.dump({'names': index.names, 'points': index.points, 'numbers': index.numbers}, file)
+
+
+def load_index(filename: str) -> AddressIndex:
+    assert os.path.exists(filename)
+    with open(filename, 'r') as file:
+        data = json.load(file)
+    return AddressIndex(data['names'], [[tuple(p) for p in points] for points in data['points']],
+                        {key: tuple(p) for key, p in data['numbers'].items()})
+
+
+class GeocodeCache:
+    '''Answers of the geocoder by normalised address, the least recently used is dropped when there are more than size.
+    The whole cache is written to filename after every new answer, so it is kept between runs (and there are few)'''
+
+    def __init__(self, filename: str | None = CACHE_FILE, size: int = CACHE_SIZE) -> None:
+        self.filename = filename
+        self.size = size
+        self._entries: OrderedDict[str, Coord] = OrderedDict()
+        self._lock = threading.Lock()  # the searches run in background threads
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'r') as file:
+                self._entries.update((key, tuple(p)) for key, p in json.load(file))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Coord | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, location: Coord) -> None:
+        with self._lock:
+            self._entries[key] = location
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            if self.filename is not None:
+                # written aside and renamed so a crash never leaves half a file
+                with open(self.filename+'.tmp', 'w') as file:
+                    json.dump(list(self._entries.items()), file)
+                os.replace(self.filename+'.tmp', self.filename)
+
+
+@dataclass
+class Geocoder:
+    """ Finds the position of addresses: cache, offline index and, only if both fail, the remote geocoder """
+    index: AddressIndex | None  # None without the osmnx graph
+    cache: GeocodeCache
+    remote: Callable[[str], tuple[float, float]] | None = ox.geocode  # (lat, lon) of an address, None to work offline
+
+    def geocode(self, address: str) -> Coord | None:
+        """ Returns the position (lon, lat) of the address, None if it is not found """
+        key = normalize(address)
+        location = self.cache.get(key)
+        if location is not None:
+            metrics.count('cache_hits')
+            return location
+        if self.index is not None:
+            location = self.index.lookup(key)
+            if location is not None:
+                metrics.count('index_hits')
+                return location
+        if self.remote is None:
+            return None
+        with metrics.span('geocoding.remote'):
+            try:
+                lat, lon = self.remote(address)
+            except InsufficientResponseError:  # Nominatim found nothing
+                return None
+        self.cache.put(key, (lon, lat))
+        return (lon, lat)
@@ -0,0 +1,314 @@
+from dataclasses import dataclass
+from typing import TypeAlias
+import networkx as nx
+import numpy as np
+import routing
+import heapq
+import math
+import json
+import os
+
+
+Path: TypeAlias = list
+
+HIERARCHY_VERSION: int = 1  # change it when the saved arrays change
+HIERARCHY_ARRAYS: list[str] = ['rank', 'up_offsets', 'up_targets', 'up_weights', 'up_middle', 'down_offsets',
+                               'down_sources', 'down_weights', 'down_middle', 'stop_street', 'stop_out', 'stop_in']
+WITNESS_SETTLED: int = 500  # most nodes settled by a witness search, if it gives up the shortcut is added
+CORE_DEGREE: int = 60  # contraction stops when the next node has more edges than this, the nodes left are the core
+
+
+@dataclass
+class Hierarchy:
+    """ Contraction hierarchy of the streets of a compiled city graph (the walking graph). Street nodes are contracted one by one
+        (rank is the order), every edge is kept at its lower node: up edges go to higher nodes and down edges come from higher nodes.
+        Bus stops are not in the hierarchy, their edges to the streets are a small overlay so walks can start or end at a stop """
+    rank: np.ndarray  # int32, order in which each node was contracted (number of nodes for stops and the core)
+    up_offsets: np.ndarray  # int64 (nodes+1), the up edges of u are up_offsets[u]:up_offsets[u+1]
+    up_targets: np.ndarray  # int32, head of each up edge
+    up_weights: np.ndarray  # float64, time of each up edge
+    up_middle: np.ndarray  # int32, node contracted to create the shortcut (-1 for edges of the graph)
+    down_offsets: np.ndarray  # int64 (nodes+1), the down edges of v are down_offsets[v]:down_offsets[v+1]
+    down_sources: np.ndarray  # int32, tail of each down edge (the edge is source -> v)
+    down_weights: np.ndarray  # float64, time of each down edge
+    down_middle: np.ndarray  # int32, node contracted to create the shortcut (-1 for edges of the graph)
+    stop_street: np.ndarray  # int32, street node each bus stop is connected to (-1 for street nodes)
+    stop_out: np.ndarray  # float64, time of the edge stop -> street
+    stop_in: np.ndarray  # float64, time of the edge street -> stop
+
+    def number_of_nodes(self) -> int:
+        return len(self.rank)
+
+    def number_of_shortcuts(self) -> int:
+        return int(np.count_nonzero(self.up_middle >= 0)+np.count_nonzero(self.down_middle >= 0))
+
+    def unpack(self, nodes: list[int]) -> Path:
+        """ Returns the nodes of the graph the path of the hierarchy (nodes joined by up or down edges) stands for """
+        up_offsets, up_targets, up_middle = memoryview(self.up_offsets), memoryview(
+            self.up_targets), memoryview(self.up_middle)
+        down_offsets, down_sources, down_middle = memoryview(self.down_offsets), memoryview(
+            self.down_sources), memoryview(self.down_middle)
+
+        def middle(u: int, v: int) -> int:
+            """ Middle node of the edge u -> v of the hierarchy (-1 if it is an edge of the graph) """
+            for e in range(up_offsets[u], up_offsets[u+1]):
+                if up_targets[e] == v:
+                    return up_middle[e]
+            for e in range(down_offsets[v], down_offsets[v+1]):
+                if down_sources[e] == u:
+                    return down_middle[e]
+            assert False, 'No edge '+str(u)+' -> '+str(v)
+
+        path: Path = nodes[:1]
+        for u, v in zip(nodes, nodes[1:]):
+            stack: list[tuple[int, int]] = [(u, v)]
+            while stack:
+                a, b = stack.pop()
+                m = middle(a, b)
+                if m < 0:
+                    path.append(b)
+                else:
+                    # a -> m first, so it goes on top
+                    stack.append((m, b))
+                    stack.append((a, m))
+        return path
+
+
+def _witness_times(out_adj: list[dict[int, tuple[float, int]]], src: int, avoid: int, limit: float) -> dict[int, float]:
+    """ Times from src to the nodes closer than limit without going through avoid (at most WITNESS_SETTLED nodes) """
+    dist: dict[int, float] = dict()
+    best: dict[int, float] = {src: 0.0}
+    heap: list[tuple[float, int]] = [(0.0, src)]
+    while heap and len(dist) < WITNESS_SETTLED:
+        t, u = heapq.heappop(heap)
+        if t > limit:
+            break
+        if u in dist:
+            continue
+        dist[u] = t
+        for v, (w, _) in out_adj[u].items():
+            if v != avoid and t+w < best.get(v, math.inf):
+                best[v] = t+w
+                heapq.heappush(heap, (t+w, v))
+    return dist
+
+
+def _shortcuts(out_adj: list[dict[int, tuple[float, int]]], in_adj: list[dict[int, tuple[float, int]]], v: int) -> list[tuple[int, int, float]]:
+    """ Returns the shortcuts (u, w, time) needed to contract v: u -> v -> w when there is no path as short without v """
+    shortcuts: list[tuple[int, int, float]] = list()
+    for u, (w_uv, _) in in_adj[v].items():
+        targets = {w: w_uv+w_vw for w,
+                   (w_vw, _) in out_adj[v].items() if w != u}
+        if not targets:
+            continue
+        witness = _witness_times(out_adj, u, v, max(targets.values()))
+        shortcuts.extend((u, w, t) for w, t in targets.items()
+                         if witness.get(w, math.inf) > t)
+    return shortcuts
+
+
+def build_hierarchy(cg: routing.CompiledGraph) -> Hierarchy:
+    """ Contracts the street nodes of the compiled graph in order of edge difference (shortcuts added minus edges removed),
+        plus contracted neighbours and level so the hierarchy stays balanced. Priorities are checked again (lazily) before each contraction """
+    n: int = cg.number_of_nodes()
+    is_stop: list[bool] = np.asarray(cg.is_stop).tolist()
+    stop_street: list[int] = [-1]*n
+    stop_out: list[float] = [0.0]*n
+    stop_in: list[float] = [0.0]*n
+    # current graph: node -> {neighbour: (time, middle node)}, only the shortest of parallel edges is kept
+    out_adj: list[dict[int, tuple[float, int]]] = [dict() for _ in range(n)]
+    in_adj: list[dict[int, tuple[float, int]]] = [dict() for _ in range(n)]
+    for u, v, e in cg.edges():
+        w = float(cg.weights[e])
+        if is_stop[u] and not is_stop[v]:
+            stop_street[u], stop_out[u] = v, w
+        elif is_stop[v] and not is_stop[u]:
+            stop_in[v] = w
+        elif not is_stop[u] and u != v and w < out_adj[u].get(v, (math.inf, -1))[0]:
+            out_adj[u][v] = (w, -1)
+            in_adj[v][u] = (w, -1)
+
+    rank: list[int] = [n]*n
+    contracted_neighbours: list[int] = [0]*n
+    level: list[int] = [0]*n  # depth of the hierarchy below each node
+
+    def priority(v: int, shortcuts: list[tuple[int, int, float]]) -> int:
+        return len(shortcuts) - len(in_adj[v]) - len(out_adj[v]) + contracted_neighbours[v] + level[v]
+
+    up: list[list[tuple[int, float, int]]] = [list() for _ in range(n)]
+    down: list[list[tuple[int, float, int]]] = [list() for _ in range(n)]
+    heap: list[tuple[int, int]] = [(priority(v, _shortcuts(out_adj, in_adj, v)), v)
+                                   for v in range(n) if not is_stop[v]]
+    heapq.heapify(heap)
+    order: int = 0
+    while heap:
+        _, v = heapq.heappop(heap)
+        # lazy update: the priority may be outdated, if it is not the smallest anymore it goes back to the heap
+        shortcuts = _shortcuts(out_adj, in_adj, v)
+        p = priority(v, shortcuts)
+        if heap and p > heap[0][0]:
+            heapq.heappush(heap, (p, v))
+            continue
+        if len(in_adj[v])+len(out_adj[v]) > CORE_DEGREE:
+            break  # the graph left is small and dense, contracting it would add too many shortcuts
+        rank[v] = order
+        order += 1
+        # all the neighbours left are higher than v
+        up[v] = [(w, t, m) for w, (t, m) in out_adj[v].items()]
+        down[v] = [(u, t, m) for u, (t, m) in in_adj[v].items()]
+        for u in in_adj[v]:
+            del out_adj[u][v]
+            contracted_neighbours[u] += 1
+            level[u] = max(level[u], level[v]+1)
+        for w in out_adj[v]:
+            del in_adj[w][v]
+            contracted_neighbours[w] += 1
+            level[w] = max(level[w], level[v]+1)
+        out_adj[v], in_adj[v] = dict(), dict()
+        for u, w, t in shortcuts:
+            if t < out_adj[u].get(w, (math.inf, -1))[0]:
+                out_adj[u][w] = (t, v)
+                in_adj[w][u] = (t, v)
+
+    # Edges left are between the nodes of the core (if contraction stopped early), they are both up and down edges
+    for u in range(n):
+        if rank[u] == n and not is_stop[u]:
+            up[u] = [(w, t, m) for w, (t, m) in out_adj[u].items()]
+            down[u] = [(x, t, m) for x, (t, m) in in_adj[u].items()]
+
+    return Hierarchy(
+        rank=np.array(rank, dtype=np.int32),
+        up_offsets=np.cumsum([0]+[len(edges)
+                             for edges in up], dtype=np.int64),
+        up_targets=np.array([e[0] for edges in up for e in edges], dtype=np.int32),
+        up_weights=np.array([e[1] for edges in up for e in edges], dtype=np.float64),
+        up_middle=np.array([e[2] for edges in up for e in edges], dtype=np.int32),
+        down_offsets=np.cumsum([0]+[len(edges)
+                               for edges in down], dtype=np.int64),
+        down_sources=np.array([e[0] for edges in down for e in edges], dtype=np.int32),
+        down_weights=np.array([e[1] for edges in down for e in edges], dtype=np.float64),
+        down_middle=np.array([e[2] for edges in down for e in edges], dtype=np.int32),
+        stop_street=np.array(stop_street, dtype=np.int32),
+        stop_out=np.array(stop_out, dtype=np.float64),
+        stop_in=np.array(stop_in, dtype=np.float64),
+    )
+
+
+def patch_stops(h: Hierarchy, cg: routing.CompiledGraph) -> Hierarchy:
+    """ Returns the hierarchy of cg, a graph patched (routing.patch_graph) from the one h was built for where only bus stops changed.
+        The streets are the same nodes with the same indices (the first ones), so their contraction is kept and only the overlay of the stops is computed again """
+    n: int = cg.number_of_nodes()
+    is_stop = np.asarray(cg.is_stop)
+    streets: int = int(np.count_nonzero(~is_stop))
+    assert not is_stop[:streets].any(), 'The streets have to be the first nodes'
+
+    def extend(offsets: np.ndarray) -> np.ndarray:
+        # stops have no edges in the hierarchy
+        return np.concatenate([offsets[:streets+1], np.full(n-streets, offsets[streets], dtype=offsets.dtype)])
+
+    sources = np.repeat(np.arange(n), np.diff(cg.offsets))
+    stop_street = np.full(n, -1, dtype=np.int32)
+    stop_out = np.zeros(n, dtype=np.float64)
+    stop_in = np.zeros(n, dtype=np.float64)
+    out = is_stop[sources] & ~is_stop[cg.targets]
+    stop_street[sources[out]] = cg.targets[out]
+    stop_out[sources[out]] = cg.weights[out]
+    into = ~is_stop[sources] & is_stop[cg.targets]
+    stop_in[cg.targets[into]] = cg.weights[into]
+
+    rank = np.asarray(h.rank)[:streets]
+    # copied, the arrays of h can be memory-mapped from the files the new hierarchy is saved over
+    return Hierarchy(
+        rank=np.concatenate([np.where(rank == h.number_of_nodes(), n, rank), np.full(n-streets, n)]).astype(np.int32),
+        up_offsets=extend(np.asarray(h.up_offsets)), up_targets=np.array(h.up_targets),
+        up_weights=np.array(h.up_weights), up_middle=np.array(h.up_middle),
+        down_offsets=extend(np.asarray(h.down_offsets)), down_sources=np.array(h.down_sources),
+        down_weights=np.array(h.down_weights), down_middle=np.array(h.down_middle),
+        stop_street=stop_street, stop_out=stop_out, stop_in=stop_in)
+
+
+def save_hierarchy(h: Hierarchy, dirname: str, inputs_hash: str, prefix: str = 'ch_') -> None:
+    """ Saves the arrays of the hierarchy at dirname (next to the snapshot of the graph) and a meta file with the hash of the inputs of the graph """
+    os.makedirs(dirname, exist_ok=True)
+    meta_file = os.path.join(dirname, prefix+'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)  # if we stop while overwriting it the old hierarchy is not valid anymore
+    for name in HIERARCHY_ARRAYS:
+        np.save(os.path.join(dirname, prefix+name+'.npy'), getattr(h, name))
+    with open(meta_file, 'w') as file:
+        json.dump({'version': HIERARCHY_VERSION, 'inputs': inputs_hash,
+                   'nodes': h.number_of_nodes(), 'shortcuts': h.number_of_shortcuts()}, file)
+
+
+def load_hierarchy(dirname: str, inputs_hash: str, prefix: str = 'ch_') -> Hierarchy | None:
+    """ Loads (memory-mapped) the hierarchy saved at dirname, None if there is none or it was built for other inputs """
+    meta_file = os.path.join(dirname, prefix+'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as file:
+        meta = json.load(file)
+    if meta.get('version') != HIERARCHY_VERSION or meta.get('inputs') != inputs_hash:
+        return None
+    return Hierarchy(**{name: np.load(os.path.join(dirname, prefix+name+'.npy'), mmap_mode='r', allow_pickle=False)
+                        for name in HIERARCHY_ARRAYS})
+
+
+def query(h: Hierarchy, src: int, dst: int) -> tuple[float, Path]:
+    """ Walking time and path (nodes of the graph) from src to dst. Bidirectional search: forward from src on up edges and backward
+        from dst on down edges, each side stops when its next node is further than the best meeting found.
+        If src or dst are bus stops the walk starts or ends with their edge to the street (the overlay) """
+    if src == dst:
+        return 0.0, [src]
+    extra: float = 0.0  # time of the overlay edges
+    begin, end = src, dst
+    if h.stop_street[src] >= 0:
+        begin, extra = int(h.stop_street[src]), extra+float(h.stop_out[src])
+    if h.stop_street[dst] >= 0:
+        end, extra = int(h.stop_street[dst]), extra+float(h.stop_in[dst])
+
+    offsets = (memoryview(h.up_offsets), memoryview(h.down_offsets))
+    heads = (memoryview(h.up_targets), memoryview(h.down_sources))
+    weights = (memoryview(h.up_weights), memoryview(h.down_weights))
+    dist: tuple[dict[int, float], dict[int, float]] = ({begin: 0.0}, {end: 0.0})
+    pred: tuple[dict[int, int], dict[int, int]] = ({begin: -1}, {end: -1})
+    settled: tuple[set[int], set[int]] = (set(), set())
+    heaps: tuple[list[tuple[float, int]], list[tuple[float, int]]] = (
+        [(0.0, begin)], [(0.0, end)])
+    best, meet = (0.0, begin) if begin == end else (math.inf, -1)
+
+    while heaps[0] or heaps[1]:
+        # the direction with the closest node goes next
+        side = 0 if heaps[0] and (
+            not heaps[1] or heaps[0][0][0] <= heaps[1][0][0]) else 1
+        t, u = heapq.heappop(heaps[side])
+        if t >= best:
+            heaps[side].clear()
+            continue
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+        if u in dist[1-side] and t+dist[1-side][u] < best:
+            best, meet = t+dist[1-side][u], u
+        for e in range(offsets[side][u], offsets[side][u+1]):
+            v = heads[side][e]
+            new_t = t+weights[side][e]
+            if new_t < dist[side].get(v, math.inf):
+                dist[side][v] = new_t
+                pred[side][v] = u
+                heapq.heappush(heaps[side], (new_t, v))
+
+    if meet < 0:
+        raise nx.NetworkXNoPath('No walk between '+str(src)+' and '+str(dst))
+    # edges of the hierarchy from begin to meet and from meet to end, unpacked into edges of the graph
+    forward: list[int] = [meet]
+    while pred[0][forward[-1]] >= 0:
+        forward.append(pred[0][forward[-1]])
+    backward: list[int] = [meet]
+    while pred[1][backward[-1]] >= 0:
+        backward.append(pred[1][backward[-1]])
+    path: Path = h.unpack(forward[::-1]+backward[1:])
+    if src != begin:
+        path.insert(0, src)
+    if dst != end:
+        path.append(dst)
+    return extra+best, path
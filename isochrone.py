@@ -0,0 +1,143 @@
+""" Isochrones: everything that can be reached from a point within a time budget. One bounded search from the origin gives the street nodes
+    reached (and the time to each), a simplified polygon around them and every showing of the billboard at a reached cinema that starts after
+    arriving there. The results are streamed as the search expands (expand), the nearest cinemas come out before the search finishes.
+    The buses are taken with the fixed wait of the city graph (not the timetable), so the times do not depend on the time of departure.
+    From the command line, the showings that can be reached in 30 minutes from Plaça de Catalunya leaving now:
+        python isochrone.py 2.1700 41.3870 [--minutes 30] [--polygon isochrone.geojson] """
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Iterator
+import argparse
+import json
+import numpy as np
+import shapely
+import billboard
+import city
+import metrics
+import planner
+
+
+STREAM_NODES: int = 5000  # street nodes settled between two updates when no showing is found
+HULL_RATIO: float = 0.2  # of shapely.concave_hull: 0 follows the nodes the most, 1 is the convex hull
+SIMPLIFY_METERS: float = 25  # tolerance of the simplification of the polygon
+METERS_PER_DEGREE: float = 111320  # of latitude, the tolerance is converted with it (enough to simplify)
+
+
+@dataclass
+class Update:
+    """ What the search found since the previous update """
+    time: float  # seconds, every node closer to the origin has been found
+    nodes: dict[Any, float]  # street nodes settled -> travel time from the origin
+    pred: dict[Any, Any]  # every node settled (bus stops too) -> previous node, city.path_from rebuilds the paths
+    showings: list[tuple[billboard.Projection, float]]  # projections that can be reached in time, with the travel time to their cinema
+
+
+@dataclass
+class Isochrone:
+    nodes: dict[Any, float]  # street nodes reached within the budget -> travel time
+    pred: dict[Any, Any]  # every node reached -> previous node in the path from the origin
+    showings: list[tuple[billboard.Projection, float]]  # sorted by start time
+    polygon: shapely.Geometry  # simplified area of the street nodes reached (lon, lat)
+
+
+def _is_street(g: city.CityGraph | city.CompiledGraph, u: Any) -> bool:
+    if isinstance(g, city.CompiledGraph):
+        return not g.is_stop[u]
+    return not isinstance(u, str)  # bus stops are the only nodes with str ids
+
+
+def expand(g: city.CityGraph | city.CompiledGraph, src: Any, budget: float, now: int, projections: list[billboard.Projection],
+           cinema_node: dict[str, Any] | None = None) -> Iterator[Update]:
+    """ Runs one search from the street node src up to budget seconds, leaving at now (seconds from 00:00), and yields what it finds on the way:
+        an update as soon as a cinema is reached (with its projections that start after arriving) and every STREAM_NODES street nodes.
+        cinema_node has the node of every cinema of the projections (planner.cinema_nodes), they are snapped to the graph if not given """
+    if cinema_node is None:
+        cinema_node = planner.cinema_nodes(
+            g, list({projection.cinema.name for projection in projections}))
+    # projections at each cinema node, several cinemas can be snapped to the same node
+    at_node: dict[Any, list[billboard.Projection]] = dict()
+    for projection in projections:
+        at_node.setdefault(
+            cinema_node[projection.cinema.name], list()).append(projection)
+
+    nodes: dict[Any, float] = dict()
+    pred: dict[Any, Any] = dict()
+    showings: list[tuple[billboard.Projection, float]] = list()
+    for u, t, previous in city.settle(g, src, budget):
+        pred[u] = previous
+        if _is_street(g, u):
+            nodes[u] = t
+        if u in at_node:
+            showings.extend((projection, t) for projection in at_node.pop(u)
+                            if now + t <= billboard.get_time_in_seconds(projection.time))
+        if showings or len(nodes) >= STREAM_NODES:
+            yield Update(t, nodes, pred, showings)
+            nodes, pred, showings = dict(), dict(), list()
+    yield Update(budget, nodes, pred, showings)
+
+
+def polygon(g: city.CityGraph | city.CompiledGraph, nodes: list[Any]) -> shapely.Geometry:
+    """ Returns the simplified concave hull of the nodes (lon, lat). With less than 3 nodes it is a point or a line """
+    if isinstance(g, city.CompiledGraph):
+        points = np.column_stack([g.x[nodes], g.y[nodes]])
+    else:
+        points = np.array([(g.nodes[u]['x'], g.nodes[u]['y'])
+                          for u in nodes]).reshape(-1, 2)
+    hull = shapely.concave_hull(shapely.MultiPoint(points), HULL_RATIO)
+    return hull.simplify(SIMPLIFY_METERS / METERS_PER_DEGREE)
+
+
+@metrics.timed('isochrone.isochrone')
+def isochrone(g: city.CityGraph | city.CompiledGraph, src: Any, budget: float, now: int, projections: list[billboard.Projection],
+              cinema_node: dict[str, Any] | None = None) -> Isochrone:
+    """ Returns everything expand finds, once the search has finished, with the polygon of the street nodes reached """
+    result = Isochrone(dict(), dict(), list(), shapely.Polygon())
+    for update in expand(g, src, budget, now, projections, cinema_node):
+        result.nodes.update(update.nodes)
+        result.pred.update(update.pred)
+        result.showings.extend(update.showings)
+    result.showings.sort(
+        key=lambda showing: billboard.get_time_in_seconds(showing[0].time))
+    result.polygon = polygon(g, list(result.nodes))
+    metrics.count('nodes', len(result.nodes))
+    metrics.count('showings', len(result.showings))
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Showings that can be reached from a point within some minutes")
+    parser.add_argument('lon', type=float)
+    parser.add_argument('lat', type=float)
+    parser.add_argument('--minutes', type=float, default=30, help="time budget of the trip")
+    parser.add_argument('--now', help="time of departure HH:MM, now by default")
+    parser.add_argument('--polygon', help="GeoJSON file where the area reached is written")
+    args = parser.parse_args()
+
+    if args.now is not None:
+        now: int = billboard.get_time_in_seconds(
+            (int(args.now[:2]), int(args.now[3:5])))
+    else:
+        current = datetime.now()
+        now = current.hour*3600 + current.minute*60 + current.second
+    city_planner = planner.load_planner()
+    g = city_planner.graph
+    src = city.nearest_nodes(g, [args.lon], [args.lat])[0]
+
+    reached: dict[Any, float] = dict()
+    found: int = 0
+    for update in expand(g, src, args.minutes*60, now, billboard.read().projections):
+        reached.update(update.nodes)
+        for projection, travel in update.showings:
+            found += 1
+            print(f"{projection.film.title} ({projection.language}) at {projection.cinema.name} "
+                  f"{projection.time[0]:02d}:{projection.time[1]:02d}, {travel/60:.0f} min away")
+    print(f"{found} showings, {len(reached)} street nodes reached in {args.minutes:g} minutes")
+    if args.polygon is not None:
+        with open(args.polygon, 'w') as file:
+            json.dump({'type': 'Feature', 'properties': {'minutes': args.minutes},
+                       'geometry': shapely.geometry.mapping(polygon(g, list(reached)))}, file)
+
+
+if __name__ == "__main__":
+    main()
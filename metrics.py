@@ -0,0 +1,172 @@
+""" Timing spans and counters of the pipeline (building the graphs, billboard, routing queries, rendering) to know where the time goes.
+    A span measures a named block of code, and the counters (nodes settled, pages fetched, tiles fetched...) are added to the innermost open span
+    of the thread. Finished spans are added up by name, prometheus() returns the totals in the Prometheus text format, and if a log file is
+    configured every span is also written to it as one line of JSON. Spans opened with profile=True (whole queries) can be run under cProfile,
+    one .prof file each (python -m pstats file.prof to read it). Nothing is written unless configure is called """
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+
+PREFIX: str = "cinema"  # of the names of the Prometheus metrics
+
+
+@dataclass
+class Span:
+    """ A block of code being measured """
+    name: str
+    labels: dict[str, Any]  # written to the log with the span
+    start: float  # time.time() when it was opened
+    counters: dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class Totals:
+    """ Sum of all the finished spans with the same name """
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    counters: dict[str, float] = field(default_factory=dict)
+
+    def add(self, other: 'Totals') -> None:
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+_totals: dict[str, Totals] = dict()  # span name -> totals
+_lock = threading.Lock()  # of _totals and the log file
+_local = threading.local()  # .stack is the list of open spans of the thread
+_log_file: str | None = None  # JSON lines, one per finished span
+_profile_dir: str | None = None  # .prof files of the spans opened with profile=True
+_profiling: bool = False  # only one profiler can be enabled at the same time in the process
+
+
+def configure(log_file: str | None = None, profile_dir: str | None = None) -> None:
+    """ Writes every finished span to log_file (appended) and the cProfile stats of the spans opened with profile=True to profile_dir. None disables them """
+    global _log_file, _profile_dir
+    _log_file, _profile_dir = log_file, profile_dir
+
+
+def settings() -> tuple[str | None, str | None]:
+    """ Returns the arguments of configure, to configure the worker processes the same way """
+    return _log_file, _profile_dir
+
+
+def _stack() -> list[Span]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = list()
+    return _local.stack
+
+
+@contextmanager
+def span(name: str, profile: bool = False, **labels: Any) -> Iterator[Span]:
+    """ Measures the block as the span name, labels are only written to the log. With profile=True and a profile_dir configured
+        the block runs under cProfile, unless another span is already being profiled """
+    global _profiling
+    profiler: cProfile.Profile | None = None
+    if profile and _profile_dir is not None:
+        with _lock:
+            if not _profiling:
+                _profiling = True
+                profiler = cProfile.Profile()
+    current = Span(name, labels, time.time())
+    stack = _stack()
+    stack.append(current)
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield current
+    except BaseException as error:
+        current.labels['error'] = type(error).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            assert _profile_dir is not None
+            os.makedirs(_profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(
+                _profile_dir, f"{name}-{os.getpid()}-{time.time_ns()}.prof"))
+            _profiling = False
+        stack.pop()
+        _finish(current, seconds, stack[-1].name if stack else None)
+
+
+def timed(name: str, profile: bool = False) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """ Decorator: every call of the function is a span """
+    def decorator(function: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, profile):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1) -> None:
+    """ Adds value to the counter name of the innermost open span of the thread (nothing if there is none) """
+    stack = _stack()
+    if stack:
+        stack[-1].counters[name] = stack[-1].counters.get(name, 0) + value
+
+
+def _finish(current: Span, seconds: float, parent: str | None) -> None:
+    with _lock:
+        totals = _totals.setdefault(current.name, Totals())
+        totals.add(Totals(1, seconds, seconds, current.counters))
+        if _log_file is not None:
+            with open(_log_file, 'a') as file:
+                file.write(json.dumps({'span': current.name, 'start': current.start, 'seconds': seconds, 'parent': parent,
+                                       'pid': os.getpid(), 'thread': threading.current_thread().name,
+                                       'counters': current.counters, 'labels': current.labels}, default=str)+'\n')
+
+
+def totals() -> dict[str, Totals]:
+    """ Returns a copy of the totals of the finished spans by name """
+    with _lock:
+        return {name: Totals(t.calls, t.seconds, t.max_seconds, dict(t.counters)) for name, t in _totals.items()}
+
+
+def take() -> dict[str, Totals]:
+    """ Returns the totals and starts them again, so a worker process can send them to the one that merges them """
+    global _totals
+    with _lock:
+        taken, _totals = _totals, dict()
+    return taken
+
+
+def merge(other: dict[str, Totals]) -> None:
+    """ Adds the totals of another process (take) to the ones of this one """
+    with _lock:
+        for name, t in other.items():
+            _totals.setdefault(name, Totals()).add(t)
+
+
+def prometheus() -> str:
+    """ Returns the totals in the Prometheus text exposition format """
+    def label(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+    current = totals()
+    lines: list[str] = list()
+    for metric, kind, help, value in [('span_calls_total', 'counter', 'Finished spans', lambda t: t.calls),
+                                      ('span_seconds_total', 'counter', 'Seconds spent in the spans', lambda t: t.seconds),
+                                      ('span_seconds_max', 'gauge', 'Longest span', lambda t: t.max_seconds)]:
+        lines.append(f"# HELP {PREFIX}_{metric} {help}")
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        lines.extend(f'{PREFIX}_{metric}{{span="{label(name)}"}} {value(t)}' for name, t in sorted(current.items()))
+    lines.append(f"# HELP {PREFIX}_span_counter_total Counters of the spans (nodes settled, pages fetched...)")
+    lines.append(f"# TYPE {PREFIX}_span_counter_total counter")
+    lines.extend(f'{PREFIX}_span_counter_total{{span="{label(name)}",counter="{label(counter)}"}} {value}'
+                 for name, t in sorted(current.items()) for counter, value in sorted(t.counters.items()))
+    return '\n'.join(lines)+'\n'
@@ -0,0 +1,204 @@
+""" Loads everything needed to go to a projection (city graph, cinema tables and timetable) and chooses the first projection the user can arrive to.
+    It has no interface, the app (demo.py) and the batch planner (batch.py) use it the same way.
+    From the command line it only builds (and saves) what is missing, the contraction hierarchy of the streets too with --hierarchy:
+        python planner.py [--hierarchy] """
+from dataclasses import dataclass
+from typing import Any, Callable
+import billboard
+import buses
+import city
+import geocoding
+import routecache
+import transit
+import metrics
+import argparse
+import math
+import os
+
+
+CITY_INPUTS: list[str] = ["busRoutes.json",
+                          "busStops.json", "barcelona.pickle"]  # files the city graph is built from
+STREET_INPUTS: list[str] = ["barcelona.pickle"]  # files the streets of the city graph are built from
+SNAPSHOT_DIR: str = "barcelona_city"
+CINEMA_TABLES_FILE: str = "barcelona_cinemas.npy"
+TIMETABLE_FILE: str = "barcelona_timetable.npz"
+
+
+@dataclass
+class Planner:
+    """ What is needed to plan the trips: the graph and, if available, the precomputed tables or the timetable of the buses """
+    graph: city.CompiledGraph  # compiled city graph
+    tables: city.CinemaTables | None  # travel time from every node to every cinema
+    timetable: transit.Timetable | None  # frequencies of the lines, None without frequencies file
+    routes: routecache.RouteCache | None = None  # routes already found in this version of the graph, None to always search
+
+
+@metrics.timed('planner.load_planner')
+def load_planner(get_bus_graph: Callable[[], buses.BusesGraph] = buses.get_buses_graph, build_hierarchy: bool = False) -> Planner:
+    """ Loads the city graph snapshot, the cinema tables and the timetable, building (and saving) the ones that are missing or belong to other inputs.
+        If only some bus lines changed since the snapshot was saved, only they are replaced in it (see _update_snapshot).
+        get_bus_graph is only called if the city graph has to be built or updated. With build_hierarchy the contraction hierarchy of the streets
+        is built (and saved with the snapshot) if the snapshot has none, walking_path uses it afterwards """
+    if not os.path.exists("barcelona.pickle"):
+        city.save_osmnx_graph(city.get_osmnx_graph(), "barcelona.pickle")
+
+    # If the snapshot was built from the same bus json files and osmnx graph we load it, otherwise we build it again
+    inputs: str = city.inputs_hash(CITY_INPUTS)
+    g = city.load_city_snapshot(SNAPSHOT_DIR, inputs)
+    if g is None:
+        bus_g = get_bus_graph()
+        streets: str = city.inputs_hash(STREET_INPUTS)
+        g = _update_snapshot(bus_g, streets)
+        if g is None:
+            ox_g = city.load_osmnx_graph("barcelona.pickle")
+            # We only keep the compiled version of the graph, it is faster to search and lighter
+            g = city.compile_city_graph(city.build_city_graph(ox_g, bus_g))
+        city.save_city_snapshot(g, SNAPSHOT_DIR, inputs,
+                                streets, bus_g.graph.get('hashes'))
+
+    # Built on the graph of the snapshot, the node indices of the hierarchy are the ones of the saved graph
+    if build_hierarchy and g._hierarchy is None:
+        city.build_city_hierarchy(g, SNAPSHOT_DIR, inputs)
+
+    # Travel times from every node to every cinema, only rebuilt if they do not belong to this graph
+    tables: city.CinemaTables | None = None
+    if os.path.exists(CINEMA_TABLES_FILE):
+        tables = city.load_cinema_tables(CINEMA_TABLES_FILE)
+        if tables.version != inputs:
+            tables = None
+    if tables is None:
+        tables = city.build_cinema_tables(
+            g, billboard.cinemas_location, CINEMA_TABLES_FILE, inputs)
+
+    # With the frequencies of the lines the buses are taken when they really pass instead of waiting always 3 minutes
+    timetable: transit.Timetable | None = None
+    if os.path.exists(transit.FREQUENCIES_FILE):
+        version: str = city.inputs_hash(
+            CITY_INPUTS + [transit.FREQUENCIES_FILE])
+        timetable = transit.load_timetable(TIMETABLE_FILE, version)
+        if timetable is None:
+            network = buses.create_Bus_Network("busNetwork.npz")
+            timetable = transit.build_timetable(g, network, transit.load_frequencies(
+                transit.FREQUENCIES_FILE, network))
+            transit.save_timetable(timetable, TIMETABLE_FILE, version)
+
+    # The routes are kept by the hash of the inputs, the ones of an older graph are deleted
+    return Planner(g, tables, timetable, routecache.RouteCache(inputs))
+
+
+def _update_snapshot(bus_g: buses.BusesGraph, streets: str) -> city.CompiledGraph | None:
+    """ If the saved snapshot was built from the same streets, returns it with only the bus lines that changed since then replaced by the ones of bus_g
+        (city.update_city_graph). Returns None if it has to be built from scratch """
+    saved = city.load_snapshot_lines(SNAPSHOT_DIR)
+    if saved is None or saved[1] != streets or 'hashes' not in bus_g.graph:
+        return None
+    g = city.load_city_snapshot(SNAPSHOT_DIR, saved[0])
+    if g is None:
+        return None
+    removed, added = buses.changed_lines(saved[2], bus_g.graph['hashes'])
+    return city.update_city_graph(g, bus_g, removed, added)
+
+
+@metrics.timed('planner.load_geocoder')
+def load_geocoder() -> geocoding.Geocoder:
+    """ Loads the geocoder with its cache and the offline index of the streets. The index is taken from the osmnx graph the first time
+        and saved apart, it is much lighter to load. Without it (no graph, or one saved before it was indexed) every new address goes to Nominatim """
+    index: geocoding.AddressIndex | None = None
+    if os.path.exists(geocoding.INDEX_FILE):
+        index = geocoding.load_index(geocoding.INDEX_FILE)
+    elif os.path.exists("barcelona.pickle"):
+        index = city.load_osmnx_graph("barcelona.pickle").graph.get('addresses')
+        if index is not None:
+            geocoding.save_index(index, geocoding.INDEX_FILE)
+    return geocoding.Geocoder(index, geocoding.GeocodeCache())
+
+
+def cinema_nodes(g: city.CityGraph | city.CompiledGraph, names: list[str]) -> dict[str, Any]:
+    """ Snaps every cinema (by name) to its nearest street node at once """
+    nodes = city.nearest_nodes(g, [billboard.cinemas_location[name][0] for name in names], [
+                               billboard.cinemas_location[name][1] for name in names])
+    return dict(zip(names, nodes))
+
+
+@metrics.timed('planner.closest_projection', profile=True)
+def closest_projection(planner: Planner, candidates: list[billboard.Projection], cinema_node: dict[str, Any], user_node: Any, now: int) -> tuple[billboard.Projection | None, float, city.Path]:
+    """ Returns the first of the candidates (projections sorted by start time) the user at user_node can arrive to in time leaving at now (seconds from 00:00),
+        the travel time and the path to its cinema. All the candidates are checked against one single search from the user.
+        cinema_node has the node of every cinema of the candidates (cinema_nodes). If none can be reached returns (None, inf, []) """
+    if not candidates:
+        return None, math.inf, []
+    g = planner.graph
+
+    # With the timetable one search gives the earliest arrival at every cinema taking the buses when they pass.
+    # It depends on the time of departure, so these routes are not cached
+    if planner.timetable is not None:
+        search = transit.earliest_arrival(g, planner.timetable, user_node, now, {cinema_node[projection.cinema.name] for projection in candidates},
+                                          billboard.get_time_in_seconds(candidates[-1].time) - now)
+        for projection in candidates:
+            node = cinema_node[projection.cinema.name]
+            if node in search.arrival and search.arrival[node] <= billboard.get_time_in_seconds(projection.time):
+                return projection, search.arrival[node] - now, transit.journey_path(g, planner.timetable, search, node)
+        return None, math.inf, []
+
+    # With the precomputed tables checking a projection is just a lookup, we only search for the path of the chosen one
+    if planner.tables is not None:
+        for projection in candidates:
+            travel: float = planner.tables.time_to(
+                user_node, projection.cinema.name)
+            if now+travel <= billboard.get_time_in_seconds(projection.time):
+                node = cinema_node[projection.cinema.name]
+                route = planner.routes.get(user_node, node) if planner.routes is not None else None
+                if route is None:
+                    route = _search(planner, user_node, {node}).get(node, (math.inf, []))
+                return projection, travel, route[1]
+        return None, math.inf, []
+
+    # The routes found before (without buses timetable they do not depend on the time) are checked first, in the order of the projections.
+    # Only when a cinema is not in the cache there is a search
+    if planner.routes is not None:
+        for projection in candidates:
+            route = planner.routes.get(
+                user_node, cinema_node[projection.cinema.name])
+            if route is None:
+                break
+            if now+route[0] <= billboard.get_time_in_seconds(projection.time):
+                return projection, route[0], route[1]
+        else:
+            return None, math.inf, []
+
+    # One search from the user that stops when all the cinemas are settled or the last projection has already started
+    budget: int = billboard.get_time_in_seconds(candidates[-1].time) - now
+    routes = _search(planner, user_node, {
+                     cinema_node[projection.cinema.name] for projection in candidates}, budget)
+    for projection in candidates:
+        node = cinema_node[projection.cinema.name]
+        # If you can arrive in time return since projections are ordered
+        if node in routes and now+routes[node][0] <= billboard.get_time_in_seconds(projection.time):
+            return projection, routes[node][0], routes[node][1]
+    return None, math.inf, []
+
+
+def _search(planner: Planner, user_node: Any, targets: set[Any], budget: float = math.inf) -> dict[Any, routecache.Route]:
+    """ Returns the route to every target reached within budget seconds with one search, and adds them to the route cache """
+    times, pred = city.shortest_times(planner.graph, user_node, targets, budget)
+    routes: dict[Any, routecache.Route] = {node: (times[node], city.path_from(pred, node))
+                                           for node in targets if node in times}
+    if planner.routes is not None:
+        for node, route in routes.items():
+            planner.routes.put(user_node, node, route)
+    return routes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Builds (and saves) the city graph, the cinema tables and the timetable if they are missing or outdated")
+    parser.add_argument('--hierarchy', action='store_true',
+                        help="also build the contraction hierarchy of the streets, it speeds up the walking paths")
+    args = parser.parse_args()
+    city_planner = load_planner(build_hierarchy=args.hierarchy)
+    print(f"{city_planner.graph.number_of_nodes()} nodes, {city_planner.graph.number_of_edges()} edges, "
+          f"hierarchy: {'yes' if city_planner.graph._hierarchy is not None else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
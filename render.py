@@ -0,0 +1,232 @@
+""" Draws the graphs over the OpenStreetMap tiles, like staticmap but made to be fast when the same map is drawn many times:
+    the tiles are kept in a local directory (rendering works offline if they were downloaded before), the static layers (the whole
+    city, all the bus lines) are drawn once and kept in memory, and the paths are drawn over a crop of them. Images are returned, never reopened from disk """
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
+from typing import TypeAlias, Any, Callable
+from PIL import Image, ImageColor, ImageDraw
+import numpy as np
+import requests
+import metrics
+import os
+import time
+
+
+Coord: TypeAlias = tuple[float, float]   # (longitude, latitude)
+
+TILE_URL: str = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+TILE_SIZE: int = 256
+TILE_CACHE_DIR: str = "tiles"  # tiles/z/x/y.png, copy it to render without internet
+MAP_SIZE: int = 3500  # width and height of the maps of the whole graphs
+MAX_ZOOM: int = 17
+BACKGROUND: str = "#fff"  # color of the tiles that could not be downloaded
+RETRY_DOWNLOADS: float = 60  # seconds without downloading tiles after a download fails
+UNPAINTED: int = 255  # label of the pixels not painted by a Raster (so it uses at most 255 colors)
+
+_offline_until: float = 0  # time.monotonic() until which no tile is downloaded
+
+
+@dataclass(frozen=True)
+class View:
+    """ Part of the world shown in an image: its zoom and the world pixel of its top left corner """
+    zoom: int
+    left: float  # world pixel x (at this zoom) of the left border
+    top: float  # world pixel y (at this zoom) of the top border
+    width: int  # size of the image in pixels
+    height: int
+
+    def to_pixels(self, lons: Any, lats: Any) -> tuple[np.ndarray, np.ndarray]:
+        """ Web Mercator projection of the points to pixels of the image (arrays or single values) """
+        scale = TILE_SIZE * 2**self.zoom
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        x = (np.asarray(lons, dtype=np.float64) + 180) / 360 * scale
+        y = (1 - np.log(np.tan(lats) + 1/np.cos(lats)) / np.pi) / 2 * scale
+        return x - self.left, y - self.top
+
+    def crop(self, left: int, top: int, width: int, height: int) -> 'View':
+        """ View of the part of this image with the top left corner at the pixel (left, top) """
+        return View(self.zoom, self.left+left, self.top+top, width, height)
+
+
+def view_of(lons: Any, lats: Any, width: int = MAP_SIZE, height: int = MAP_SIZE, padding: int = 20) -> View:
+    """ Returns the view with the highest zoom that shows all the points, centered on them """
+    for zoom in range(MAX_ZOOM, -1, -1):
+        x, y = View(zoom, 0, 0, width, height).to_pixels(lons, lats)
+        if x.max()-x.min() <= width-2*padding and y.max()-y.min() <= height-2*padding:
+            break
+    return View(zoom, round((x.min()+x.max()-width)/2), round((y.min()+y.max()-height)/2), width, height)
+
+
+def tile(zoom: int, x: int, y: int) -> Image.Image:
+    """ Returns the tile from the local cache, downloading (and saving) it the first time. If it can not be downloaded an empty tile is returned """
+    global _offline_until
+    filename = os.path.join(TILE_CACHE_DIR, str(zoom), str(x), str(y)+'.png')
+    if not os.path.exists(filename):
+        if time.monotonic() < _offline_until:
+            metrics.count('skipped')
+            return Image.new('RGB', (TILE_SIZE, TILE_SIZE), BACKGROUND)
+        try:
+            response = requests.get(TILE_URL.format(z=zoom, x=x, y=y),
+                                    headers={"User-Agent": "StaticMap"}, timeout=10)
+            response.raise_for_status()
+        except requests.RequestException:
+            # without internet the rest of the missing tiles would fail too
+            _offline_until = time.monotonic() + RETRY_DOWNLOADS
+            metrics.count('failed')
+            return Image.new('RGB', (TILE_SIZE, TILE_SIZE), BACKGROUND)
+        metrics.count('fetched')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as file:
+            file.write(response.content)
+        return Image.open(BytesIO(response.content)).convert('RGB')
+    metrics.count('cached')
+    return Image.open(filename).convert('RGB')
+
+
+def _tile_span(zoom: int, x: int, y: int) -> Image.Image:
+    """ tile measured as a span of its own (it runs in the threads of base_map) """
+    with metrics.span('render.tile', zoom=zoom, x=x, y=y):
+        return tile(zoom, x, y)
+
+
+@lru_cache(maxsize=4)
+@metrics.timed('render.base_map')
+def base_map(view: View) -> Image.Image:
+    """ Returns the map of the view assembled from the tiles (kept in memory, copy it before drawing on it) """
+    image = Image.new('RGB', (view.width, view.height), BACKGROUND)
+    tiles = [(x, y) for x in range(int(view.left // TILE_SIZE), int((view.left+view.width) // TILE_SIZE)+1)
+             for y in range(int(view.top // TILE_SIZE), int((view.top+view.height) // TILE_SIZE)+1)]
+    # only the missing tiles are downloaded, the threads just wait for the server
+    with ThreadPoolExecutor(4) as pool:
+        images = pool.map(lambda t: _tile_span(view.zoom, t[0] % 2**view.zoom, t[1] % 2**view.zoom), tiles)
+        for (x, y), tile_image in zip(tiles, images):
+            image.paste(tile_image, (round(x*TILE_SIZE-view.left), round(y*TILE_SIZE-view.top)))
+    metrics.count('tiles', len(tiles))
+    return image
+
+
+def cached_layer(cache: dict[str, Any], name: str, view: View, draw: Callable[[Image.Image, View], None]) -> Image.Image:
+    """ Returns the base map of the view with draw(image, view) done on it. It is drawn only the first time, then kept in cache (a dict of the graph) under name.
+        The returned image is shared, copy or crop it before drawing on it """
+    if name not in cache or cache[name][0] != view:
+        image = base_map(view).copy()
+        draw(image, view)
+        cache[name] = (view, image)
+    return cache[name][1]
+
+
+def crop(image: Image.Image, view: View, lons: Any, lats: Any, margin: int = 100) -> tuple[Image.Image, View]:
+    """ Returns the part of the image (a new one) around the points with a margin in pixels, and its view """
+    x, y = view.to_pixels(lons, lats)
+    left, top = max(0, int(x.min())-margin), max(0, int(y.min())-margin)
+    right = min(view.width, int(x.max())+margin)
+    bottom = min(view.height, int(y.max())+margin)
+    return image.crop((left, top, right, bottom)), view.crop(left, top, right-left, bottom-top)
+
+
+def draw_lines(image: Image.Image, view: View, lines: list[tuple[list[Coord], str, int]]) -> None:
+    """ Draws the lines (route, color, width) on the image """
+    draw = ImageDraw.Draw(image)
+    for route, color, width in lines:
+        x, y = view.to_pixels([p[0] for p in route], [p[1] for p in route])
+        draw.line(list(zip(x.tolist(), y.tolist())), fill=color, width=width, joint='curve')
+
+
+def draw_circles(image: Image.Image, view: View, circles: list[tuple[Coord, str, int]]) -> None:
+    """ Draws the circles (center, color, width) on the image, width is the diameter like in stm.CircleMarker """
+    draw = ImageDraw.Draw(image)
+    for (lon, lat), color, width in circles:
+        x, y = view.to_pixels(lon, lat)
+        radius = width/2
+        draw.ellipse((float(x)-radius, float(y)-radius, float(x)+radius, float(y)+radius), fill=color)
+
+
+def flatten(routes: list[list[Coord]]) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the points of all the routes one after the other (points x 2) and the offsets (routes+1) where each one starts """
+    offsets = np.zeros(len(routes)+1, dtype=np.int64)
+    np.cumsum([len(route) for route in routes], out=offsets[1:])
+    points = np.array([p for route in routes for p in route],
+                      dtype=np.float64).reshape(-1, 2)
+    return points, offsets
+
+
+def palette_of(colors: list[str]) -> tuple[np.ndarray, list[str]]:
+    """ Returns the index of each color in the palette and the palette (different colors) """
+    palette, index = np.unique(np.array(colors, dtype=str), return_inverse=True)
+    return index, palette.tolist()
+
+
+def _disk(width: int) -> list[tuple[int, int]]:
+    """ Pixel offsets covered by a dot of this width (diameter) """
+    r = (width-1)/2
+    return [(dx, dy) for dx in range(-int(r), int(r)+1) for dy in range(-int(r), int(r)+1) if dx*dx+dy*dy <= r*r+r]
+
+
+class Raster:
+    """ Draws many routes and points at once: they are projected in one go, each segment is sampled every pixel, and the pixels are painted
+        with numpy in a label image (index in the palette). It is pasted on the image at the end, so there is no drawing call per route """
+
+    def __init__(self, view: View, palette: list[str]):
+        assert len(palette) < UNPAINTED, 'Too many colors'
+        self.view = view
+        self.palette = palette
+        self.label = np.full((view.height, view.width),
+                             UNPAINTED, dtype=np.uint8)
+
+    def _paint(self, x: np.ndarray, y: np.ndarray, colors: np.ndarray, width: int) -> None:
+        """ Paints the pixels (x, y) and the ones around them (width), later pixels are painted over the previous ones """
+        x, y = np.rint(x).astype(np.int64), np.rint(y).astype(np.int64)
+        for dx, dy in _disk(width):
+            px, py = x+dx, y+dy
+            inside = (px >= 0) & (px < self.view.width) & (
+                py >= 0) & (py < self.view.height)
+            self.label[py[inside], px[inside]] = colors[inside]
+
+    def routes(self, points: np.ndarray, offsets: np.ndarray, colors: np.ndarray, width: int) -> None:
+        """ Paints the routes: route i is points[offsets[i]:offsets[i+1]] (lon, lat) with color palette[colors[i]] """
+        if len(points) < 2:
+            return
+        x, y = self.view.to_pixels(points[:, 0], points[:, 1])
+        # segment i goes from point i to point i+1, except from the last point of a route
+        route = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+        starts = np.flatnonzero(route[:-1] == route[1:])
+        x0, y0, x1, y1 = x[starts], y[starts], x[starts+1], y[starts+1]
+
+        # one sample per pixel of each segment (and both ends)
+        samples = np.ceil(np.maximum(np.abs(x1-x0), np.abs(y1-y0))
+                          ).astype(np.int64) + 1
+        first = np.repeat(np.cumsum(samples)-samples, samples)
+        t = (np.arange(samples.sum()) - first) / \
+            np.repeat(np.maximum(samples-1, 1), samples)
+        segment = np.repeat(np.arange(len(starts)), samples)
+        self._paint(x0[segment] + t*(x1-x0)[segment], y0[segment] + t*(y1-y0)[segment],
+                    np.asarray(colors)[route[starts]][segment], width)
+
+    def points(self, points: np.ndarray, colors: np.ndarray, width: int) -> None:
+        """ Paints a dot of color palette[colors[i]] and diameter width at every point (lon, lat) """
+        if len(points) == 0:
+            return
+        x, y = self.view.to_pixels(points[:, 0], points[:, 1])
+        self._paint(x, y, np.asarray(colors), width)
+
+    def paste_on(self, image: Image.Image) -> None:
+        """ Pastes the painted pixels on the image (of the same view) """
+        layer = Image.fromarray(self.label, 'P')
+        layer.putpalette(
+            [c for color in self.palette for c in ImageColor.getrgb(color)[:3]])
+        image.paste(layer.convert(image.mode), mask=Image.fromarray(
+            ((self.label != UNPAINTED)*255).astype(np.uint8), 'L'))
+
+
+@lru_cache(maxsize=8)
+def _icon(filename: str) -> Image.Image:
+    return Image.open(filename).convert('RGBA')
+
+
+def draw_icon(image: Image.Image, view: View, pos: Coord, filename: str, offset_x: int, offset_y: int) -> None:
+    """ Pastes the image at filename with its pixel (offset_x, offset_y) at pos """
+    x, y = view.to_pixels(pos[0], pos[1])
+    icon = _icon(filename)
+    image.paste(icon, (round(float(x))-offset_x, round(float(y))-offset_y), icon)
@@ -0,0 +1,133 @@
+""" Cache of the routes (travel time and path) between two nodes of the city graph, so the users that leave from the same street to the same cinema
+    only cost one search. The routes are kept by (origin node, destination node, graph version): the version is the hash of the inputs of the graph
+    (planner.load_planner), so when the graph is rebuilt the routes of the old one are never used, and they are deleted from the file.
+    Each process keeps the most recently used routes in memory (bounded by routes and by nodes of the paths), and all the processes that open the
+    same file (the workers of batch and server, or several runs) share the routes through it (sqlite) """
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, TypeAlias
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+
+Route: TypeAlias = tuple[float, list[Any]]  # (travel time in seconds, nodes of the path)
+
+CACHE_FILE: str = "routes.sqlite"
+CACHE_ROUTES: int = 10000  # routes kept in the memory of each process
+CACHE_NODES: int = 1000000  # nodes of all the paths kept in the memory of each process
+SHARED_ROUTES: int = 200000  # routes kept in the file, the least recently used are deleted
+PRUNE_EVERY: int = 1000  # routes added to the file between two checks of its size
+
+
+@dataclass
+class Stats:
+    hits: int = 0  # found in the memory of the process
+    shared_hits: int = 0  # found in the file (added by another process or run)
+    misses: int = 0
+    evictions: int = 0  # dropped from the memory of the process
+
+
+class RouteCache:
+    '''Routes of one version of the graph by (origin, destination) node: least recently used first in memory, then the shared file.
+    The nodes are the ones of the graph (indices of a compiled graph), they only mean something in the same version of it'''
+
+    def __init__(self, version: str, filename: str | None = CACHE_FILE, routes: int = CACHE_ROUTES, nodes: int = CACHE_NODES,
+                 shared_routes: int = SHARED_ROUTES, invalidate: bool = True) -> None:
+        self.version = version
+        self.filename = filename
+        self.routes = routes
+        self.nodes = nodes
+        self.shared_routes = shared_routes
+        self._memory: OrderedDict[tuple[Any, Any], Route] = OrderedDict()
+        self._nodes: int = 0  # nodes of the paths in _memory
+        self._stats = Stats()
+        self._lock = threading.Lock()  # of _memory, _stats and the connection, the searches can run in threads
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int = -1  # process that opened the connection, a forked worker opens its own
+        self._added: int = 0  # routes added to the file since it was last pruned
+        if filename is not None and invalidate:
+            # the process that loads the graph deletes the routes of the other versions
+            with self._lock:
+                self._db().execute(
+                    "DELETE FROM routes WHERE version != ?", (version,))
+                self._db().commit()
+
+    def settings(self) -> tuple[str, str | None, int, int, int]:
+        """ Returns the arguments to open the same cache in a worker process (RouteCache(*settings, invalidate=False)) """
+        return self.version, self.filename, self.routes, self.nodes, self.shared_routes
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            assert self.filename is not None
+            self._connection = sqlite3.connect(
+                self.filename, timeout=30, check_same_thread=False)
+            # readers do not wait for the writer
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS routes (version TEXT, origin TEXT, destination TEXT, time REAL, path TEXT,
+                                        used REAL, PRIMARY KEY (version, origin, destination))""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS routes_used ON routes (used)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key: tuple[Any, Any], route: Route) -> None:
+        """ Keeps the route in memory, dropping the least recently used ones while there are too many routes or nodes """
+        if key in self._memory:
+            self._nodes -= len(self._memory.pop(key)[1])
+        self._memory[key] = route
+        self._nodes += len(route[1])
+        while len(self._memory) > self.routes or (self._nodes > self.nodes and len(self._memory) > 1):
+            _, dropped = self._memory.popitem(last=False)
+            self._nodes -= len(dropped[1])
+            self._stats.evictions += 1
+
+    def get(self, origin: Any, destination: Any) -> Route | None:
+        """ Returns the route from origin to destination if it is in the cache """
+        key = (origin, destination)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats.hits += 1
+                metrics.count('route_cache_hits')
+                return self._memory[key]
+            if self.filename is not None:
+                db = self._db()
+                row = db.execute("SELECT time, path FROM routes WHERE version = ? AND origin = ? AND destination = ?",
+                                 (self.version, json.dumps(origin), json.dumps(destination))).fetchone()
+                if row is not None:
+                    db.execute("UPDATE routes SET used = ? WHERE version = ? AND origin = ? AND destination = ?",
+                               (time.time(), self.version, json.dumps(origin), json.dumps(destination)))
+                    db.commit()
+                    route: Route = (row[0], json.loads(row[1]))
+                    self._remember(key, route)
+                    self._stats.shared_hits += 1
+                    metrics.count('route_cache_shared_hits')
+                    return route
+            self._stats.misses += 1
+            metrics.count('route_cache_misses')
+            return None
+
+    def put(self, origin: Any, destination: Any, route: Route) -> None:
+        """ Adds the route from origin to destination to the memory of the process and to the file """
+        with self._lock:
+            self._remember((origin, destination), route)
+            if self.filename is None:
+                return
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)", (self.version, json.dumps(origin), json.dumps(destination),
+                                                                                  route[0], json.dumps(route[1]), time.time()))
+            self._added += 1
+            if self._added >= PRUNE_EVERY:
+                self._added = 0
+                db.execute("""DELETE FROM routes WHERE rowid IN (SELECT rowid FROM routes ORDER BY used
+                              LIMIT max(0, (SELECT count(*) FROM routes) - ?))""", (self.shared_routes,))
+            db.commit()
+
+    def stats(self) -> Stats:
+        """ Returns the hits and misses of this process since the cache was opened """
+        with self._lock:
+            return Stats(self._stats.hits, self._stats.shared_hits, self._stats.misses, self._stats.evictions)
@@ -0,0 +1,360 @@
+from dataclasses import dataclass, field
+from typing import TypeAlias, Any, Iterator
+import networkx as nx
+import numpy as np
+import spatial
+import heapq
+import math
+import json
+import os
+
+
+Coord: TypeAlias = tuple[float, float]   # (longitude, latitude)
+Path: TypeAlias = list
+
+SNAPSHOT_VERSION: int = 2  # change it when the arrays saved in a snapshot change
+# arrays of CompiledGraph saved in a snapshot, one .npy file each
+SNAPSHOT_ARRAYS: list[str] = ['ids', 'is_stop', 'x', 'y', 'barcelona', 'node_color', 'offsets',
+                              'targets', 'weights', 'edge_color', 'geom_offsets', 'geom', 'colors']
+
+
+@dataclass
+class CompiledGraph:
+    """ Array (CSR) representation of the city graph. Nodes are identified by their index (int) instead of their original id """
+    ids: np.ndarray  # original id of each node as a string (osmid for streets, code-id for bus stops)
+    is_stop: np.ndarray  # bool, True if the node is a bus stop
+    x: np.ndarray  # float64, longitude of each node
+    y: np.ndarray  # float64, latitude of each node
+    barcelona: np.ndarray  # bool, True if the 'poblacio' of the node is Barcelona
+    node_color: np.ndarray  # int16, index in colors of the color of each node
+    offsets: np.ndarray  # int32 (nodes+1), the edges leaving u are offsets[u]:offsets[u+1]
+    targets: np.ndarray  # int32 (edges), destination of each edge
+    weights: np.ndarray  # float32 (edges), 'length' of each edge (seconds)
+    edge_color: np.ndarray  # int16, index in colors of the color of each edge
+    geom_offsets: np.ndarray  # int64 (edges+1), the route of edge e is geom[geom_offsets[e]:geom_offsets[e+1]]
+    geom: np.ndarray  # float64 (points, 2), routes of all the edges one after the other
+    colors: np.ndarray  # str, palette of colors used by nodes and edges
+    _index: dict[Any, int] | None = field(default=None, repr=False)
+    _reverse: tuple[np.ndarray, np.ndarray, np.ndarray] | None = field(
+        default=None, repr=False)
+    _spatial: spatial.GridIndex | None = field(default=None, repr=False)
+    # hierarchy.Hierarchy of the streets, attached by city when it is built or loaded
+    _hierarchy: Any = field(default=None, repr=False)
+    # images drawn by render (layers of the whole graph), kept while the graph is used
+    _images: dict[str, Any] = field(default_factory=dict, repr=False)
+
+    def number_of_nodes(self) -> int:
+        return len(self.x)
+
+    def number_of_edges(self) -> int:
+        return len(self.targets)
+
+    def node_id(self, u: int) -> Any:
+        """ Returns the id the node had in the networkx graph """
+        return str(self.ids[u]) if self.is_stop[u] else int(self.ids[u])
+
+    def index_of(self, node: Any) -> int:
+        """ Returns the index of the node with the given networkx id """
+        if self._index is None:
+            self._index = {self.node_id(u): u for u in range(
+                self.number_of_nodes())}
+        return self._index[node]
+
+    def edge(self, u: int, v: int) -> int:
+        """ Returns the index of the edge u->v """
+        begin, end = int(self.offsets[u]), int(self.offsets[u+1])
+        found = np.flatnonzero(self.targets[begin:end] == v)
+        assert len(found) > 0, 'No edge '+str(u)+' -> '+str(v)
+        return begin + int(found[0])
+
+    def edges(self) -> Iterator[tuple[int, int, int]]:
+        """ Iterates over the edges as (u, v, edge index) """
+        for u in range(self.number_of_nodes()):
+            for e in range(int(self.offsets[u]), int(self.offsets[u+1])):
+                yield u, int(self.targets[e]), e
+
+    def pos(self, u: int) -> Coord:
+        return (float(self.x[u]), float(self.y[u]))
+
+    def route(self, e: int) -> list[Coord]:
+        """ Returns the list of coordinates of the edge e """
+        return [tuple(p) for p in self.geom[self.geom_offsets[e]:self.geom_offsets[e+1]].tolist()]
+
+    def street_index(self) -> spatial.GridIndex:
+        """ Returns the spatial index over the street nodes (bus stops are not included), built the first time it is needed """
+        if self._spatial is None:
+            streets = np.flatnonzero(~np.asarray(self.is_stop))
+            self._spatial = spatial.build_index(
+                streets, self.x[streets], self.y[streets])
+        return self._spatial
+
+    def reverse_csr(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns (offsets, sources, weights) of the reversed graph, computed the first time it is needed """
+        if self._reverse is None:
+            sources = np.repeat(np.arange(self.number_of_nodes(), dtype=np.int32),
+                                np.diff(self.offsets))
+            order = np.argsort(self.targets, kind='stable')
+            counts = np.bincount(
+                self.targets, minlength=self.number_of_nodes())
+            offsets = np.zeros(self.number_of_nodes()+1, dtype=np.int32)
+            np.cumsum(counts, out=offsets[1:])
+            self._reverse = (offsets, sources[order], self.weights[order])
+        return self._reverse
+
+
+def compile_graph(g: nx.DiGraph) -> CompiledGraph:
+    """ Returns the compiled version of a city graph (as built by city.build_city_graph) """
+    nodes: list[Any] = list(g.nodes)
+    index: dict[Any, int] = {node: i for i, node in enumerate(nodes)}
+    palette: dict[str, int] = dict()  # color -> index in colors
+
+    offsets: list[int] = [0]
+    targets: list[int] = list()
+    weights: list[float] = list()
+    edge_color: list[int] = list()
+    geom_offsets: list[int] = [0]
+    geom: list[Coord] = list()
+    for u in nodes:
+        for v, data in g.adj[u].items():
+            targets.append(index[v])
+            weights.append(data['length'])
+            edge_color.append(palette.setdefault(data['color'], len(palette)))
+            geom.extend((p[0], p[1]) for p in data['route'])
+            geom_offsets.append(len(geom))
+        offsets.append(len(targets))
+
+    node_data = [g.nodes[node] for node in nodes]
+    node_color: list[int] = [palette.setdefault(
+        data['color'], len(palette)) for data in node_data]
+    return CompiledGraph(
+        ids=np.array([str(node) for node in nodes]),
+        is_stop=np.array([isinstance(node, str)
+                         for node in nodes], dtype=bool),
+        x=np.array([data['x'] for data in node_data], dtype=np.float64),
+        y=np.array([data['y'] for data in node_data], dtype=np.float64),
+        barcelona=np.array([data['poblacio'] == 'Barcelona'
+                            for data in node_data], dtype=bool),
+        node_color=np.array(node_color, dtype=np.int16),
+        offsets=np.array(offsets, dtype=np.int32),
+        targets=np.array(targets, dtype=np.int32),
+        weights=np.array(weights, dtype=np.float32),
+        edge_color=np.array(edge_color, dtype=np.int16),
+        geom_offsets=np.array(geom_offsets, dtype=np.int64),
+        geom=np.array(geom, dtype=np.float64).reshape(-1, 2),
+        colors=np.array(list(palette)),
+    )
+
+
+def _take(offsets: np.ndarray, values: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the offsets and values of the chosen rows of a ragged array (row i is values[offsets[i]:offsets[i+1]]) """
+    lengths = np.diff(offsets)[rows]
+    new_offsets = np.zeros(len(rows)+1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    index = np.repeat(offsets[:-1][rows] - new_offsets[:-1],
+                      lengths) + np.arange(new_offsets[-1])
+    return new_offsets, values[index]
+
+
+def patch_graph(cg: CompiledGraph, removed: set[Any], added: nx.DiGraph) -> tuple[CompiledGraph, np.ndarray]:
+    """ Returns a new compiled graph: cg without the removed nodes (networkx ids) and their edges, plus the nodes and edges of added (with the
+        same attributes than compile_graph uses). Edges of added can go to nodes of cg, only the new nodes need their data in added.
+        The kept nodes keep their order and the new ones go after them, so if only bus stops are removed (they come after the streets)
+        the streets keep their index and their spatial index is kept. Also returns the new index of every node of cg (-1 if removed) """
+    n: int = cg.number_of_nodes()
+    keep = np.ones(n, dtype=bool)
+    keep[np.array([cg.index_of(node) for node in removed], dtype=np.int64)] = False
+    new_index = np.full(n, -1, dtype=np.int64)
+    new_index[keep] = np.arange(np.count_nonzero(keep))
+
+    def index_of(node: Any) -> int:
+        try:
+            return int(new_index[cg.index_of(node)])
+        except KeyError:
+            return -1
+    index: dict[Any, int] = {node: index_of(node) for node in added.nodes}
+    new_nodes: list[Any] = [node for node, i in index.items() if i < 0]
+    index.update({node: int(np.count_nonzero(keep))+i
+                 for i, node in enumerate(new_nodes)})
+    palette: dict[str, int] = {color: i for i, color in enumerate(cg.colors.tolist())}
+
+    # Edges of cg between kept nodes (rows 0..edges-1 of the routes) and edges of added after them
+    edges = list(added.edges(data=True))
+    sources = np.repeat(np.arange(n), np.diff(cg.offsets))
+    kept = np.flatnonzero(keep[sources] & keep[cg.targets])
+    route_offsets = np.zeros(len(edges)+1, dtype=np.int64)
+    np.cumsum([len(data['route']) for _, _, data in edges], out=route_offsets[1:])
+    new_sources = np.concatenate([new_index[sources[kept]], np.array(
+        [index[u] for u, _, _ in edges], dtype=np.int64)])
+    # stable, the edges of each node stay in the same order
+    order = np.argsort(new_sources, kind='stable')
+    rows = np.concatenate([kept, cg.number_of_edges() + np.arange(len(edges))])[order]
+    geom_offsets, geom = _take(np.concatenate([cg.geom_offsets, cg.geom_offsets[-1]+route_offsets[1:]]),
+                               np.concatenate([cg.geom, np.array([(p[0], p[1]) for _, _, data in edges for p in data['route']],
+                                                                 dtype=np.float64).reshape(-1, 2)]), rows)
+    nodes: int = int(np.count_nonzero(keep)) + len(new_nodes)
+    offsets = np.zeros(nodes+1, dtype=np.int32)
+    np.cumsum(np.bincount(new_sources, minlength=nodes), out=offsets[1:])
+
+    node_data = [added.nodes[node] for node in new_nodes]
+    assert all('x' in data for data in node_data), 'New nodes need their attributes'
+    patched = CompiledGraph(
+        ids=np.concatenate([cg.ids[keep], np.array([str(node) for node in new_nodes], dtype=str)]),
+        is_stop=np.concatenate([cg.is_stop[keep], np.array([isinstance(node, str) for node in new_nodes], dtype=bool)]),
+        x=np.concatenate([cg.x[keep], np.array([data['x'] for data in node_data], dtype=np.float64)]),
+        y=np.concatenate([cg.y[keep], np.array([data['y'] for data in node_data], dtype=np.float64)]),
+        barcelona=np.concatenate([cg.barcelona[keep], np.array(
+            [data['poblacio'] == 'Barcelona' for data in node_data], dtype=bool)]),
+        node_color=np.concatenate([cg.node_color[keep], np.array(
+            [palette.setdefault(data['color'], len(palette)) for data in node_data], dtype=np.int16)]),
+        offsets=offsets,
+        targets=np.concatenate([new_index[cg.targets[kept]], np.array(
+            [index[v] for _, v, _ in edges], dtype=np.int64)])[order].astype(np.int32),
+        weights=np.concatenate([cg.weights[kept], np.array(
+            [data['length'] for _, _, data in edges], dtype=np.float32)])[order],
+        edge_color=np.concatenate([cg.edge_color[kept], np.array(
+            [palette.setdefault(data['color'], len(palette)) for _, _, data in edges], dtype=np.int16)])[order],
+        geom_offsets=geom_offsets,
+        geom=geom,
+        colors=np.array(list(palette)),
+    )
+    streets = np.flatnonzero(~np.asarray(cg.is_stop))
+    if np.array_equal(new_index[streets], streets):
+        # copied, the arrays of cg can be memory-mapped from the files the new graph is saved over
+        patched._spatial = spatial.GridIndex(**{name: np.array(getattr(cg.street_index(), name))
+                                                for name in spatial.GRID_ARRAYS})
+    return patched, new_index
+
+
+def save_snapshot(cg: CompiledGraph, dirname: str, inputs_hash: str) -> None:
+    """ Saves the compiled graph at the directory dirname, one .npy per array and a meta.json with the version and the hash of the inputs used to build it """
+    os.makedirs(dirname, exist_ok=True)
+    meta_file = os.path.join(dirname, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)  # if we stop while overwriting it the old snapshot is not valid anymore
+    for name in SNAPSHOT_ARRAYS:
+        np.save(os.path.join(dirname, name+'.npy'), getattr(cg, name))
+    spatial.save_index(cg.street_index(), dirname)
+    # meta.json is written last, a snapshot without it is not complete
+    with open(meta_file, 'w') as file:
+        json.dump({'version': SNAPSHOT_VERSION, 'inputs': inputs_hash,
+                   'nodes': cg.number_of_nodes(), 'edges': cg.number_of_edges()}, file)
+
+
+def snapshot_is_valid(dirname: str, inputs_hash: str) -> bool:
+    """ Returns True if there is a complete snapshot at dirname with the current version and built from the same inputs """
+    meta_file = os.path.join(dirname, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r') as file:
+        meta = json.load(file)
+    return meta.get('version') == SNAPSHOT_VERSION and meta.get('inputs') == inputs_hash
+
+
+def load_snapshot(dirname: str) -> CompiledGraph:
+    """ Loads the compiled graph saved with save_snapshot. Arrays are memory-mapped, nothing is unpickled or recomputed """
+    assert os.path.exists(os.path.join(dirname, 'meta.json'))
+    arrays = {name: np.load(os.path.join(dirname, name+'.npy'), mmap_mode='r', allow_pickle=False)
+              for name in SNAPSHOT_ARRAYS}
+    return CompiledGraph(**arrays, _spatial=spatial.load_index(dirname))
+
+
+def to_networkx(cg: CompiledGraph) -> nx.DiGraph:
+    """ Returns a networkx graph (indexed by node index) with the positions of the nodes, used to draw the compiled graph """
+    g = nx.DiGraph()
+    for u in range(cg.number_of_nodes()):
+        g.add_node(u, x=float(cg.x[u]), y=float(cg.y[u]))
+    g.add_edges_from((u, v) for u, v, _ in cg.edges())
+    return g
+
+
+def nearest_nodes(cg: CompiledGraph, lons: list[float], lats: list[float]) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the index of the nearest street node to each point (lon, lat) and the distance to it in meters """
+    return cg.street_index().query(lons, lats)
+
+
+def dijkstra(cg: CompiledGraph, src: int, targets: set[int] | None = None, budget: float = math.inf, reverse: bool = False, walk_only: bool = False) -> tuple[dict[int, float], dict[int, int | None]]:
+    """ Same search as city.shortest_times but over the arrays of the compiled graph. With reverse=True it returns the time from every node to src.
+        With walk_only=True only the streets are used, bus stops are only entered when they are targets (as city.walking_path with a hierarchy) """
+    if reverse:
+        offsets_arr, targets_arr, weights_arr = cg.reverse_csr()
+    else:
+        offsets_arr, targets_arr, weights_arr = cg.offsets, cg.targets, cg.weights
+    # memoryviews give python numbers when indexed, much faster than indexing numpy arrays one by one
+    offsets, heads, weights = memoryview(offsets_arr), memoryview(
+        targets_arr), memoryview(weights_arr)
+    stops = memoryview(cg.is_stop)
+
+    best: list[float] = [math.inf]*cg.number_of_nodes()
+    pred: list[int] = [-1]*cg.number_of_nodes()
+    best[src] = 0.0
+    dist: dict[int, float] = dict()
+    remaining: set[int] = set(targets or ()) - {src}
+    heap: list[tuple[float, int]] = [(0.0, src)]
+
+    while heap:
+        t, u = heapq.heappop(heap)
+        if t > best[u] or u in dist:
+            continue
+        if t > budget:
+            break
+        dist[u] = t
+        remaining.discard(u)
+        if targets and not remaining:
+            break
+        if walk_only and stops[u] and u != src:
+            continue  # a stop reached walking is a target, the walk does not go on through it
+        for e in range(offsets[u], offsets[u+1]):
+            v = heads[e]
+            # walking a stop is only entered from the street when it is a target (stop to stop is a bus)
+            if walk_only and stops[v] and (stops[u] or v not in remaining):
+                continue
+            new_t = t + weights[e]
+            if new_t < best[v]:
+                best[v] = new_t
+                pred[v] = u
+                heapq.heappush(heap, (new_t, v))
+
+    return dist, {u: (pred[u] if u != src else None) for u in dist}
+
+
+def settle(cg: CompiledGraph, src: int, budget: float = math.inf, walk_only: bool = False) -> Iterator[tuple[int, float, int | None]]:
+    """ Same search as dijkstra, but yields every node (node, time, predecessor) as soon as it is settled, in order of time, until the next one is further than budget.
+        Whoever consumes it can stop the search at any moment """
+    offsets, heads, weights = memoryview(cg.offsets), memoryview(
+        cg.targets), memoryview(cg.weights)
+    stops = memoryview(cg.is_stop)
+
+    best: list[float] = [math.inf]*cg.number_of_nodes()
+    pred: list[int] = [-1]*cg.number_of_nodes()
+    settled: list[bool] = [False]*cg.number_of_nodes()
+    best[src] = 0.0
+    heap: list[tuple[float, int]] = [(0.0, src)]
+
+    while heap:
+        t, u = heapq.heappop(heap)
+        if t > best[u] or settled[u]:
+            continue
+        if t > budget:
+            return
+        settled[u] = True
+        yield u, t, (pred[u] if u != src else None)
+        for e in range(offsets[u], offsets[u+1]):
+            v = heads[e]
+            if walk_only and stops[v]:
+                continue
+            new_t = t + weights[e]
+            if new_t < best[v]:
+                best[v] = new_t
+                pred[v] = u
+                heapq.heappush(heap, (new_t, v))
+
+
+def shortest_path(cg: CompiledGraph, src: int, dst: int) -> Path:
+    """ Returns the shortest path (list of node indices) from src to dst """
+    _, pred = dijkstra(cg, src, {dst})
+    if dst not in pred:
+        raise nx.NetworkXNoPath('No path between '+str(src)+' and '+str(dst))
+    path: Path = [dst]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+    return path[::-1]
@@ -0,0 +1,312 @@
+""" Local routing service: one process owns the city graph (compiled arrays, spatial index and cinema tables) in shared memory and answers
+    over HTTP on localhost, so the app and the batch planner do not have to load their own copy. The queries of each request are split
+    among worker processes that attach to the shared arrays (multiprocessing.shared_memory) instead of copying them.
+    Endpoints (JSON):
+        POST /find_path   {"queries": [[src lon, src lat, dst lon, dst lat], ...]} -> {"paths": [[node id, ...], ...]}  ([] if there is no path)
+        POST /reachable   {"queries": [[lon, lat, budget in seconds], ...]} -> {"cinemas": [{cinema name: travel time}, ...]}
+        GET  /line/<id>   -> {"id", "name", "color", "stops": [[lon, lat], ...], "codes": [...], "route": [[lon, lat], ...]}
+        GET  /health      -> {"nodes", "edges", "workers"}
+        GET  /metrics     -> timing spans and counters of the server and its workers (Prometheus text format, see metrics)
+    Run from the root of the project:
+        python server.py [--port 8642] [--workers 4] [--metrics-log spans.jsonl] [--profile profiles] """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+from typing import Any, Callable
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import numpy as np
+import requests
+import billboard
+import buses
+import city
+import metrics
+import planner
+import routecache
+import routing
+import spatial
+
+
+DEFAULT_PORT: int = 8642
+
+# name -> (shared memory block name, dtype, shape) of every shared array
+SharedArrays = dict[str, tuple[str, str, tuple[int, ...]]]
+
+# State of every worker process, set by _attach
+_graph: routing.CompiledGraph | None = None
+_cinema_times: np.ndarray | None = None  # times[node, cinema] of the cinema tables, None if there are none
+_cinema_names: list[str] = list()  # cinema of each column of _cinema_times
+_blocks: list[shared_memory.SharedMemory] = list()  # kept open while the worker lives
+_routes: routecache.RouteCache | None = None  # routes found by any worker in this version of the graph
+
+
+def share_arrays(arrays: dict[str, np.ndarray]) -> tuple[SharedArrays, list[shared_memory.SharedMemory]]:
+    """ Copies the arrays to new shared memory blocks. Returns what other processes need to attach to them, and the blocks (close and unlink them at the end) """
+    shared: SharedArrays = dict()
+    blocks: list[shared_memory.SharedMemory] = list()
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        shared[name] = (block.name, array.dtype.str, array.shape)
+        blocks.append(block)
+    return shared, blocks
+
+
+def attach_arrays(shared: SharedArrays) -> tuple[dict[str, np.ndarray], list[shared_memory.SharedMemory]]:
+    """ Returns the arrays shared with share_arrays without copying them (read only), and the blocks that have to stay open while they are used """
+    arrays: dict[str, np.ndarray] = dict()
+    blocks: list[shared_memory.SharedMemory] = list()
+    for name, (block_name, dtype, shape) in shared.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        arrays[name].flags.writeable = False
+        blocks.append(block)
+    return arrays, blocks
+
+
+def share_planner(city_planner: planner.Planner) -> tuple[SharedArrays, list[str], list[shared_memory.SharedMemory]]:
+    """ Shares the arrays of the graph (prefix g_), of its spatial index (grid_) and of the cinema tables (cinema_times).
+        Returns what _attach needs (the arrays and the cinema names) and the blocks """
+    g = city_planner.graph
+    arrays: dict[str, np.ndarray] = {
+        'g_'+name: getattr(g, name) for name in routing.SNAPSHOT_ARRAYS}
+    arrays.update({'grid_'+name: getattr(g.street_index(), name)
+                  for name in spatial.GRID_ARRAYS})
+    names: list[str] = list()
+    # with a compiled graph the rows of the tables are the node indices
+    if city_planner.tables is not None:
+        names = sorted(city_planner.tables.columns,
+                       key=city_planner.tables.columns.__getitem__)
+        arrays['cinema_times'] = city_planner.tables.times
+    shared, blocks = share_arrays(arrays)
+    return shared, names, blocks
+
+
+def _attach(shared: SharedArrays, cinema_names: list[str], metrics_settings: tuple[str | None, str | None],
+            route_settings: tuple[str, str | None, int, int, int] | None) -> None:
+    """ Initializer of the workers: builds the graph over the shared arrays, logs the spans like the server (metrics.settings)
+        and opens the route cache of the server (RouteCache.settings) """
+    global _graph, _cinema_times, _cinema_names, _blocks, _routes
+    metrics.configure(*metrics_settings)
+    if route_settings is not None:
+        _routes = routecache.RouteCache(*route_settings, invalidate=False)
+    arrays, _blocks = attach_arrays(shared)
+    _graph = routing.CompiledGraph(**{name: arrays['g_'+name] for name in routing.SNAPSHOT_ARRAYS},
+                                   _spatial=spatial.GridIndex(**{name: arrays['grid_'+name] for name in spatial.GRID_ARRAYS}))
+    _cinema_times = arrays.get('cinema_times')
+    _cinema_names = cinema_names
+
+
+def _find_paths(queries: list[list[float]]) -> list[list[Any]]:
+    """ Shortest path (node ids) for each [src lon, src lat, dst lon, dst lat] """
+    assert _graph is not None
+    g = _graph
+    nodes = city.nearest_nodes(g, [q[0] for q in queries] + [q[2] for q in queries],
+                               [q[1] for q in queries] + [q[3] for q in queries])
+    paths: list[list[Any]] = list()
+    for src, dst in zip(nodes[:len(queries)], nodes[len(queries):]):
+        route = _routes.get(src, dst) if _routes is not None else None
+        if route is None:
+            times, pred = city.shortest_times(g, src, {dst})
+            if dst not in times:
+                paths.append(list())
+                continue
+            route = (times[dst], city.path_from(pred, dst))
+            if _routes is not None:
+                _routes.put(src, dst, route)
+        paths.append([g.node_id(u) for u in route[1]])
+    return paths
+
+
+def _reachable(queries: list[list[float]]) -> list[dict[str, float]]:
+    """ Cinemas reachable from each [lon, lat, budget] in at most budget seconds, with the travel time """
+    assert _graph is not None
+    g = _graph
+    nodes = city.nearest_nodes(g, [q[0] for q in queries], [q[1] for q in queries])
+    if _cinema_times is None:
+        cinema_node = planner.cinema_nodes(g, list(billboard.cinemas_location))
+    result: list[dict[str, float]] = list()
+    for (_, _, budget), node in zip(queries, nodes):
+        if _cinema_times is not None:
+            # with the tables it is one row
+            times = _cinema_times[node]
+            result.append({name: float(times[i]) for i, name in enumerate(
+                _cinema_names) if times[i] <= budget})
+        else:
+            dist, _ = city.shortest_times(g, node, set(cinema_node.values()), budget)
+            result.append({name: dist[u] for name, u in cinema_node.items() if u in dist})
+    return result
+
+
+def _check_queries(queries: Any, arity: int) -> str | None:
+    """ Returns what is wrong with the queries of a request (each one a list of arity finite numbers, the budgets not negative), None if nothing """
+    if not isinstance(queries, list):
+        return 'Expected {"queries": [...]}'
+    for i, query in enumerate(queries):
+        if not isinstance(query, list) or len(query) != arity:
+            return f"Query {i} is not a list of {arity} numbers"
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in query):
+            return f"Query {i} has values that are not finite numbers"
+        if arity == 3 and query[2] < 0:
+            return f"Query {i} has a negative budget"
+    return None
+
+
+def _measured(job: tuple[Callable[[list[Any]], list[Any]], list[Any]]) -> tuple[list[Any], dict[str, metrics.Totals]]:
+    """ Answers the queries of the job (function, queries) in a worker. Also returns the metrics of the worker since its last job, the server adds them to its own """
+    function, queries = job
+    with metrics.span('server.'+function.__name__.lstrip('_'), profile=True, queries=len(queries)):
+        answers = function(queries)
+    return answers, metrics.take()
+
+
+class GraphServer(ThreadingHTTPServer):
+    """ HTTP server that splits the queries of each request among the pool of workers attached to the shared graph """
+    daemon_threads = True
+
+    def __init__(self, port: int, workers: int):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.planner = planner.load_planner()
+        self.shared, cinema_names, self.blocks = share_planner(self.planner)
+        self.workers = workers
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            workers, _attach, (self.shared, cinema_names, metrics.settings(),
+                               self.planner.routes.settings() if self.planner.routes is not None else None))
+        self.network: buses.NetworkBus | None = None  # bus lines, read the first time a line is asked
+
+    def batch(self, function: Any, queries: list[Any]) -> list[Any]:
+        """ Answers the queries splitting them in one chunk per worker """
+        if not queries:
+            return list()
+        size = math.ceil(len(queries)/self.workers)
+        chunks = self.pool.map(_measured, [(function, queries[i:i+size])
+                                           for i in range(0, len(queries), size)])
+        for _, worker_metrics in chunks:
+            metrics.merge(worker_metrics)
+        return [answer for chunk, _ in chunks for answer in chunk]
+
+    def line(self, id: int) -> dict[str, Any]:
+        if self.network is None:
+            self.network = buses.create_Bus_Network("busNetwork.npz")
+        line = self.network.getBusLine(id)
+        stops = line.stops()
+        return {'id': line.id(), 'name': line.name(), 'color': line.color(), 'stops': [list(stop.pos) for stop in stops],
+                'codes': [stop.code for stop in stops], 'route': line.route().tolist()}
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.terminate()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: GraphServer
+
+    def _reply(self, status: int, body: Any, content_type: str = 'application/json') -> None:
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == '/health':
+            self._reply(200, {'nodes': self.server.planner.graph.number_of_nodes(),
+                              'edges': self.server.planner.graph.number_of_edges(), 'workers': self.server.workers})
+        elif self.path == '/metrics':
+            self._reply(200, metrics.prometheus(), 'text/plain; version=0.0.4')
+        elif self.path.startswith('/line/') and self.path[len('/line/'):].isdigit():
+            try:
+                self._reply(200, self.server.line(int(self.path[len('/line/'):])))
+            except AssertionError as error:
+                self._reply(404, {'error': str(error)})
+        else:
+            self._reply(404, {'error': 'Unknown path '+self.path})
+
+    def do_POST(self) -> None:
+        # path -> (function, key of the answers, numbers in each query)
+        functions = {'/find_path': (_find_paths, 'paths', 4), '/reachable': (_reachable, 'cinemas', 3)}
+        if self.path not in functions:
+            self._reply(404, {'error': 'Unknown path '+self.path})
+            return
+        try:
+            queries = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['queries']
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error': 'Expected {"queries": [...]}'})
+            return
+        function, key, arity = functions[self.path]
+        # a bad query would fail in a worker, after the other chunks were answered
+        error = _check_queries(queries, arity)
+        if error is not None:
+            self._reply(400, {'error': error})
+            return
+        try:
+            with metrics.span('server.request', path=self.path, queries=len(queries)):
+                answers = self.server.batch(function, queries)
+        except Exception as exception:
+            self._reply(500, {'error': f"{type(exception).__name__}: {exception}"})
+            return
+        self._reply(200, {key: answers})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass  # one line per request is too much with many clients
+
+
+class GraphClient:
+    """ Client of the routing service, sends all the queries of a call in one request """
+
+    def __init__(self, url: str = 'http://127.0.0.1:'+str(DEFAULT_PORT)):
+        self.url = url
+        self.session = requests.Session()
+
+    def _post(self, path: str, queries: list[list[float]]) -> Any:
+        response = self.session.post(self.url+path, json={'queries': queries})
+        response.raise_for_status()
+        return response.json()
+
+    def find_paths(self, pairs: list[tuple[city.Coord, city.Coord]]) -> list[list[Any]]:
+        """ Returns the shortest path (node ids of the city graph) between each pair of points (lon, lat) """
+        return self._post('/find_path', [[*src, *dst] for src, dst in pairs])['paths']
+
+    def reachable(self, points: list[city.Coord], budget: float) -> list[dict[str, float]]:
+        """ Returns for each point (lon, lat) the cinemas that can be reached in at most budget seconds and the time to get there """
+        return self._post('/reachable', [[*point, budget] for point in points])['cinemas']
+
+    def line(self, id: int) -> dict[str, Any]:
+        """ Returns the stops and the route of the bus line """
+        response = self.session.get(self.url+'/line/'+str(id))
+        response.raise_for_status()
+        return response.json()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serves the city graph to local clients")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--metrics-log', help="file where every timing span is written as a line of JSON")
+    parser.add_argument('--profile', help="directory for the cProfile stats of every chunk of queries")
+    args = parser.parse_args()
+
+    metrics.configure(args.metrics_log, args.profile)
+    server = GraphServer(args.port, args.workers)
+    # stopped as a service (SIGTERM) the shared memory is freed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {server.planner.graph.number_of_nodes()} nodes at http://127.0.0.1:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from typing import TypeAlias
+import numpy as np
+import math
+import os
+
+
+Coord: TypeAlias = tuple[float, float]   # (longitude, latitude)
+
+EARTH_RADIUS: float = 6371008.8  # meters, same as haversine
+GRID_ARRAYS: list[str] = ['ids', 'px', 'py', 'offsets', 'params']
+
+
+@dataclass
+class GridIndex:
+    """ Uniform grid over the street nodes to find the nearest node of a point. The nodes of each cell are consecutive (CSR like offsets)
+        so the whole index is a few arrays that can be saved with np.save """
+    ids: np.ndarray  # int64, id of each node (sorted by cell)
+    px: np.ndarray  # float64, x of each node in meters (sorted by cell)
+    py: np.ndarray  # float64, y of each node in meters (sorted by cell)
+    offsets: np.ndarray  # int64 (cells+1), the nodes of cell c are offsets[c]:offsets[c+1]
+    params: np.ndarray  # float64 [lat0, cell size, x0, y0, columns, rows]
+
+    def _project(self, lons: np.ndarray, lats: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ Projects (lon, lat) to meters, equirectangular projection around lat0 (enough inside a city) """
+        lat0 = self.params[0]
+        return (np.radians(lons)*math.cos(lat0)*EARTH_RADIUS, np.radians(lats)*EARTH_RADIUS)
+
+    def query(self, lons: list[float] | np.ndarray, lats: list[float] | np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ Returns the id of the nearest node to each point and the distance to it in meters """
+        _, cell, x0, y0, columns, rows = self.params
+        columns, rows = int(columns), int(rows)
+        xs, ys = self._project(np.asarray(lons, dtype=np.float64),
+                               np.asarray(lats, dtype=np.float64))
+        found = np.empty(len(xs), dtype=np.int64)
+        dists = np.empty(len(xs), dtype=np.float64)
+
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            # cell of the point (points outside the grid start at the closest border cell)
+            cx = min(max(int((x-x0)//cell), 0), columns-1)
+            cy = min(max(int((y-y0)//cell), 0), rows-1)
+            best, best_d = -1, math.inf
+            # We look in squares of cells of radius r around the point until no closer node can be in the next square
+            r = 0
+            while True:
+                xa, xb = max(cx-r, 0), min(cx+r, columns-1)
+                for col in range(xa, xb+1):
+                    # only the cells of the border of the square are new
+                    if col in (cx-r, cx+r):
+                        ya, yb = max(cy-r, 0), min(cy+r, rows-1)
+                        cells = range(ya, yb+1)
+                    else:
+                        cells = [c for c in (cy-r, cy+r) if 0 <= c < rows]
+                    for row in cells:
+                        c = col*rows+row
+                        begin, end = self.offsets[c], self.offsets[c+1]
+                        if begin == end:
+                            continue
+                        d = (self.px[begin:end]-x)**2+(self.py[begin:end]-y)**2
+                        j = int(np.argmin(d))
+                        if d[j] < best_d:
+                            best, best_d = begin+j, float(d[j])
+                # Cells not visited yet are in the parts of the grid outside the square,
+                # if all of them are further than the best node we can stop
+                x_lo, x_hi = x0+(cx-r)*cell, x0+(cx+r+1)*cell
+                y_lo, y_hi = y0+(cy-r)*cell, y0+(cy+r+1)*cell
+                x_min, x_max = x0, x0+columns*cell
+                y_min, y_max = y0, y0+rows*cell
+                left = [(x_min, x_lo, y_min, y_max)] if cx-r > 0 else []
+                right = [(x_hi, x_max, y_min, y_max)] if cx+r < columns-1 else []
+                down = [(x_min, x_max, y_min, y_lo)] if cy-r > 0 else []
+                up = [(x_min, x_max, y_hi, y_max)] if cy+r < rows-1 else []
+                bound = min((_box_distance(x, y, box) for box in left+right+down+up), default=None)
+                if bound is None or (best >= 0 and math.sqrt(best_d) <= bound):
+                    break
+                r += 1
+            # distance in meters using haversine (the projection is only used to compare)
+            lon1, lat1 = x/(math.cos(self.params[0])*EARTH_RADIUS), y/EARTH_RADIUS
+            lon2, lat2 = self.px[best]/(math.cos(self.params[0])*EARTH_RADIUS), self.py[best]/EARTH_RADIUS
+            h = math.sin((lat2-lat1)/2)**2 + math.cos(lat1) * \
+                math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+            found[i], dists[i] = self.ids[best], 2*EARTH_RADIUS*math.asin(math.sqrt(h))
+
+        return found, dists
+
+
+def _box_distance(x: float, y: float, box: tuple[float, float, float, float]) -> float:
+    """ Distance from the point (x, y) to the rectangle box = (x_min, x_max, y_min, y_max) """
+    dx = max(box[0]-x, 0.0, x-box[1])
+    dy = max(box[2]-y, 0.0, y-box[3])
+    return math.hypot(dx, dy)
+
+
+def build_index(ids: np.ndarray, lons: np.ndarray, lats: np.ndarray, cell: float = 100.0) -> GridIndex:
+    """ Returns the grid index of the nodes with the given ids and positions. cell is the size of the cells in meters """
+    lat0 = math.radians(float(np.mean(lats)))
+    px = np.radians(np.asarray(lons, dtype=np.float64)) * \
+        math.cos(lat0)*EARTH_RADIUS
+    py = np.radians(np.asarray(lats, dtype=np.float64))*EARTH_RADIUS
+    x0, y0 = float(px.min()), float(py.min())
+    # never more cells than 4 per node, a few nodes far away must not make the grid huge
+    cell = max(cell, math.sqrt((px.max()-x0+1)*(py.max()-y0+1)/(4*len(px))))
+    columns = int((px.max()-x0)//cell)+1
+    rows = int((py.max()-y0)//cell)+1
+
+    # Sort the nodes by cell so each cell is a range of the arrays
+    cells = ((px-x0)//cell).astype(np.int64)*rows + \
+        ((py-y0)//cell).astype(np.int64)
+    order = np.argsort(cells, kind='stable')
+    offsets = np.zeros(columns*rows+1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=columns*rows), out=offsets[1:])
+    return GridIndex(np.asarray(ids, dtype=np.int64)[order], px[order], py[order], offsets,
+                     np.array([lat0, cell, x0, y0, columns, rows], dtype=np.float64))
+
+
+def save_index(index: GridIndex, dirname: str, prefix: str = 'grid_') -> None:
+    """ Saves the arrays of the index at the directory dirname """
+    os.makedirs(dirname, exist_ok=True)
+    for name in GRID_ARRAYS:
+        np.save(os.path.join(dirname, prefix+name+'.npy'),
+                getattr(index, name))
+
+
+def load_index(dirname: str, prefix: str = 'grid_') -> GridIndex:
+    """ Loads (memory-mapped) the index saved with save_index """
+    return GridIndex(**{name: np.load(os.path.join(dirname, prefix+name+'.npy'), mmap_mode='r', allow_pickle=False)
+                        for name in GRID_ARRAYS})
@@ -0,0 +1,107 @@
+""" Runs the slow work of the app (scraping, building graphs, routing, plotting) in background threads so the Tk window never freezes.
+    Tk is not thread safe, so the results are never touched from the threads: the main loop polls the finished tasks with after() and calls their callbacks.
+    Threads (and not processes) are used because the results are big graphs that would have to be pickled back, and the Tk loop still gets the GIL between bytecodes """
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+import tkinter as tk
+
+
+POLL_MS: int = 100  # how often the main loop checks the tasks
+
+
+@dataclass
+class Task:
+    """ A function to run in background, identified by its name (only one task with each name at the same time) """
+    name: str  # identifies the task, other tasks use it to depend on it
+    function: Callable[..., Any]  # runs in a background thread
+    args: tuple  # arguments of function
+    on_done: Callable[[Any], None] | None  # called in the Tk loop with the result
+    depends: list[str]  # names of the tasks that have to finish (successfully) before it starts
+    future: Future | None = None  # set once it is started
+
+
+class TaskRunner:
+    """ Starts the tasks in a thread pool once their dependencies are done and calls back their results in the Tk loop """
+
+    def __init__(self, root: tk.Misc, workers: int = 2, on_change: Callable[[list[str]], None] | None = None):
+        """ root is the Tk widget whose loop receives the results. on_change is called (in the Tk loop) with the names of the unfinished tasks every time they change """
+        self.root = root
+        self.executor = ThreadPoolExecutor(workers)
+        self.on_change = on_change
+        self.tasks: dict[str, Task] = dict()  # unfinished tasks by name
+        self.root.after(POLL_MS, self._poll)
+
+    def submit(self, name: str, function: Callable[..., Any], *args: Any, on_done: Callable[[Any], None] | None = None, depends: list[str] | None = None) -> Task:
+        """ Runs function(*args) in background once the unfinished tasks in depends have finished (dependencies already finished or unknown are ignored).
+            If a task with the same name is not finished it is returned instead of starting another one """
+        if name in self.tasks:
+            return self.tasks[name]
+        task = Task(name, function, args, on_done,
+                    [dependency for dependency in depends or [] if dependency in self.tasks])
+        self.tasks[name] = task
+        self._start_ready()
+        self._changed()
+        return task
+
+    def is_running(self, name: str) -> bool:
+        """ Returns if the task with this name is waiting or running """
+        return name in self.tasks
+
+    def cancel(self, name: str) -> None:
+        """ Cancels the task and the ones that depend on it. A running function can not be stopped: it finishes but its result is discarded """
+        if name not in self.tasks:
+            return
+        task = self.tasks.pop(name)
+        if task.future is not None:
+            task.future.cancel()
+        for other in list(self.tasks.values()):
+            if name in other.depends:
+                self.cancel(other.name)
+        self._changed()
+
+    def cancel_all(self) -> None:
+        """ Cancels every unfinished task """
+        for name in list(self.tasks):
+            self.cancel(name)
+
+    def shutdown(self) -> None:
+        """ Cancels everything and does not wait for the running functions (threads can not be killed) """
+        self.cancel_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start_ready(self) -> None:
+        """ Starts the tasks whose dependencies are all finished """
+        for task in self.tasks.values():
+            if task.future is None and not any(dependency in self.tasks for dependency in task.depends):
+                task.future = self.executor.submit(task.function, *task.args)
+
+    def _poll(self) -> None:
+        """ Calls back the finished tasks, starts the ones that were waiting for them and polls again later """
+        finished = [task for task in self.tasks.values()
+                    if task.future is not None and task.future.done()]
+        for task in finished:
+            if self.tasks.pop(task.name, None) is None:
+                continue  # cancelled because a task it depends on failed
+            error = task.future.exception()
+            if error is None and task.on_done is not None:
+                try:
+                    task.on_done(task.future.result())
+                except Exception as exception:
+                    error = exception
+            if error is not None:
+                # the tasks depending on a failed one can not run
+                for other in list(self.tasks.values()):
+                    if task.name in other.depends:
+                        self.cancel(other.name)
+                # same report as an exception in a normal Tk callback
+                self.root.report_callback_exception(
+                    type(error), error, error.__traceback__)
+        if finished:
+            self._start_ready()
+            self._changed()
+        self.root.after(POLL_MS, self._poll)
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change(list(self.tasks))
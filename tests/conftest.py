@@ -0,0 +1,37 @@
+""" Data shared by the tests: a small synthetic city, a grid of streets with a bus line whose stops are far apart but one short bus edge away """
+import networkx as nx
+import pytest
+import city
+
+
+SIZE: int = 6  # streets in each direction
+STEP: float = 0.001  # degrees between two crossings
+
+
+def build_grid_city() -> city.CityGraph:
+    streets = nx.DiGraph()
+    for i in range(SIZE):
+        for j in range(SIZE):
+            streets.add_node(i*SIZE+j, x=2.15+i*STEP, y=41.38+j*STEP, poblacio='Barcelona', color='#000000')
+    for u in list(streets.nodes):
+        for v in [u+1 if (u+1) % SIZE else None, u+SIZE if u+SIZE < SIZE*SIZE else None]:
+            if v is None:
+                continue
+            pos_u = (streets.nodes[u]['x'], streets.nodes[u]['y'])
+            pos_v = (streets.nodes[v]['x'], streets.nodes[v]['y'])
+            streets.add_edge(u, v, length=80.0, color='#000000', route=[pos_u, pos_v])
+            streets.add_edge(v, u, length=80.0, color='#000000', route=[pos_v, pos_u])
+    bus = nx.DiGraph()
+    corners = [(0, 0), (SIZE-1, SIZE-1), (0, SIZE-1), (SIZE-1, 0)]
+    for k, (i, j) in enumerate(corners):
+        bus.add_node(f"{k}-1", x=2.15+i*STEP+STEP/10, y=41.38+j*STEP, poblacio='Barcelona', color='#ff0000')
+    for k in range(len(corners)-1):
+        bus.add_edge(f"{k}-1", f"{k+1}-1", length=1.0, color='#ff0000',
+                     route=[(bus.nodes[f"{k}-1"]['x'], bus.nodes[f"{k}-1"]['y']), (bus.nodes[f"{k+1}-1"]['x'], bus.nodes[f"{k+1}-1"]['y'])])
+    return city.build_city_graph(streets, bus)
+
+
+@pytest.fixture(scope='session')
+def grid_city() -> city.CityGraph:
+    """ The grid city (build_grid_city), the tests must not change it """
+    return build_grid_city()
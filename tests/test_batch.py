@@ -0,0 +1,44 @@
+""" Tests of the reading of the origins of the batch planner, without internet (the addresses are geocoded by a stand-in of ox.geocode).
+    Run from the root of the project: python -m pytest tests """
+import importlib.util
+import pytest
+import batch
+
+
+def test_read_csv(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(batch.ox, 'geocode', lambda address: (41.38, 2.17))
+    filename = tmp_path / "origins.csv"
+    filename.write_text("id,lon,lat,address\n"
+                        "a,2.15,41.39,\n"
+                        "b,,,Plaça de Catalunya\n")
+    assert batch.read_origins(str(filename)) == [('a', 2.15, 41.39), ('b', 2.17, 41.38)]
+
+
+def test_read_csv_without_id(tmp_path) -> None:
+    filename = tmp_path / "origins.csv"
+    filename.write_text("lon,lat\n2.15,41.39\n2.16,41.4\n")
+    assert batch.read_origins(str(filename)) == [(0, 2.15, 41.39), (1, 2.16, 41.4)]
+
+
+def test_read_csv_without_coordinates(tmp_path) -> None:
+    filename = tmp_path / "origins.csv"
+    filename.write_text("id,name\na,b\n")
+    with pytest.raises(AssertionError):
+        batch.read_origins(str(filename))
+
+
+@pytest.mark.skipif(importlib.util.find_spec('pyarrow') is not None, reason="pyarrow is installed")
+def test_read_parquet_without_pyarrow(tmp_path) -> None:
+    with pytest.raises(ModuleNotFoundError, match="pyarrow"):
+        batch.read_origins(str(tmp_path / "origins.parquet"))
+
+
+@pytest.mark.skipif(importlib.util.find_spec('pyarrow') is None, reason="pyarrow is not installed")
+def test_read_parquet(tmp_path, monkeypatch) -> None:
+    import pyarrow
+    import pyarrow.parquet
+    filename = str(tmp_path / "origins.parquet")
+    pyarrow.parquet.write_table(pyarrow.table({'lon': [2.15, None], 'lat': [41.39, None],
+                                               'address': [None, 'Plaça de Catalunya']}), filename)
+    monkeypatch.setattr(batch.ox, 'geocode', lambda address: (41.38, 2.17))
+    assert batch.read_origins(filename) == [(0, 2.15, 41.39), (1, 2.17, 41.38)]
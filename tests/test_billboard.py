@@ -0,0 +1,149 @@
+""" Tests of the billboard, offline: the pages saved in fixtures/sensacine are served by a local stand-in of sensacine (with ETag and 304)
+    and billboard.SENSACINE_URL points to it. Run from the root of the project: python -m pytest tests """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator
+from urllib.parse import parse_qs, urlparse
+import hashlib
+import os
+import threading
+import pytest
+import requests
+import billboard
+
+
+FIXTURES_DIR: str = os.path.join(os.path.dirname(__file__), "fixtures", "sensacine")
+
+
+class Sensacine(ThreadingHTTPServer):
+    """ Serves FIXTURES_DIR/<page>.html for ?page=<page>, answers 304 when the ETag sent is the one of the page, and records every request """
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), SensacineHandler)
+        self.requests: list[tuple[str, int]] = list()  # (page, status) of every request
+        self._lock = threading.Lock()
+
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/cines/?page="
+
+    def pages(self, status: int | None = None) -> list[str]:
+        """ Returns the pages requested (only the ones answered with status if given) """
+        with self._lock:
+            return [page for page, answer in self.requests if status is None or answer == status]
+
+    def record(self, page: str, status: int) -> None:
+        with self._lock:
+            self.requests.append((page, status))
+
+
+class SensacineHandler(BaseHTTPRequestHandler):
+    server: Sensacine
+
+    def do_GET(self) -> None:
+        page = parse_qs(urlparse(self.path).query).get('page', [''])[0]
+        filename = os.path.join(FIXTURES_DIR, os.path.basename(page)+'.html')
+        if not os.path.exists(filename):
+            self.server.record(page, 404)
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as file:
+            content = file.read()
+        etag = '"'+hashlib.sha1(content).hexdigest()+'"'
+        if self.headers.get('If-None-Match') == etag:
+            self.server.record(page, 304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.server.record(page, 200)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def sensacine(tmp_path, monkeypatch) -> Iterator[Sensacine]:
+    """ The stand-in server, with billboard pointing to it and its cache (sensacine_cache) in an empty temporary directory """
+    server = Sensacine()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(billboard, 'SENSACINE_URL', server.url())
+    monkeypatch.chdir(tmp_path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _expected(page: int) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, str(page)+'.html'), 'rb') as file:
+        return file.read()
+
+
+def test_cache_hit_within_ttl(sensacine: Sensacine) -> None:
+    with requests.Session() as session:
+        first = billboard.fetch_page(session, billboard.SENSACINE_URL+'1')
+        second = billboard.fetch_page(session, billboard.SENSACINE_URL+'1')
+    assert first == second == _expected(1)
+    # the second one is answered by the cache without asking the server
+    assert sensacine.pages() == ['1']
+
+
+def test_conditional_request_not_modified(sensacine: Sensacine) -> None:
+    with requests.Session() as session:
+        first = billboard.fetch_page(session, billboard.SENSACINE_URL+'2')
+        # with ttl 0 the cached page is too old, it is asked again with its ETag
+        second = billboard.fetch_page(session, billboard.SENSACINE_URL+'2', ttl=0)
+    assert first == second == _expected(2)
+    assert sensacine.pages(200) == ['2']
+    assert sensacine.pages(304) == ['2']
+
+
+def test_without_cache(sensacine: Sensacine) -> None:
+    with requests.Session() as session:
+        for _ in range(2):
+            assert billboard.fetch_page(session, billboard.SENSACINE_URL+'3', cache_dir=None) == _expected(3)
+    assert sensacine.pages(200) == ['3', '3']
+    assert not os.path.exists(billboard.CACHE_DIR)
+
+
+def test_fetch_pages(sensacine: Sensacine) -> None:
+    pages = billboard.fetch_pages([1, 2, 3])
+    assert pages == {page: _expected(page) for page in [1, 2, 3]}
+    assert sorted(sensacine.pages()) == ['1', '2', '3']
+
+
+def test_read_fetches_each_page_once(sensacine: Sensacine) -> None:
+    bb = billboard.read()
+    # the cinema pages are also film pages, each one is downloaded once
+    assert sorted(sensacine.pages()) == sorted(str(page) for page in set(billboard.CINEMA_PAGES+billboard.FILM_PAGES))
+    assert sorted(cinema.name for cinema in bb.cinemas) == [
+        'Cines Verdi Barcelona', 'Cinesa Diagonal Mar 18', 'Cinesa La Farga 3D']
+    assert sorted(film.title for film in bb.films) == ['Film 1', 'Film 2', 'Film 3']
+    assert sorted((p.film.title, p.cinema.name, p.time) for p in bb.projections) == [
+        ('Film 1', 'Cines Verdi Barcelona', (20, 0)),
+        ('Film 1', 'Cinesa Diagonal Mar 18', (16, 0)),
+        ('Film 1', 'Cinesa Diagonal Mar 18', (18, 30)),
+        ('Film 2', 'Cinesa Diagonal Mar 18', (17, 15)),
+        ('Film 2', 'Cinesa La Farga 3D', (19, 45)),
+        ('Film 2', 'Cinesa La Farga 3D', (22, 0)),
+    ]
+
+
+def test_read_uses_the_cache(sensacine: Sensacine) -> None:
+    first = billboard.read()
+    second = billboard.read()
+    assert first == second
+    assert len(sensacine.pages()) == len(set(billboard.CINEMA_PAGES+billboard.FILM_PAGES))
+
+
+def test_language(sensacine: Sensacine) -> None:
+    languages = {(p.film.title, p.cinema.name): p.language for p in billboard.read().projections}
+    # "Original" in the text of the j_w block, in the attribute of an element inside it, or nowhere
+    assert languages == {('Film 1', 'Cinesa Diagonal Mar 18'): 'Original', ('Film 1', 'Cines Verdi Barcelona'): 'Original',
+                         ('Film 2', 'Cinesa Diagonal Mar 18'): 'Doblada', ('Film 2', 'Cinesa La Farga 3D'): 'Doblada'}
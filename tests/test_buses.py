@@ -0,0 +1,118 @@
+""" Tests of buses.iter_features, the streaming reader of the bus GeoJSON files, and of buses.get_buses_from_network against the previous
+    point by point implementation (kept here as reference) on small synthetic networks. Run from the root of the project: python -m pytest tests """
+import json
+import random
+import pytest
+import buses
+from buses import Coord, NetworkBus, BusesGraph, dist, brighter_color
+
+
+FEATURES: list[dict] = [{'type': 'Feature', 'properties': {'ID_RECORREGUT': i, 'NOM': 'línia '+str(i)},
+                         'geometry': {'type': 'Point', 'coordinates': [2.17+i/100, 41.38]}} for i in range(5)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 16, 32, 1 << 16])
+@pytest.mark.parametrize('text', [
+    # whitespace and newlines after "features" split among several chunks
+    '{"type":"FeatureCollection","features"' + ' '*50 + ':' + json.dumps(FEATURES) + '}',
+    '{"type":"FeatureCollection","features":\n' + '\n'*40 + json.dumps(FEATURES) + '}',
+    json.dumps({'type': 'FeatureCollection', 'features': FEATURES}, indent=4),
+], ids=['spaces', 'newlines', 'indented'])
+def test_iter_features_small_chunks(tmp_path, text: str, chunk_size: int) -> None:
+    filename = tmp_path / 'features.json'
+    filename.write_text(text, encoding='utf-8')
+    assert list(buses.iter_features(str(filename), chunk_size)) == FEATURES
+
+
+def test_iter_features_empty(tmp_path) -> None:
+    filename = tmp_path / 'features.json'
+    filename.write_text('{"type": "FeatureCollection", "features": [ ]}', encoding='utf-8')
+    assert list(buses.iter_features(str(filename), 4)) == []
+
+
+def route_between_stops(idx: int, trgt_dist: float, route: list[Coord]) -> tuple[int, list[Coord]]:
+    """ Returns the index and list of coordinates coresponding to the path between stops (previous implementation) """
+    distance: float = 0  # acumulated distance
+    route_between: list[Coord] = [route[idx]]
+    while idx < len(route)-1 and distance+dist(route[idx], route[idx+1]) <= trgt_dist:
+        distance += dist(route[idx], route[idx+1])  # using harversines
+        route_between.append(route[idx+1])
+        idx += 1
+    return idx+1, route_between
+
+
+def reference_buses_from_network(network: NetworkBus) -> BusesGraph:
+    """ Previous implementation of buses.get_buses_from_network """
+    graph = BusesGraph()
+    for busline in network.busLines().values():
+        for s in busline.stops():
+            graph.add_node(s.code, name=s.name, poblacio=s.poblacio, x=s.pos[0], y=s.pos[1],
+                           color="#"+brighter_color(busline.color()))
+
+        index: int = 0
+        route_between: list[Coord] = list()
+        for src, dst in zip(busline.stops(), busline.stops()[1:]):
+            trgt_dist: float = dst.dist_prev - \
+                dist(src.pos, busline.route()[index])
+            if trgt_dist <= 0:
+                route_between = list()
+            else:
+                index, route_between = route_between_stops(
+                    index, trgt_dist, busline.route())
+            graph.add_edge(src.code, dst.code, route=[src.pos]+route_between+[dst.pos],
+                           length=dst.dist_prev/8.33, color="#"+brighter_color(busline.color()))
+    return graph
+
+
+STEP: float = 0.0006  # degrees of longitude between two points of the routes, about 50 meters
+
+
+def _network(lines: list[tuple[int, list[Coord], list[tuple[Coord, float | None]]]]) -> NetworkBus:
+    """ Network with the lines (id, route, stops as (position, dist_prev)) """
+    network = NetworkBus()
+    for id, route, stops in lines:
+        network.addBusLine(id, 'L'+str(id), '00A0C0', route)
+        for i, (pos, dist_prev) in enumerate(stops):
+            network.addStop(id, 1000*id+i, 'Stop '+str(i), 'Barcelona', pos, dist_prev)
+    return network
+
+
+def _assert_same_graph(network: NetworkBus) -> None:
+    reference = reference_buses_from_network(network)
+    graph = buses.get_buses_from_network(network)
+    assert dict(reference.nodes(data=True)) == dict(graph.nodes(data=True))
+    assert set(reference.edges) == set(graph.edges)
+    for u, v, data in reference.edges(data=True):
+        assert [[float(x) for x in p] for p in data['route']] == [[float(x) for x in p] for p in graph[u][v]['route']], (u, v)
+        assert data['length'] == graph[u][v]['length'] and data['color'] == graph[u][v]['color'], (u, v)
+
+
+def test_split_route_cases() -> None:
+    route: list[Coord] = [(2.15+i*STEP, 41.38+(i % 2)*STEP/5) for i in range(30)]
+
+    def near(i: int) -> Coord:
+        return (route[i][0], route[i][1]+STEP/10)
+    # the route between consecutive stops is about 50 meters per point: dist_prev 0, shorter than it, longer than it, and beyond its end
+    # (only for the last stop, once the whole route is used neither implementation has a point to measure the next stop from)
+    _assert_same_graph(_network([
+        (1, route, [(near(0), None), (near(0), 0), (near(5), 180), (near(9), 320), (near(20), 560), (near(29), 5000)]),
+        (2, route, [(near(3), 0), (near(4), 60), (near(4), 0), (near(25), 900)]),
+        (3, route, [(near(10), None), (near(12), 20), (near(12), 0)]),
+    ]))
+
+
+def test_random_networks() -> None:
+    rng = random.Random(6)
+    lines: list[tuple[int, list[Coord], list[tuple[Coord, float | None]]]] = list()
+    for id in range(1, 30):
+        route: list[Coord] = [(2.15+i*STEP+rng.uniform(-1, 1)*STEP/4, 41.38+rng.uniform(-1, 1)*STEP/4)
+                              for i in range(rng.randint(2, 40))]
+        length = sum(dist(p, q) for p, q in zip(route, route[1:]))
+        stops: list[tuple[Coord, float | None]] = [(route[0], rng.choice([None, 0]))]
+        middle = rng.randint(0, 10)
+        # the stops in the middle use at most half of the route, the last one can go beyond its end
+        for _ in range(middle):
+            stops.append(((rng.choice(route)[0], route[0][1]), rng.choice([0, rng.uniform(0, length/(2*middle))])))
+        stops.append(((route[-1][0], route[0][1]), rng.choice([0, rng.uniform(0, length), rng.uniform(length, length*1.5)])))
+        lines.append((id, route, stops))
+    _assert_same_graph(_network(lines))
@@ -0,0 +1,71 @@
+""" Tests of isochrone.expand and isochrone.isochrone on the grid city of conftest, with both the networkx and the compiled graph.
+    Run from the root of the project: python -m pytest tests """
+import math
+import pytest
+import billboard
+import city
+import isochrone
+from billboard import Cinema, Film, Projection
+
+
+FILM: Film = Film('Film', [], [], [], '')
+BUDGET: float = 300  # seconds, the grid is crossed in 480
+
+
+@pytest.fixture(params=['networkx', 'compiled'])
+def g(request, grid_city: city.CityGraph) -> city.CityGraph | city.CompiledGraph:
+    return grid_city if request.param == 'networkx' else city.compile_city_graph(grid_city)
+
+
+def _node(g: city.CityGraph | city.CompiledGraph, street: int) -> int:
+    """ Node of the street crossing in g (its index in a compiled graph) """
+    return g.index_of(street) if isinstance(g, city.CompiledGraph) else street
+
+
+def _times(g: city.CityGraph | city.CompiledGraph, src: int) -> dict[int, float]:
+    return dict(city.shortest_times(g, src, set())[0])
+
+
+def _at(start: int) -> tuple[int, int]:
+    return start // 3600, start % 3600 // 60
+
+
+def test_showings_after_arriving(g) -> None:
+    src, near, far = _node(g, 0), _node(g, 8), _node(g, 21)
+    times = _times(g, src)
+    assert times[near] < BUDGET < times[far]
+    # leaving so that the cinema near is reached at most a minute before 18:00
+    start = billboard.get_time_in_seconds((18, 0))
+    now = start - math.ceil(times[near])
+    cinemas = {'Near': near, 'Far': far}
+    projections = [Projection(FILM, Cinema('Near', '', (0, 0)), _at(start), 'Doblada'),
+                   Projection(FILM, Cinema('Near', '', (0, 0)), _at(start-60), 'Doblada'),  # starts before arriving
+                   Projection(FILM, Cinema('Near', '', (0, 0)), _at(start+3600), 'Original'),
+                   Projection(FILM, Cinema('Far', '', (0, 0)), _at(start+3600), 'Doblada')]  # too far for the budget
+    result = isochrone.isochrone(g, src, BUDGET, now, projections, cinemas)
+    assert [(projection.time, projection.language) for projection, _ in result.showings] == [((18, 0), 'Doblada'), ((19, 0), 'Original')]
+    assert all(travel == pytest.approx(times[near]) for _, travel in result.showings)
+    assert all(now + travel <= billboard.get_time_in_seconds(projection.time) for projection, travel in result.showings)
+    # every street node within the budget, with its time, and none of the stops
+    assert result.nodes == pytest.approx({u: t for u, t in times.items() if t <= BUDGET and u in result.nodes})
+    assert len(result.nodes) == sum(1 for u, t in times.items() if t <= BUDGET and isochrone._is_street(g, u))
+    assert not result.polygon.is_empty
+
+
+def test_streams_before_finishing(g, monkeypatch) -> None:
+    src, near = _node(g, 0), _node(g, 1)
+    projections = [Projection(FILM, Cinema('Near', '', (0, 0)), (23, 0), 'Doblada')]
+    updates = isochrone.expand(g, src, BUDGET, 0, projections, {'Near': near})
+    # the nearest cinema comes out long before the search reaches the budget
+    first = next(updates)
+    assert [projection for projection, _ in first.showings] == projections
+    assert first.time < BUDGET
+    rest = list(updates)
+    assert rest and rest[-1].time == BUDGET
+
+    # without showings, an update every STREAM_NODES street nodes
+    monkeypatch.setattr(isochrone, 'STREAM_NODES', 5)
+    updates = list(isochrone.expand(g, src, BUDGET, 0, [], {}))
+    assert all(len(update.nodes) == 5 for update in updates[:-1])
+    assert len(updates) > 2
+    assert [update.time for update in updates] == sorted(update.time for update in updates)
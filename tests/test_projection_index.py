@@ -0,0 +1,78 @@
+""" Tests of billboard.ProjectionIndex: the projections of each film and language sorted by start time, updated when the billboard is refreshed.
+    Run from the root of the project: python -m pytest tests """
+import billboard
+from billboard import Billboard, Cinema, Film, Projection, ProjectionIndex
+
+
+FILMS: list[Film] = [Film('Film '+str(i), [], [], [], '') for i in range(2)]
+CINEMAS: list[Cinema] = [Cinema('Cinema '+str(i), '', (2.17, 41.38)) for i in range(4)]
+
+
+def _projection(film: int, cinema: int, time: tuple[int, int], language: str = 'Doblada') -> Projection:
+    return Projection(FILMS[film], CINEMAS[cinema], time, language)
+
+
+def _billboard(projections: list[Projection]) -> Billboard:
+    return Billboard(FILMS, CINEMAS, projections)
+
+
+def _names(projections: list[Projection]) -> list[tuple[str, tuple[int, int]]]:
+    return [(projection.cinema.name, projection.time) for projection in projections]
+
+
+def test_sorted_with_ties() -> None:
+    index = ProjectionIndex(_billboard([_projection(0, 0, (20, 0)), _projection(0, 1, (18, 0)), _projection(0, 2, (18, 0)),
+                                        _projection(0, 3, (18, 0)), _projection(0, 0, (18, 0), 'Original')]))
+    assert len(index) == 5
+    # the ones starting at the same second keep the order of the billboard
+    assert _names(index.next_showings('Film 0', 'Doblada', 0)) == [
+        ('Cinema 1', (18, 0)), ('Cinema 2', (18, 0)), ('Cinema 3', (18, 0)), ('Cinema 0', (20, 0))]
+    assert _names(index.next_showings('Film 0', 'Original', 0)) == [('Cinema 0', (18, 0))]
+    assert not index.add(_projection(0, 2, (18, 0)))
+    assert len(index) == 5
+
+
+def test_next_showings() -> None:
+    index = ProjectionIndex(_billboard([_projection(0, i % 4, (16+i, 30)) for i in range(6)]))
+    t = billboard.get_time_in_seconds((18, 30))
+    # starting exactly at t counts
+    assert _names(index.next_showings('Film 0', 'Doblada', t)) == [('Cinema 2', (18, 30)), ('Cinema 3', (19, 30)),
+                                                                   ('Cinema 0', (20, 30)), ('Cinema 1', (21, 30))]
+    assert _names(index.next_showings('Film 0', 'Doblada', t+1, n=2)) == [('Cinema 3', (19, 30)), ('Cinema 0', (20, 30))]
+    assert index.next_showings('Film 0', 'Doblada', t, n=0) == []
+    assert len(index.next_showings('Film 0', 'Doblada', 0, n=100)) == 6
+    assert index.next_showings('Film 0', 'Doblada', billboard.get_time_in_seconds((23, 0))) == []
+    assert index.next_showings('Film 1', 'Doblada', 0) == []
+    assert index.next_showings('Film 0', 'Original', 0) == []
+
+
+def test_remove() -> None:
+    tied = [_projection(0, i, (18, 0)) for i in range(4)]
+    index = ProjectionIndex(_billboard([_projection(0, 0, (17, 0))] + tied + [_projection(0, 0, (19, 0))]))
+    # a new but equal projection is found among the ones starting at the same second
+    assert index.remove(_projection(0, 2, (18, 0)))
+    assert not index.remove(_projection(0, 2, (18, 0)))
+    assert not index.remove(_projection(1, 2, (18, 0)))
+    assert _names(index.next_showings('Film 0', 'Doblada', 0)) == [
+        ('Cinema 0', (17, 0)), ('Cinema 0', (18, 0)), ('Cinema 1', (18, 0)), ('Cinema 3', (18, 0)), ('Cinema 0', (19, 0))]
+    for projection in index.next_showings('Film 0', 'Doblada', 0):
+        assert index.remove(projection)
+    assert len(index) == 0
+    assert index.next_showings('Film 0', 'Doblada', 0) == []
+
+
+def test_update() -> None:
+    old = [_projection(0, 0, (18, 0)), _projection(0, 1, (18, 0)), _projection(1, 0, (20, 0)), _projection(0, 2, (21, 0))]
+    index = ProjectionIndex()
+    assert index.update(_billboard(old)) == (4, 0)
+    # the refreshed billboard has new objects: the same showings are kept, one is removed and two are added (one tied with a kept one)
+    new = [_projection(0, 1, (18, 0)), _projection(1, 0, (20, 0)), _projection(0, 2, (21, 0)),
+           _projection(0, 3, (18, 0)), _projection(1, 1, (22, 0), 'Original')]
+    assert index.update(_billboard(new)) == (2, 1)
+    assert len(index) == 5
+    assert _names(index.next_showings('Film 0', 'Doblada', 0)) == [
+        ('Cinema 1', (18, 0)), ('Cinema 3', (18, 0)), ('Cinema 2', (21, 0))]
+    assert _names(index.next_showings('Film 1', 'Original', 0)) == [('Cinema 1', (22, 0))]
+    assert index.update(_billboard(new)) == (0, 0)
+    assert index.update(_billboard([])) == (0, 5)
+    assert len(index) == 0
@@ -0,0 +1,95 @@
+""" Tests of routecache.RouteCache: the least recently used routes of each process in memory (bounded by routes and by nodes) and the shared
+    sqlite file, kept by graph version. Run from the root of the project: python -m pytest tests """
+import multiprocessing
+import sqlite3
+import pytest
+import routecache
+
+
+def _route(nodes: int) -> routecache.Route:
+    return float(nodes), list(range(nodes))
+
+
+def _rows(filename: str) -> list[tuple[str, str, str]]:
+    with sqlite3.connect(filename) as connection:
+        return sorted(connection.execute("SELECT version, origin, destination FROM routes").fetchall())
+
+
+def test_memory_evicts_by_routes() -> None:
+    cache = routecache.RouteCache('v1', filename=None, routes=2)
+    cache.put(1, 2, _route(3))
+    cache.put(1, 3, _route(3))
+    assert cache.get(1, 2) == _route(3)  # now (1, 3) is the least recently used
+    cache.put(1, 4, _route(3))
+    assert cache.get(1, 3) is None
+    assert cache.get(1, 2) == _route(3) and cache.get(1, 4) == _route(3)
+    assert cache.stats() == routecache.Stats(hits=3, shared_hits=0, misses=1, evictions=1)
+
+
+def test_memory_evicts_by_nodes() -> None:
+    cache = routecache.RouteCache('v1', filename=None, nodes=10)
+    cache.put(1, 2, _route(4))
+    cache.put(1, 3, _route(4))
+    cache.put(1, 4, _route(4))  # 12 nodes, the first route goes
+    assert cache.get(1, 2) is None
+    cache.put(1, 5, _route(20))  # more nodes than the bound alone, it is kept anyway
+    assert cache.get(1, 5) == _route(20)
+    assert cache.get(1, 3) is None and cache.get(1, 4) is None
+    assert cache.stats().evictions == 3
+
+
+def test_shared_hit(tmp_path) -> None:
+    filename = str(tmp_path / "routes.sqlite")
+    first = routecache.RouteCache('v1', filename)
+    first.put(1, 2, (10.5, [1, 'a-1', 2]))
+    # another process (or run) opens the same file without deleting anything
+    second = routecache.RouteCache(*first.settings(), invalidate=False)
+    assert second.get(1, 2) == (10.5, [1, 'a-1', 2])
+    assert second.get(1, 2) == (10.5, [1, 'a-1', 2])  # from its memory now
+    assert second.get(2, 1) is None
+    assert second.stats() == routecache.Stats(hits=1, shared_hits=1, misses=1, evictions=0)
+
+
+def test_other_versions_are_deleted(tmp_path) -> None:
+    filename = str(tmp_path / "routes.sqlite")
+    old = routecache.RouteCache('v1', filename)
+    old.put(1, 2, _route(2))
+    old.put(3, 4, _route(2))
+    routecache.RouteCache('v1', filename).put(5, 6, _route(2))  # same version, kept
+    assert len(_rows(filename)) == 3
+    new = routecache.RouteCache('v2', filename)
+    assert _rows(filename) == []
+    assert new.get(1, 2) is None
+
+
+def test_prune(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(routecache, 'PRUNE_EVERY', 5)
+    filename = str(tmp_path / "routes.sqlite")
+    cache = routecache.RouteCache('v1', filename, shared_routes=3)
+    for i in range(4):
+        cache.put(0, i, _route(2))
+    assert len(_rows(filename)) == 4  # not pruned until PRUNE_EVERY routes are added
+    cache.put(0, 4, _route(2))
+    # the least recently used are deleted
+    assert _rows(filename) == [('v1', '0', '2'), ('v1', '0', '3'), ('v1', '0', '4')]
+
+
+def _forked_get(cache: routecache.RouteCache, queue: multiprocessing.Queue) -> None:
+    queue.put((cache.get(1, 2), cache._pid, cache.stats().shared_hits))
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_forked_process_opens_its_connection(tmp_path) -> None:
+    filename = str(tmp_path / "routes.sqlite")
+    cache = routecache.RouteCache('v1', filename)
+    cache.put(1, 2, _route(3))
+    cache._memory.clear()  # so the forked process has to read the file
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_forked_get, args=(cache, queue))
+    process.start()
+    route, pid, shared_hits = queue.get(timeout=30)
+    process.join()
+    # the connection inherited from the parent is not used, the child opens its own
+    assert route == _route(3) and shared_hits == 1
+    assert pid == process.pid != cache._pid
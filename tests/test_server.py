@@ -0,0 +1,29 @@
+""" Tests of the validation of the queries of the routing service, done before they are sent to the workers.
+    Run from the root of the project: python -m pytest tests """
+import pytest
+import server
+
+
+@pytest.mark.parametrize('queries, arity', [
+    ([], 4),
+    ([[2.17, 41.387, 2.15, 41.39], [2, 41, 2, 41]], 4),
+    ([[2.17, 41.387, 600], [2.17, 41.387, 0]], 3),
+])
+def test_valid(queries, arity) -> None:
+    assert server._check_queries(queries, arity) is None
+
+
+@pytest.mark.parametrize('queries, arity', [
+    ({'a': 1}, 4),
+    ([5], 4),
+    ([[2.17, 41.387, 2.15]], 4),
+    ([[2.17, 41.387, 2.15, 41.39, 0]], 4),
+    ([[2.17, '41.387', 2.15, 41.39]], 4),
+    ([[2.17, None, 2.15, 41.39]], 4),
+    ([[2.17, True, 2.15, 41.39]], 4),
+    ([[2.17, 41.387, float('nan')]], 3),
+    ([[2.17, 41.387, float('inf')]], 3),
+    ([[2.17, 41.387, -1]], 3),
+])
+def test_invalid(queries, arity) -> None:
+    assert server._check_queries(queries, arity) is not None
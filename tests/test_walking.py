@@ -0,0 +1,47 @@
+""" Tests of city.walking_path on a small synthetic city: a grid of streets with a bus line whose stops are far apart but one short
+    bus edge away. Walking the buses are never taken, and the search and the contraction hierarchy give the same times, also when the walk
+    starts or ends at a stop. Run from the root of the project: python -m pytest tests """
+import copy
+import math
+import networkx as nx
+import pytest
+import city
+import hierarchy
+from conftest import SIZE
+
+
+def _walk(g: city.CityGraph | city.CompiledGraph, src, dst) -> float:
+    try:
+        return city.walking_path(g, src, dst)[0]
+    except nx.NetworkXNoPath:
+        return math.inf
+
+
+@pytest.fixture(scope='module')
+def graphs(grid_city: city.CityGraph) -> tuple[city.CityGraph, city.CompiledGraph, city.CompiledGraph]:
+    """ The networkx city graph, and its compiled version without and with contraction hierarchy """
+    g = grid_city
+    plain = city.compile_city_graph(g)
+    with_hierarchy = copy.copy(plain)
+    with_hierarchy._hierarchy = hierarchy.build_hierarchy(plain)
+    return g, plain, with_hierarchy
+
+
+def test_backends_agree(graphs) -> None:
+    g, plain, with_hierarchy = graphs
+    for src in g.nodes:
+        for dst in g.nodes:
+            u, v = plain.index_of(src), plain.index_of(dst)
+            times = [_walk(g, src, dst), _walk(plain, u, v), _walk(with_hierarchy, u, v)]
+            assert max(times) < math.inf, (src, dst)
+            assert max(times) - min(times) < 1e-2, (src, dst, times)
+
+
+def test_no_buses(graphs) -> None:
+    g, plain, _ = graphs
+    # the stops are one bus edge (1 second) away, walking it is the whole grid
+    time, path = city.walking_path(g, "0-1", "1-1")
+    assert time > 2*(SIZE-1)*80
+    assert not any(isinstance(node, str) for node in path[1:-1])
+    _, path = city.walking_path(plain, plain.index_of("0-1"), plain.index_of("1-1"))
+    assert not any(plain.is_stop[u] for u in path[1:-1])
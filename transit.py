@@ -0,0 +1,340 @@
+from dataclasses import dataclass
+from typing import TypeAlias, Any
+import numpy as np
+import buses
+import city
+import routing
+import metrics
+import math
+import csv
+import os
+
+
+Path: TypeAlias = list
+
+FREQUENCIES_FILE: str = "frequencies.txt"  # GTFS-style frequencies of the bus lines
+TIMETABLE_FORMAT: int = 1  # version of the arrays saved by save_timetable
+TIMETABLE_ARRAYS: list[str] = ['codes', 'street', 'access', 'line_ids', 'line_offsets', 'stop_times', 'freq_offsets',
+                               'freq_start', 'freq_end', 'freq_headway', 'transfer_offsets', 'transfer_targets', 'transfer_times']
+
+BUS_SPEED: float = 8.33  # m/s, same average speed (30 km/h) as the bus graph
+DEFAULT_HEADWAY: int = 6*60  # lines without frequencies run all day every 6 minutes (3 minutes of average wait, as the city graph)
+TRANSFER_WALK: float = 5*60  # longest walk (seconds) between two stops to change bus
+MAX_WALK: float = 30*60  # longest walk (seconds) from the origin to a stop and from a stop to the destination
+MAX_ROUNDS: int = 4  # most buses taken in one journey
+
+
+@dataclass
+class Timetable:
+    """ Bus lines of a city graph with their frequencies, as arrays (struct of arrays as NetworkBus). The stops of each line are
+        consecutive, so a stop is its position in the arrays and belongs to only one line (as in the bus graph, where they are code-line) """
+    codes: np.ndarray  # str, id of each stop in the bus graph (code-line)
+    street: np.ndarray  # int64, street node (of the city graph) the stop is connected to
+    access: np.ndarray  # float64, seconds to walk between the stop and its street node
+    line_ids: np.ndarray  # int64, id of each line (ID_RECORREGUT)
+    line_offsets: np.ndarray  # int64 (lines+1), the stops of line l are line_offsets[l]:line_offsets[l+1]
+    stop_times: np.ndarray  # float64, seconds from the first stop of the line to each stop
+    freq_offsets: np.ndarray  # int64 (lines+1), the frequencies of line l are freq_offsets[l]:freq_offsets[l+1]
+    freq_start: np.ndarray  # int64, first departure (seconds from 00:00) from the first stop of each period
+    freq_end: np.ndarray  # int64, end of each period (no departures at end or later)
+    freq_headway: np.ndarray  # int64, seconds between departures in each period
+    transfer_offsets: np.ndarray  # int64 (stops+1), the transfers from stop s are transfer_offsets[s]:transfer_offsets[s+1]
+    transfer_targets: np.ndarray  # int64, stop reached by each transfer
+    transfer_times: np.ndarray  # float64, seconds of each transfer (walking from stop to stop)
+
+    def number_of_stops(self) -> int:
+        return len(self.codes)
+
+    def number_of_lines(self) -> int:
+        return len(self.line_ids)
+
+    def next_departure(self, line: int, stop: int, t: float) -> float | None:
+        """ Returns the departure from the first stop of the line of the first bus that passes by stop at time t or later (None if there is none) """
+        offset = t - self.stop_times[stop]
+        best: float | None = None
+        for f in range(int(self.freq_offsets[line]), int(self.freq_offsets[line+1])):
+            start, end, headway = int(self.freq_start[f]), int(
+                self.freq_end[f]), int(self.freq_headway[f])
+            departure = start + \
+                max(0, math.ceil((offset-start)/headway))*headway
+            if departure < end and (best is None or departure < best):
+                best = departure
+        return best
+
+
+@dataclass
+class TransitSearch:
+    """ Result of earliest_arrival: the arrival at each target and the labels needed to rebuild the journeys with journey_path """
+    src: Any  # street node where the search started
+    arrival: dict[Any, float]  # target -> earliest arrival (seconds from 00:00), unreachable targets are not in it
+    _walk: dict[Any, Any]  # predecessor map of the walk from src
+    _reverse_walks: dict[Any, dict[Any, Any]]  # target -> predecessor map of the walk to it
+    _labels: list[dict[int, tuple[str, int]]]  # for each round, stop -> ('access', -1), ('bus', boarding stop) or ('walk', previous stop)
+    _best: dict[Any, tuple[int, int]]  # target -> (round, stop) where the best journey leaves the buses, (-1, -1) if it is walking
+
+
+def parse_time(text: str) -> int:
+    """ Returns the seconds from 00:00 of a GTFS time hh:mm:ss (hours can be more than 23 for services after midnight) """
+    h, m, s = text.strip().split(':')
+    return int(h)*3600+int(m)*60+int(s)
+
+
+def load_frequencies(filename: str, network: buses.NetworkBus) -> dict[int, list[tuple[int, int, int]]]:
+    """ Reads a GTFS-style frequencies file (csv with route_id, start_time, end_time and headway_secs).
+        route_id can be the id of a line (ID_RECORREGUT) or its name (for all the lines with that name).
+        Returns line id -> list of (start, end, headway) in seconds """
+    lines: dict[int, buses.BusLine] = network.busLines()
+    by_name: dict[str, list[int]] = dict()
+    for id, busline in lines.items():
+        by_name.setdefault(busline.name(), list()).append(id)
+
+    frequencies: dict[int, list[tuple[int, int, int]]] = dict()
+    with open(filename, 'r', newline='') as file:
+        for row in csv.DictReader(file):
+            route: str = row['route_id'].strip()
+            ids: list[int] = [int(route)] if route.isdigit() and int(
+                route) in lines else by_name.get(route, [])
+            period = (parse_time(row['start_time']), parse_time(
+                row['end_time']), int(row['headway_secs']))
+            assert period[2] > 0, 'headway_secs must be positive'
+            for id in ids:
+                frequencies.setdefault(id, list()).append(period)
+    return frequencies
+
+
+def _stop_node(g: city.CityGraph | city.CompiledGraph, code: str) -> Any:
+    """ Returns the node of the city graph of the stop with the given code """
+    return g.index_of(code) if isinstance(g, routing.CompiledGraph) else code
+
+
+def _street_of(g: city.CityGraph | city.CompiledGraph, stop: Any) -> tuple[Any, float]:
+    """ Returns the street node a stop is connected to and the time to walk from the stop to it (the edge stop -> street has no waiting time) """
+    if isinstance(g, routing.CompiledGraph):
+        for e in range(int(g.offsets[stop]), int(g.offsets[stop+1])):
+            if not g.is_stop[g.targets[e]]:
+                return int(g.targets[e]), float(g.weights[e])
+    else:
+        for v, data in g.adj[stop].items():
+            if not isinstance(v, str):
+                return v, data['length']
+    assert False, str(stop)+' is not connected to the streets'
+
+
+def build_timetable(g: city.CityGraph | city.CompiledGraph, network: buses.NetworkBus, frequencies: dict[int, list[tuple[int, int, int]]]) -> Timetable:
+    """ Returns the timetable of the bus lines of network over the city graph g (built with the same network).
+        The transfers between stops are the walks of at most TRANSFER_WALK seconds along the streets """
+    codes: list[str] = list()
+    line_ids: list[int] = list()
+    line_offsets: list[int] = [0]
+    stop_times: list[float] = list()
+    freq_offsets: list[int] = [0]
+    periods: list[tuple[int, int, int]] = list()
+    for id, busline in network.busLines().items():
+        stops: list[buses.Stop] = busline.stops()
+        line_ids.append(id)
+        codes.extend(stop.code for stop in stops)
+        # the first stop has no previous one
+        stop_times.extend(np.cumsum(
+            [0.0]+[stop.dist_prev/BUS_SPEED for stop in stops[1:]]).tolist())
+        line_offsets.append(len(codes))
+        periods.extend(frequencies.get(id, [(0, 48*3600, DEFAULT_HEADWAY)]))
+        freq_offsets.append(len(periods))
+
+    street: list[Any] = list()
+    access: list[float] = list()
+    for code in codes:
+        node, time = _street_of(g, _stop_node(g, code))
+        street.append(node)
+        access.append(time)
+
+    # One walk from each street node with stops reaches all the stops we can change to
+    stops_at: dict[Any, list[int]] = dict()
+    for s, node in enumerate(street):
+        stops_at.setdefault(node, list()).append(s)
+    walks: dict[Any, list[tuple[int, float]]] = dict()
+    for node in stops_at:
+        times, _ = city.shortest_times(
+            g, node, budget=TRANSFER_WALK, walk_only=True)
+        walks[node] = [(s, t) for v, t in times.items()
+                       for s in stops_at.get(v, ())]
+    transfer_offsets: list[int] = [0]
+    transfer_targets: list[int] = list()
+    transfer_times: list[float] = list()
+    for s, node in enumerate(street):
+        for s2, t in walks[node]:
+            if s2 != s:
+                transfer_targets.append(s2)
+                transfer_times.append(access[s]+t+access[s2])
+        transfer_offsets.append(len(transfer_targets))
+
+    return Timetable(
+        codes=np.array(codes, dtype=str),
+        street=np.array(street, dtype=np.int64),
+        access=np.array(access, dtype=np.float64),
+        line_ids=np.array(line_ids, dtype=np.int64),
+        line_offsets=np.array(line_offsets, dtype=np.int64),
+        stop_times=np.array(stop_times, dtype=np.float64),
+        freq_offsets=np.array(freq_offsets, dtype=np.int64),
+        freq_start=np.array([p[0] for p in periods], dtype=np.int64),
+        freq_end=np.array([p[1] for p in periods], dtype=np.int64),
+        freq_headway=np.array([p[2] for p in periods], dtype=np.int64),
+        transfer_offsets=np.array(transfer_offsets, dtype=np.int64),
+        transfer_targets=np.array(transfer_targets, dtype=np.int64),
+        transfer_times=np.array(transfer_times, dtype=np.float64),
+    )
+
+
+def save_timetable(tt: Timetable, filename: str, version: str = "") -> None:
+    """ Saves the arrays of the timetable in a .npz file (no pickle) with the version of the inputs it was built from """
+    np.savez(filename, format=np.array(TIMETABLE_FORMAT), version=np.array(version),
+             **{name: getattr(tt, name) for name in TIMETABLE_ARRAYS})
+
+
+def load_timetable(filename: str, version: str | None = None) -> Timetable | None:
+    """ Loads a timetable saved with save_timetable. Returns None if it has another format or was built from other inputs than version """
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename, allow_pickle=False) as data:
+        if int(data['format']) != TIMETABLE_FORMAT or (version is not None and str(data['version']) != version):
+            return None
+        return Timetable(**{name: data[name] for name in TIMETABLE_ARRAYS})
+
+
+@metrics.timed('transit.earliest_arrival')
+def earliest_arrival(g: city.CityGraph | city.CompiledGraph, tt: Timetable, src: Any, t0: float, targets: set[Any], budget: float = math.inf) -> TransitSearch:
+    """ Earliest arrival at each target leaving the street node src at time t0 (seconds from 00:00), walking and taking the buses
+        when they really pass (RAPTOR: in round k the journeys take k buses, each round scans every line once from its first improved stop).
+        Walks from src and to the targets are at most MAX_WALK seconds, and journeys arriving later than t0+budget are discarded """
+    limit: float = t0 + budget
+    walk_limit: float = min(MAX_WALK, budget)
+    walk, walk_pred = city.shortest_times(
+        g, src, budget=walk_limit, walk_only=True)
+    # time from every street node near each target to it
+    reverse_walks: dict[Any, tuple[dict[Any, float], dict[Any, Any]]] = {target: city.shortest_times(
+        g, target, budget=walk_limit, reverse=True, walk_only=True) for target in targets}
+
+    arrival: dict[Any, float] = {target: t0+walk[target]
+                                 for target in targets if target in walk}
+    best_leg: dict[Any, tuple[int, int]] = {
+        target: (-1, -1) for target in arrival}
+    street: list[int] = tt.street.tolist()
+    access: list[float] = tt.access.tolist()
+    stop_times: list[float] = tt.stop_times.tolist()
+    line_offsets: list[int] = tt.line_offsets.tolist()
+    transfer_offsets: list[int] = tt.transfer_offsets.tolist()
+    line_of: np.ndarray = np.repeat(np.arange(tt.number_of_lines()), np.diff(tt.line_offsets))
+
+    # stops a target can be reached from: stop -> list of (target, time from the stop to the target)
+    egress: dict[int, list[tuple[Any, float]]] = dict()
+    stops_at: dict[Any, list[int]] = dict()
+    for s, node in enumerate(street):
+        stops_at.setdefault(node, list()).append(s)
+    for target, (times, _) in reverse_walks.items():
+        for node, t in times.items():
+            for s in stops_at.get(node, ()):
+                egress.setdefault(s, list()).append((target, access[s]+t))
+
+    def reach_targets(stops: list[int], k: int) -> None:
+        """ Updates the arrival at the targets leaving the buses at the given stops in round k """
+        for s in stops:
+            for target, t in egress.get(s, ()):
+                if best[s]+t < arrival.get(target, math.inf) and best[s]+t <= limit:
+                    arrival[target] = best[s]+t
+                    best_leg[target] = (k, s)
+
+    # Round 0: walking from src to every stop
+    best: list[float] = [math.inf]*tt.number_of_stops()
+    labels: list[dict[int, tuple[str, int]]] = [dict()]
+    for s, node in enumerate(street):
+        if node in walk and t0+walk[node]+access[s] <= limit:
+            best[s] = t0+walk[node]+access[s]
+            labels[0][s] = ('access', -1)
+    marked: set[int] = set(labels[0])
+    reach_targets(list(marked), 0)
+
+    for k in range(1, MAX_ROUNDS+1):
+        if not marked:
+            break
+        previous: list[float] = best.copy()  # arrivals with at most k-1 buses
+        labels.append(dict())
+        # first improved stop of each line
+        first: dict[int, int] = dict()
+        for s in marked:
+            line = int(line_of[s])
+            if s < first.get(line, math.inf):
+                first[line] = s
+
+        # Scan each line from its first improved stop, riding the earliest bus we can catch
+        improved: list[int] = list()
+        for line, begin in first.items():
+            departure: float | None = None  # departure from the first stop of the line of the bus we are in
+            boarding: int = -1
+            for s in range(begin, line_offsets[line+1]):
+                if departure is not None:
+                    t = departure + stop_times[s]
+                    if t < best[s] and t <= limit:
+                        best[s] = t
+                        labels[k][s] = ('bus', boarding)
+                        improved.append(s)
+                # we can catch an earlier bus if we were at this stop in the previous round
+                if previous[s] < (math.inf if departure is None else departure+stop_times[s]):
+                    earlier = tt.next_departure(line, s, previous[s])
+                    if earlier is not None and (departure is None or earlier < departure):
+                        departure, boarding = earlier, s
+
+        # Walk to the stops near the ones we got off the bus
+        walked: list[int] = list()
+        for s in improved:
+            for e in range(transfer_offsets[s], transfer_offsets[s+1]):
+                s2 = int(tt.transfer_targets[e])
+                t = best[s] + float(tt.transfer_times[e])
+                if t < best[s2] and t <= limit:
+                    best[s2] = t
+                    labels[k][s2] = ('walk', s)
+                    walked.append(s2)
+        reach_targets(improved, k)
+        marked = set(improved) | set(walked)
+
+    metrics.count('rounds', len(labels))
+    metrics.count('reached', len(arrival))
+    return TransitSearch(src, arrival, walk_pred, {target: pred for target, (_, pred) in reverse_walks.items()}, labels, best_leg)
+
+
+def journey_path(g: city.CityGraph | city.CompiledGraph, tt: Timetable, search: TransitSearch, target: Any) -> Path:
+    """ Rebuilds the path (nodes of the city graph) of the best journey found by earliest_arrival to target """
+    assert target in search.arrival, str(target)+' was not reached'
+    k, s = search._best[target]
+    if k < 0:
+        return city.path_from(search._walk, target)
+
+    # walk from the last stop to the target (the reverse predecessors go towards the target)
+    tail: Path = [_stop_node(g, str(tt.codes[s]))] + \
+        city.path_from(search._reverse_walks[target], int(tt.street[s]))[::-1]
+    legs: list[Path] = [tail]
+    while True:
+        kind, previous = search._labels[k][s]
+        if kind == 'access':
+            legs.append(city.path_from(search._walk, int(
+                tt.street[s]))+[_stop_node(g, str(tt.codes[s]))])
+            break
+        if kind == 'bus':
+            legs.append([_stop_node(g, str(tt.codes[i]))
+                        for i in range(previous, s+1)])
+            # we got on the bus with the last label of the stop before this round
+            k -= 1
+            while previous not in search._labels[k]:
+                k -= 1
+        else:
+            _, walk = city.walking_path(
+                g, int(tt.street[previous]), int(tt.street[s]))
+            legs.append([_stop_node(g, str(tt.codes[previous]))] +
+                        walk + [_stop_node(g, str(tt.codes[s]))])
+        s = previous
+
+    # join the legs without repeating the nodes where they meet
+    path: Path = list()
+    for leg in reversed(legs):
+        for node in leg:
+            if not path or path[-1] != node:
+                path.append(node)
+    return path